@@ -1,12 +1,23 @@
-from flask import Flask, request, render_template, redirect, url_for, session, jsonify, send_from_directory
+from flask import Flask, request, render_template, redirect, url_for, session, jsonify, send_from_directory, Response
 import os
-from face_detection import create_image_output, create_video_output
+import base64
+import binascii
+import json
+import subprocess
+import threading
+import time
+from urllib.parse import quote, urlsplit
+import metrics
+import job_progress
+import live_stream
+import upload_manifest
 from flask_dropzone import Dropzone
 import uuid
 
-from rq import Queue
+from rq import Queue, get_current_job
 from rq.job import Job
-from worker import conn
+from rq.timeouts import JobTimeoutException
+from worker import conn, QUEUES, FAST_QUEUE, BULK_QUEUE
 
 app = Flask(__name__)
 
@@ -17,8 +28,45 @@ app = Flask(__name__)
 # This should happen only in localhost case, on Heroku, you must initialize this variable in the config
 app.secret_key = os.getenv('SECRET_KEY', os.urandom(16))
 
-# Redis Task Queue that will handle all jobs
-queue = Queue(connection=conn)
+# Redis Task Queues that will handle all jobs, one per queue class (see worker.py)
+queues = {name: Queue(name, connection=conn) for name in QUEUES}
+
+# How long Redis holds on to the batch of sub-jobs, as long as the longest lived job result
+JOB_RESULT_TTL = max(config['result_ttl'] for config in QUEUES.values())
+# Videos up to this size and this long (in seconds) are cheap enough to be processed on the fast queue along with images (2 MB)
+FAST_VIDEO_MAX_BYTES = 2 * 1024 * 1024
+FAST_VIDEO_MAX_SECONDS = 20
+# ffprobe reads the duration of uploaded videos from their container, without it videos are only routed by their size
+FFPROBE_BINARY = os.getenv('FFPROBE_BINARY', 'ffprobe')
+FFPROBE_TIMEOUT = 5
+# Uploads are fanned out into sub-jobs so that a batch scales with the number of workers,
+# every video gets its own sub-job and images are grouped IMAGES_PER_JOB at a time (they are cheap and batch well)
+IMAGES_PER_JOB = 5
+# Prefix of the Redis list that holds the sub-job ids of a batch, the batch id is what the client polls for
+BATCH_KEY_PREFIX = 'batch:'
+
+# Progress events of a batch are sent at least this often (in seconds) even if no sub-job published any progress,
+# which also catches sub-jobs that failed without publishing
+EVENTS_HEARTBEAT = 15
+# After a sub-job reported its last file, its status is checked again this soon since RQ only marks it finished after it returned
+EVENTS_FINISH_CHECK = 0.5
+# An event stream is closed after this many seconds, the browser's EventSource reconnects by itself
+EVENTS_MAX_DURATION = 60
+# Every open event stream (and MJPEG stream) holds one of the web process' threads (16 with gunicorn, see heroku.sh),
+# so only this many are open at once and further clients get a 503, on which the browser polls "jobs/<job_key>" instead
+EVENTS_MAX_STREAMS = int(os.getenv('EVENTS_MAX_STREAMS', 8))
+event_stream_slots = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+# Maximum size of a webcam frame posted to a live stream (1 MB)
+LIVE_MAX_FRAME_BYTES = 1024 * 1024
+# Hosts (or host:port) that live streams may read RTSP sources from, comma separated
+# Empty by default, so that anonymous clients can't make the live worker connect to arbitrary hosts
+LIVE_RTSP_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv('LIVE_RTSP_ALLOWED_HOSTS', '').split(',') if host.strip()}
+
+# Maximum number of images accepted by a single /api/predict request
+API_MAX_IMAGES = 10
+# The synchronous API runs the model inside the web process, one request at a time since the model and detectors aren't thread safe
+api_lock = threading.Lock()
 
 # Set the upload folder for whatever we upload
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -38,6 +86,15 @@ app.config['DROPZONE_ALLOWED_FILE_TYPE'] = '.jpg, .png, .bmp, .jpeg, .mp4, .avi,
 app.config['DROPZONE_MAX_FILE_SIZE'] = 20 # 20 MB
 app.config['DROPZONE_MAX_FILE'] = 10
 
+# Output names are unique per upload and never rewritten, so browsers may cache them for good (one year, the maximum of HTTP/1.1)
+RESULT_FILE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+# Optionally hand the bytes of result files off to the front-end server, so that web workers aren't tied up streaming videos:
+# "x-sendfile" (Apache mod_xsendfile, lighttpd) or "x-accel-redirect" (nginx), empty to let Flask stream them
+RESULT_FILE_OFFLOAD = os.getenv('RESULT_FILE_OFFLOAD', '').lower()
+# With X-Accel-Redirect, the internal nginx location that is aliased to UPLOAD_FOLDER
+X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX', '/protected-uploads/')
+app.use_x_sendfile = RESULT_FILE_OFFLOAD in ('x-sendfile', 'x-accel-redirect')
+
 # Set of extensions allowed
 IMAGE_EXTENSIONS = {'bmp', 'jpg', 'png', 'jpeg', 'jpe'}
 VIDEO_EXTENSIONS = {'mp4', 'avi', 'wmv', 'flv', 'mpeg'}
@@ -52,6 +109,19 @@ def allowed_image(filename):
 def allowed_video(filename):
 	return '.' in filename and filename.split('.')[-1].lower() in VIDEO_EXTENSIONS
 
+def allowed_rtsp_source(url):
+	'''
+		Whether a live stream may read the given RTSP URL, i.e., whether its host (or host:port) is in LIVE_RTSP_ALLOWED_HOSTS
+	'''
+	try:
+		parts = urlsplit(url)
+		host = (parts.hostname or '').lower()
+		host_port = '%s:%s' % (host, parts.port) if parts.port else host
+	except ValueError:
+		return False
+
+	return bool(host) and (host in LIVE_RTSP_ALLOWED_HOSTS or host_port in LIVE_RTSP_ALLOWED_HOSTS)
+
 
 @app.route('/')
 @app.route('/home')
@@ -94,11 +164,16 @@ def upload_file():
 			filename = user_uuid + file_uuid + '.' + file.filename.split('.')[-1]
 
 			# If file is an allowed image or video then save it in their respective input folder
+			# and record it in the user's upload manifest
 			if allowed_image(filename):
 				file.save(os.path.join(IMAGES_INPUT_FOLDER_PATH, filename))
+				upload_manifest.record_upload(conn, user_uuid, upload_manifest.IMAGES, filename)
 
 			elif allowed_video(filename):
-				file.save(os.path.join(VIDEOS_INPUT_FOLDER_PATH, filename))
+				video_path = os.path.join(VIDEOS_INPUT_FOLDER_PATH, filename)
+				file.save(video_path)
+				# Read once here so that starting the jobs doesn't have to wait on ffprobe for every video (see video_queue())
+				upload_manifest.record_upload(conn, user_uuid, upload_manifest.VIDEOS, filename, video_duration(video_path))
 
 			else:
 				# If file format is not supported, then return with an error message with a 4xx status code
@@ -114,7 +189,7 @@ def upload_file():
 def jobs():
 	'''
 		This route is triggered when "Display Results" button is clicked on the home page
-		It uses user_uuid to parse the input directories and identify which are the user uploaded files
+		It uses user_uuid to read the user's upload manifest and identify which are the user uploaded files
 		If no files were uploaded by user then just redirect to home
 		If files were uploaded then start the Redis job, store filenames in the session dictionary
 		and return the job_id back to the client.
@@ -129,17 +204,9 @@ def jobs():
 		user_uuid = session['user_uuid']
 
 		# Checking for whether user has uploaded any image or video file
-		image_filenames = []
-		video_filenames = []
-
-		# Collect all the output filenames in their respective lists
-		for filename in os.listdir(IMAGES_INPUT_FOLDER_PATH):
-			if user_uuid in filename:
-				image_filenames.append(filename)
-		
-		for filename in os.listdir(VIDEOS_INPUT_FOLDER_PATH):
-			if user_uuid in filename:
-				video_filenames.append(filename)
+		# The manifest only holds this user's files, so this doesn't get slower as the upload folders fill up
+		image_filenames, video_filenames = upload_manifest.get_uploads(conn, user_uuid)
+		video_durations = upload_manifest.get_video_durations(conn, user_uuid)
 
 		# If no images and videos were uploaded to the dropzone, then both these lists would be empty
 		# In this case, redirect to home page and display Error Message
@@ -147,13 +214,9 @@ def jobs():
 			response_object['error_code'] = 101
 			return jsonify(response_object), 302
 		
-		# Enqueue the prediction job on the Redis Task Queue
-		# The result_ttl=5000 line argument tells RQ how long to hold on to the result of the job for, 
-		# 5,000 seconds in this case. 
-		job = queue.enqueue_call(
-			func='app.create_output', 
-			args=(image_filenames, video_filenames),
-			result_ttl=5000)
+		# Enqueue one sub-job per video and per chunk of images on the Redis Task Queue
+		# and group them under a single batch id that is returned to the client
+		batch_id = enqueue_batch(image_filenames, video_filenames, video_durations)
 
 		# Store the image and video filename lists in the session dictionary
 		# This is because the output files will also have the same names and these lists can be 
@@ -161,11 +224,11 @@ def jobs():
 		session['image_filenames'] = image_filenames
 		session['video_filenames'] = video_filenames
 
-		print(job.get_id())
+		print(batch_id)
 
 		response_object = {
 			"status": "success",
-			"job_id": job.get_id()
+			"job_id": batch_id
 		}
 
 		# Respond to request by Client with success code indicating that job has started
@@ -188,6 +251,16 @@ def get_results(job_key):
 			The result of the job can be fetched for a completed job using,
 			response_object['data']['job_result']
 	'''
+	# A batch of sub-jobs reports the combined status of all of them
+	batch_status = fetch_batch_status(job_key)
+
+	if batch_status is not None:
+		response_object = {
+			"status": "success",
+			"data": batch_status,
+		}
+		return jsonify(response_object)
+
 	job = Job.fetch(job_key, connection=conn)
 	
 	# If job exists then return job id and status along with result
@@ -208,6 +281,65 @@ def get_results(job_key):
 	return jsonify(response_object)
 
 
+@app.route('/jobs/<job_key>/events', methods=['GET'])
+def job_events(job_key):
+	'''
+		Server-Sent Events stream of the status of a batch, an alternative to polling "jobs/<job_key>"
+		Every event holds the same data as "jobs/<job_key>" returns, including the progress of the batch and the files that are
+		already done. A new event is sent whenever a sub-job publishes progress (see job_progress.py) and the stream ends once
+		the batch finished or failed
+		The progress published by the sub-jobs is merged into the last status read from Redis, which is only read again when a
+		sub-job reports that it is done or when no sub-job published anything for EVENTS_HEARTBEAT seconds
+		Responds with a 503 when EVENTS_MAX_STREAMS streams are already open, the page polls "jobs/<job_key>" then
+	'''
+	if fetch_batch_jobs(job_key) is None:
+		return jsonify({"status": "error"}), 404
+
+	def events():
+		pubsub = conn.pubsub(ignore_subscribe_messages=True)
+		pubsub.subscribe(job_progress.PROGRESS_CHANNEL % job_key)
+		start = time.time()
+
+		try:
+			# Subscribed before reading the status, so no progress published in between is missed
+			batch = fetch_batch_jobs(job_key)
+			progress_updates = {}
+
+			while time.time() - start < EVENTS_MAX_DURATION:
+				if batch is None:
+					yield 'data: %s\n\n' % json.dumps({"job_id": job_key, "job_status": "failed"})
+					return
+
+				batch_status = get_batch_status(job_key, *batch, progress_updates=progress_updates)
+				yield 'data: %s\n\n' % json.dumps(batch_status)
+
+				if batch_status['job_status'] in ('finished', 'failed'):
+					return
+
+				# Wait for the next progress messages, any number of them received meanwhile make a single event
+				job_done = False
+				message = pubsub.get_message(timeout=EVENTS_HEARTBEAT)
+				heartbeat = message is None
+
+				while message is not None:
+					progress = json.loads(message['data'])
+					progress_updates[progress['job_id']] = progress
+					job_done = job_done or len(progress['files_done']) == progress['files_total']
+					message = pubsub.get_message(timeout=0)
+
+				if job_done:
+					time.sleep(EVENTS_FINISH_CHECK)
+
+				# The heartbeat also catches sub-jobs that failed without publishing
+				if job_done or heartbeat:
+					batch = fetch_batch_jobs(job_key)
+					progress_updates = {}
+		finally:
+			pubsub.close()
+
+	return stream_response(events(), 'text/event-stream')
+
+
 @app.route('/results', methods=['GET'])
 def results():
 	'''
@@ -218,6 +350,10 @@ def results():
 	image_filenames = session['image_filenames']
 	video_filenames = session['video_filenames']
 
+	# The files of this upload are now only kept long enough for the browser to load them, then the garbage collector deletes them
+	if 'user_uuid' in session:
+		upload_manifest.results_served(conn, session['user_uuid'], image_filenames, video_filenames)
+
 	# Clear all files that were uploaded by this user because after displaying the files on the results page
 	# This session can essentially be considered as "expired" once the user has reached the results page
 	# And a new session will be created upon hitting the home page again
@@ -226,7 +362,8 @@ def results():
 	session.pop('video_filenames', None)
 	session.pop('user_uuid', None)
 
-	return render_template('results.html', output_images=image_filenames, output_videos=video_filenames)
+	return render_template('results.html', output_images=image_filenames, output_videos=video_filenames,
+						   video_output_mode=upload_manifest.VIDEO_OUTPUT_MODE, video_mimetype=upload_manifest.VIDEO_OUTPUT_MIMETYPE)
 
 
 @app.route('/results/<file_type>/<file_name>')
@@ -236,32 +373,534 @@ def send_file(file_type, file_name):
 
 		Parameters:
 		file_type: Indicates whether file is "image" or "video"
+			or, in the annotations only video output mode, "timeline" or "original_video" (the input video the timeline is drawn over)
 		file_name: Unique name of file, same for input as well as output files
 	'''
 	if file_type == "image":
-		return send_from_directory(IMAGES_OUTPUT_FOLDER_PATH, file_name)
+		return send_result_file(IMAGES_OUTPUT_FOLDER_PATH, file_name)
 
-	# For videos, remove extension and append webm as the final extension because we convert all videos to webm format
+	# For videos, the output name is derived from the input name because we convert all videos to webm (or mp4 for H.264)
 	if file_type == "video":
-		webm_file_name = file_name.split('.')[0] + '.webm'
-		return send_from_directory(VIDEOS_OUTPUT_FOLDER_PATH, webm_file_name)
+		output_file_name = upload_manifest.output_video_filename(file_name, 'video')
+		return send_result_file(VIDEOS_OUTPUT_FOLDER_PATH, output_file_name)
+
+	if file_type == "timeline":
+		timeline_file_name = upload_manifest.output_video_filename(file_name, 'annotations')
+		return send_result_file(VIDEOS_OUTPUT_FOLDER_PATH, timeline_file_name, mimetype='application/x-ndjson')
+
+	if file_type == "original_video":
+		return send_result_file(VIDEOS_INPUT_FOLDER_PATH, file_name)
+
+
+def send_result_file(directory, file_name, mimetype=None):
+	'''
+		Sends a file of an upload with a strong ETag (from its modification time, size and name) and RESULT_FILE_CACHE_CONTROL
+		Conditional requests are answered with a 304 without touching the file's contents. Range requests, e.g., when seeking
+		in a video, are answered with only the requested bytes, by Flask or, with RESULT_FILE_OFFLOAD, by the front-end server
+
+		Parameters:
+		directory: Folder of the file
+		file_name: Name of the file in directory
+		mimetype: Content type, guessed from the extension by default
+	'''
+	if not RESULT_FILE_OFFLOAD:
+		response = send_from_directory(directory, file_name, mimetype=mimetype, conditional=True)
+	else:
+		# The front-end server replaces the empty body with the file and handles ranges itself,
+		# so only the validators are checked here
+		response = send_from_directory(directory, file_name, mimetype=mimetype, conditional=False)
+		response.make_conditional(request)
+		response.headers['Accept-Ranges'] = 'bytes'
+
+		if response.status_code != 200:
+			response.headers.pop('X-Sendfile', None)
+		elif RESULT_FILE_OFFLOAD == 'x-accel-redirect':
+			file_path = response.headers.pop('X-Sendfile')
+			response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX + quote(os.path.relpath(file_path, UPLOAD_FOLDER))
+
+	response.headers['Cache-Control'] = RESULT_FILE_CACHE_CONTROL
+	response.headers.pop('Expires', None)
+
+	return response
+
+
+@app.route('/api/predict', methods=['POST'])
+def api_predict():
+	'''
+		Synchronous prediction API for clients that need labels, not pictures
+		Images are decoded in memory and predicted on directly, without going through the upload folders or the Redis Task Queue
+		
+		Accepts either a multipart request with one or many image files (any field names)
+		or a JSON body of the form {"images": [base64 encoded image, ...], "annotate": false}
+		With annotate set (JSON bool, form field or query parameter, strings must be "true"), the annotated images are returned
+		as base64 encoded JPEGs
+		
+		Returns:
+			response_object (JSON): {"status": "success", "results": [{"faces": [{"box", "label", "probabilities"}, ...]}, ...]}
+			with one result per image in request order, or {"status": "fail", "error": message} with a 400 status code
+	'''
+	json_body = request.get_json(silent=True)
+	annotate = request.values.get('annotate', 'false')
+
+	if json_body is not None:
+		if not isinstance(json_body, dict):
+			return jsonify({"status": "fail", "error": "The JSON body must be an object"}), 400
+
+		images = json_body.get('images')
+		if not isinstance(images, list) or len(images) == 0 or not all(isinstance(image, str) for image in images):
+			return jsonify({"status": "fail", "error": "images must be a non-empty list of base64 encoded images"}), 400
+
+		try:
+			encoded_images = [base64.b64decode(image) for image in images]
+		except binascii.Error:
+			return jsonify({"status": "fail", "error": "Images must be base64 encoded"}), 400
+
+		annotate = json_body.get('annotate', annotate)
+	else:
+		encoded_images = [file.read() for field in request.files for file in request.files.getlist(field)]
+
+	# A JSON bool, or a string parsed the same way wherever it comes from, so that "false" is never taken as true
+	if isinstance(annotate, str):
+		annotate = annotate.lower() == 'true'
+	elif not isinstance(annotate, bool):
+		return jsonify({"status": "fail", "error": "annotate must be true or false"}), 400
+
+	if len(encoded_images) == 0:
+		return jsonify({"status": "fail", "error": "No image uploaded"}), 400
+
+	if len(encoded_images) > API_MAX_IMAGES:
+		return jsonify({"status": "fail", "error": "At most %d images per request" % API_MAX_IMAGES}), 400
+
+	# Only web processes that actually serve this route pay for importing the inference stack and loading the model
+	from face_detection import decode_image, encode_image, predict_images, get_model, model_context
+
+	images = [decode_image(encoded_image) for encoded_image in encoded_images]
+
+	if any(image is None for image in images):
+		return jsonify({"status": "fail", "error": "Unsupported File Format"}), 400
+
+	with api_lock:
+		model = get_model()
+		with model_context():
+			results, annotated_images = predict_images(images, model, annotate)
+
+	response_object = {
+		"status": "success",
+		"results": [{"faces": faces} for faces in results]
+	}
+
+	if annotate:
+		for result, annotated_image in zip(response_object['results'], annotated_images):
+			result['annotated_image'] = base64.b64encode(encode_image(annotated_image)).decode()
+
+	return jsonify(response_object)
+
+
+@app.route('/live', methods=['GET'])
+def live():
+	'''
+		Live mode page, streams the webcam of the browser (or an RTSP stream or uploaded video) through the live worker
+	'''
+	return render_template('live.html')
+
+
+@app.route('/live/streams', methods=['POST'])
+def start_stream():
+	'''
+		Starts a live stream, processed by live_worker.py
+
+		Parameters (JSON body):
+			source: "browser" (default) if the browser posts the frames to "live/streams/<stream_id>/frames",
+			an RTSP URL, or the filename of an uploaded video which is then played as if it were live
+
+		Returns:
+			response_object (JSON): {"status": "success", "stream_id"}
+	'''
+	source = (request.get_json(silent=True) or {}).get('source') or live_stream.BROWSER_SOURCE
+
+	if source.startswith(('rtsp://', 'rtsps://')):
+		if not allowed_rtsp_source(source):
+			return jsonify({"status": "fail", "error": "RTSP source not allowed"}), 403
+
+	elif source != live_stream.BROWSER_SOURCE:
+		# Only the filename is used so that no file outside of the upload folder can be read
+		source = os.path.join(VIDEOS_INPUT_FOLDER_PATH, os.path.basename(source))
+
+		if not os.path.isfile(source):
+			return jsonify({"status": "fail", "error": "Unknown video"}), 400
+
+	response_object = {
+		"status": "success",
+		"stream_id": live_stream.create_stream(conn, source)
+	}
+
+	return jsonify(response_object), 201
+
+
+@app.route('/live/streams/<stream_id>/frames', methods=['POST'])
+def push_stream_frame(stream_id):
+	'''
+		Takes an encoded (JPEG) webcam frame of a browser stream, it replaces any frame the live worker hasn't processed yet
+	'''
+	if live_stream.stream_source(conn, stream_id) != live_stream.BROWSER_SOURCE:
+		return jsonify({"status": "error"}), 404
+
+	frame_bytes = request.get_data()
+	if len(frame_bytes) > LIVE_MAX_FRAME_BYTES:
+		return jsonify({"status": "fail", "error": "Frame too large"}), 413
+
+	live_stream.push_frame(conn, stream_id, frame_bytes)
+
+	return '', 204
+
+
+@app.route('/live/streams/<stream_id>', methods=['DELETE'])
+def stop_stream(stream_id):
+	live_stream.stop_stream(conn, stream_id)
+	return '', 204
+
+
+@app.route('/live/streams/<stream_id>/mjpeg', methods=['GET'])
+def stream_mjpeg(stream_id):
+	'''
+		Annotated frames of a live stream as an MJPEG stream, can be used as the src of an img tag
+	'''
+	if live_stream.stream_source(conn, stream_id) is None:
+		return jsonify({"status": "error"}), 404
+
+	def frames():
+		last_jpeg_bytes = None
+
+		for jpeg_bytes in stream_messages(stream_id, live_stream.FRAMES_CHANNEL):
+			# MJPEG has no comments, so the last frame is sent again as the heartbeat
+			if jpeg_bytes is None:
+				if last_jpeg_bytes is None:
+					continue
+				jpeg_bytes = last_jpeg_bytes
+
+			last_jpeg_bytes = jpeg_bytes
+			yield b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(jpeg_bytes)).encode() + b'\r\n\r\n' + jpeg_bytes + b'\r\n'
+
+	return stream_response(frames(), 'multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/live/streams/<stream_id>/events', methods=['GET'])
+def stream_events(stream_id):
+	'''
+		Predictions of a live stream as Server-Sent Events, one event per processed frame:
+		{"faces": [{"box", "label", "probabilities"}, ...], "latency_ms", "dropped"}
+	'''
+	if live_stream.stream_source(conn, stream_id) is None:
+		return jsonify({"status": "error"}), 404
+
+	def events():
+		for result in stream_messages(stream_id, live_stream.RESULTS_CHANNEL):
+			if result is None:
+				yield ': heartbeat\n\n'
+			else:
+				yield 'data: %s\n\n' % result.decode()
+
+	return stream_response(events(), 'text/event-stream')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+	'''
+		Prometheus scrape route, exposes the stage latency histograms and counters of all jobs processed by the workers
+	'''
+	return Response(metrics.render_prometheus(conn), mimetype='text/plain; version=0.0.4')
+
+
+def stream_response(generator, mimetype):
+	'''
+		Response of a long lived stream that holds one of the EVENTS_MAX_STREAMS slots until it is closed
+		Returns a 503 if all slots are taken, so that a few slow clients can't starve the other routes of threads
+	'''
+	if not event_stream_slots.acquire(blocking=False):
+		return jsonify({"status": "busy"}), 503, {'Retry-After': '2'}
+
+	# X-Accel-Buffering stops a proxy in front of the app from holding events back
+	response = Response(generator, mimetype=mimetype, headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+	# Called once the server is done with the response, also if the client disconnected before the generator started
+	response.call_on_close(event_stream_slots.release)
+
+	return response
+
+
+def stream_messages(stream_id, channel):
+	'''
+		Generator of the messages the live worker publishes on a channel of a stream, ends once the stream stops or after
+		EVENTS_MAX_DURATION seconds (the page reconnects by itself)
+		Watching keeps the stream alive. If the client reads slower than the worker publishes, older messages are skipped
+		so that the client is never behind by more than a message
+		None is generated when nothing was published for EVENTS_HEARTBEAT seconds. The caller has to write a heartbeat then, which
+		is how a closed tab is noticed, otherwise an abandoned viewer would hold its thread and keep the stream alive forever
+
+		Parameters:
+		stream_id: Id of the live stream
+		channel: live_stream.FRAMES_CHANNEL or live_stream.RESULTS_CHANNEL
+	'''
+	pubsub = conn.pubsub(ignore_subscribe_messages=True)
+	pubsub.subscribe(channel % stream_id)
+	start = time.time()
+	last_touch = 0
+
+	try:
+		while time.time() - start < EVENTS_MAX_DURATION:
+			message = pubsub.get_message(timeout=EVENTS_HEARTBEAT)
+
+			# The heartbeat is written before the stream is kept alive, so a closed connection ends this generator first
+			if message is None:
+				yield None
+
+			if message is None or time.time() - last_touch > live_stream.STREAM_IDLE_TTL / 4:
+				if not live_stream.touch_stream(conn, stream_id):
+					return
+				last_touch = time.time()
+
+			if message is None:
+				continue
+
+			# Skip to the newest message
+			newer_message = pubsub.get_message(timeout=0)
+			while newer_message is not None:
+				message, newer_message = newer_message, pubsub.get_message(timeout=0)
+
+			yield message['data']
+	finally:
+		pubsub.close()
+
+
+def video_duration(video_path):
+	'''
+		Duration of a video in seconds as recorded in its container, read with ffprobe
+		None if ffprobe isn't installed or can't tell, OpenCV isn't used since the web process doesn't import it
+	'''
+	command = [FFPROBE_BINARY, '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', video_path]
+
+	try:
+		output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=FFPROBE_TIMEOUT, check=True).stdout
+		return float(output.strip())
+	except (OSError, subprocess.SubprocessError, ValueError):
+		return None
+
+
+def video_queue(video_filename, duration=None):
+	'''
+		Routes a video to a queue class based on its estimated cost, i.e., its duration and file size
+		Short clips go to the fast queue, anything longer or bigger to the bulk queue so that it never delays image only users
+		A small file can still be a long low bitrate clip, so the size only decides on its own if the duration is unknown (None)
+		The duration was read when the video was uploaded, so no video is probed here
+	'''
+	try:
+		size = os.path.getsize(os.path.join(VIDEOS_INPUT_FOLDER_PATH, video_filename))
+	# E.g., the garbage collector already removed it, the bulk queue's timeout is the safe choice and the job reports the error
+	except OSError:
+		return BULK_QUEUE
+
+	if size > FAST_VIDEO_MAX_BYTES:
+		return BULK_QUEUE
+
+	if duration is not None and duration > FAST_VIDEO_MAX_SECONDS:
+		return BULK_QUEUE
+
+	return FAST_QUEUE
+
+
+def enqueue_batch(image_filenames, video_filenames, video_durations=None):
+	'''
+		Fans an upload out into sub-jobs, one per video and one per IMAGES_PER_JOB images, so that idle workers can pick them up in parallel
+		Images go on the fast queue and videos on the queue picked by video_queue()
+		The sub-job ids are stored in a Redis list under the returned batch id, which expires along with the job results
+
+		Parameters:
+		image_filenames: List of input image filenames
+		video_filenames: List of input video filenames
+		video_durations: {video_filename: duration in seconds} of the videos whose duration is known
+
+		Returns:
+		batch_id (str): Id that the client polls on the "jobs/<job_key>" route
+	'''
+	sub_jobs = [(FAST_QUEUE, (image_filenames[i: i + IMAGES_PER_JOB], [])) for i in range(0, len(image_filenames), IMAGES_PER_JOB)]
+	video_durations = video_durations or {}
+	sub_jobs += [(video_queue(video_filename, video_durations.get(video_filename)), ([], [video_filename])) for video_filename in video_filenames]
+
+	batch_id = str(uuid.uuid4().hex)
+	batch_key = BATCH_KEY_PREFIX + batch_id
+
+	job_ids = []
+	for queue_name, args in sub_jobs:
+		# The result_ttl line argument tells RQ how long to hold on to the result of the job for
+		# and timeout how long the job may run before it is killed, both depend on the queue class
+		# Videos always get the timeout of the bulk queue though, their routing is only an estimate of their cost
+		# The batch id in the meta tells the job which channel to publish its progress on
+		job_timeout = QUEUES[BULK_QUEUE if args[1] else queue_name]['job_timeout']
+		job = queues[queue_name].enqueue_call(
+			func='app.create_output', 
+			args=args,
+			result_ttl=QUEUES[queue_name]['result_ttl'],
+			timeout=job_timeout,
+			meta={'batch_id': batch_id})
+		job_ids.append(job.get_id())
+
+	pipeline = conn.pipeline()
+	pipeline.rpush(batch_key, *job_ids)
+	pipeline.expire(batch_key, JOB_RESULT_TTL)
+	pipeline.execute()
+
+	return batch_id
+
+
+def fetch_batch_jobs(batch_id):
+	'''
+		Returns (batch_jobs, statuses) of the sub-jobs of a batch, None if there is no batch with this id
+		Sub-jobs that don't exist anymore are None with a "failed" status
+	'''
+	batch_job_ids = [job_id.decode() for job_id in conn.lrange(BATCH_KEY_PREFIX + batch_id, 0, -1)]
+
+	if not batch_job_ids:
+		return None
+
+	batch_jobs = Job.fetch_many(batch_job_ids, connection=conn)
+	# fetch_many() already read the status of every sub-job, so it isn't read from Redis again
+	statuses = [job.get_status(refresh=False) if job else 'failed' for job in batch_jobs]
+
+	return batch_jobs, statuses
+
+
+def fetch_batch_status(batch_id):
+	'''
+		Returns the get_batch_status() of a batch, None if there is no batch with this id
+	'''
+	batch = fetch_batch_jobs(batch_id)
+
+	if batch is None:
+		return None
+
+	return get_batch_status(batch_id, *batch)
+
+
+def get_batch_progress(batch_jobs, statuses, progress_updates=None):
+	'''
+		Combines the progress that the sub-jobs of a batch saved in their meta, or published more recently (progress_updates)
+		Files of finished sub-jobs and the files that running sub-jobs already reported as done are ready to be shown
+		The ETA of the batch is that of its slowest running sub-job, queued sub-jobs aren't accounted for
+	'''
+	ready_images, ready_videos = [], []
+	files_total, frames_done, frames_total, eta = 0, 0, 0, None
+
+	for job, status in zip(batch_jobs, statuses):
+		if job is None:
+			continue
+
+		image_filenames, video_filenames = job.args
+		files_total += len(image_filenames) + len(video_filenames)
+
+		if status == 'finished':
+			ready_images.extend(image_filenames)
+			ready_videos.extend(video_filenames)
+			continue
+
+		progress = (progress_updates or {}).get(job.get_id()) or job.meta.get('progress')
+		if not progress:
+			continue
+
+		for file_done in progress['files_done']:
+			(ready_images if file_done['kind'] == 'image' else ready_videos).append(file_done['filename'])
+
+		frames_done += progress['frames_done']
+		frames_total += progress['frames_total']
+
+		if progress['eta_seconds'] is not None:
+			eta = max(eta or 0, progress['eta_seconds'])
+
+	return {
+		"files_done": len(ready_images) + len(ready_videos),
+		"files_total": files_total,
+		"frames_done": frames_done,
+		"frames_total": frames_total,
+		"eta_seconds": eta,
+		"ready_images": ready_images,
+		"ready_videos": ready_videos
+	}
+
+
+def get_batch_status(batch_id, batch_jobs, statuses, progress_updates=None):
+	'''
+		Combines the status of all sub-jobs of a batch into a single status in the same format as that of a single job
+		The batch is "failed" if any sub-job failed (or expired), "finished" once every sub-job finished,
+		"started" while any sub-job is being processed and "queued" otherwise
+		The result of a finished batch merges the filenames of all the sub-job results
+
+		Parameters:
+		batch_id: Id of the batch
+		batch_jobs, statuses: Sub-jobs of the batch and their statuses, as returned by fetch_batch_jobs()
+		progress_updates: Progress published by sub-jobs since their statuses were read, {job_id: progress}
+	'''
+	# A queued sub-job that published progress has been started since
+	progress_updates = progress_updates or {}
+	statuses = ['started' if status == 'queued' and job.get_id() in progress_updates else status
+				for job, status in zip(batch_jobs, statuses)]
+
+	if 'failed' in statuses:
+		batch_status = 'failed'
+	elif all(status == 'finished' for status in statuses):
+		batch_status = 'finished'
+	elif 'started' in statuses or 'finished' in statuses:
+		batch_status = 'started'
+	else:
+		batch_status = 'queued'
+
+	batch_result = None
+	if batch_status == 'finished':
+		batch_result = {
+			"status": "success",
+			"image_filenames": [filename for job in batch_jobs for filename in job.result['image_filenames']],
+			"video_filenames": [filename for job in batch_jobs for filename in job.result['video_filenames']]
+		}
+
+	return {
+		"job_id": batch_id,
+		"job_status": batch_status,
+		"job_result": batch_result,
+		"jobs_finished": statuses.count('finished'),
+		"jobs_total": len(statuses),
+		"progress": get_batch_progress(batch_jobs, statuses, progress_updates)
+	}
 
 
 def create_output(image_filenames, video_filenames):
 	'''
 		Wrapper function that executes both image and video output prediction functions
-		This is done so that both tasks can be wrapped into the same Redis Job which helps avoid timing issues
-		and besides it is only the Video input that will actually cause delay in web-app functioning, so it doesn't make much sense
-		to create a second job only for processing Image input
+		This is the function run by every sub-job of a batch (see enqueue_batch), so usually only one of the two lists is non-empty
 
 		Parameters:
 		image_filenames: List of input image filenames, same filenames are used for output images
 		video_filenames: Same but for input videos
 	'''
 
+	# The inference stack (TensorFlow, dlib, OpenCV) is only imported here, i.e., inside the RQ workers
+	# so that the web process, which only handles uploads, enqueues jobs and serves files, starts fast and stays small
+	from face_detection import create_image_output, create_video_output
+
+	# Record the time spent in every stage of this job, they end up in the job's meta and on the /metrics route
+	recorder = metrics.start_job()
+	# Publish the progress of this job to the client while it runs
+	job_progress.start_job(get_current_job(), conn, len(image_filenames) + len(video_filenames))
+
 	# Process the input images and/or videos and save them to the respective output folders
-	create_image_output(IMAGES_INPUT_FOLDER_PATH, IMAGES_OUTPUT_FOLDER_PATH, image_filenames)
-	create_video_output(VIDEOS_INPUT_FOLDER_PATH, VIDEOS_OUTPUT_FOLDER_PATH, video_filenames)
+	# Metrics are recorded whatever the outcome, so that failed and timed out jobs show up on /metrics as well
+	outcome = 'failed'
+	try:
+		create_image_output(IMAGES_INPUT_FOLDER_PATH, IMAGES_OUTPUT_FOLDER_PATH, image_filenames)
+		create_video_output(VIDEOS_INPUT_FOLDER_PATH, VIDEOS_OUTPUT_FOLDER_PATH, video_filenames)
+		outcome = 'success'
+	except JobTimeoutException:
+		outcome = 'timeout'
+		raise
+	finally:
+		job_progress.finish_job()
+		metrics.finish_job(recorder, get_current_job(), conn, outcome)
 
 	# Job result JSON
 	# This will be sent to the client once the Redis job finishes
@@ -0,0 +1,351 @@
+# Stage level benchmark of the face_detection pipeline.
+# Generates synthetic frames and videos with a controlled resolution, length and number of faces (tiled from a bundled image),
+# times every stage of the pipeline separately and writes the results to a JSON file that can be compared between commits.
+# Runs offline and on the CPU only, e.g.,
+#   python benchmark.py --resolutions 640x480,1920x1080 --faces 1,8 --output bench_results.json
+#   python benchmark.py --compare bench_results.json
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# Benchmarks must be comparable between machines with and without a GPU
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+import cv2
+import numpy as np
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+# face_detection uses paths relative to the app root
+os.chdir(APP_ROOT)
+
+import face_detection
+import models
+import video_encoding
+
+# Image the synthetic faces are cropped from
+FACE_SOURCE_IMAGE = 'static/uploads/images/input_images/angry_2.jpg'
+DEFAULT_OUTPUT = 'bench_results.json'
+# Output encoders compared by default, "opencv" or "ffmpeg-<codec>"
+DEFAULT_ENCODERS = 'opencv,ffmpeg-vp8,ffmpeg-vp9,ffmpeg-h264'
+
+
+def parse_resolutions(value):
+    return [tuple(int(side) for side in resolution.split('x')) for resolution in value.split(',')]
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(',')]
+
+
+def load_face():
+    '''
+        Crops the first face detected by the HOG detector out of FACE_SOURCE_IMAGE (or its center if none is found)
+    '''
+    image = cv2.imread(FACE_SOURCE_IMAGE)
+    face_locations = face_detection.create_hog_detector()(image)
+
+    if face_locations:
+        top, right, bottom, left = face_locations[0]
+    else:
+        height, width = image.shape[:2]
+        top, right, bottom, left = height // 4, 3 * width // 4, 3 * height // 4, width // 4
+
+    return image[top: bottom, left: right]
+
+
+def make_frame(width, height, face_count, face, frame_index=0):
+    '''
+        Returns (frame, face_boxes) where frame is a width x height image with face_count copies of face tiled on a grid
+        frame_index slightly shifts the faces so that consecutive video frames aren't identical
+    '''
+    frame = np.full((height, width, 3), 90, dtype=np.uint8)
+    face_boxes = []
+
+    if face_count == 0:
+        return frame, face_boxes
+
+    columns = int(np.ceil(np.sqrt(face_count)))
+    rows = int(np.ceil(face_count / float(columns)))
+    cell_width, cell_height = width // columns, height // rows
+    size = int(min(cell_width, cell_height) * 0.7)
+    resized_face = cv2.resize(face, (size, size))
+    shift = (frame_index % 10) - 5
+
+    for index in range(face_count):
+        row, column = divmod(index, columns)
+        left = column * cell_width + (cell_width - size) // 2 + shift
+        top = row * cell_height + (cell_height - size) // 2
+        left = min(max(left, 0), width - size)
+
+        frame[top: top + size, left: left + size] = resized_face
+        face_boxes.append((top, left + size, top + size, left))
+
+    return frame, face_boxes
+
+
+def summarize(latencies, items=None):
+    '''
+        Summary of a list of latencies in seconds, throughput is in items (default one per latency) per second
+    '''
+    latencies = np.array(latencies)
+    total = float(latencies.sum())
+    items = len(latencies) if items is None else items
+
+    return {
+        "count": len(latencies),
+        "total_s": total,
+        "mean_ms": float(latencies.mean() * 1000),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p90_ms": float(np.percentile(latencies, 90) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "throughput_per_s": items / total if total > 0 else None
+    }
+
+
+def time_calls(function, arguments):
+    '''
+        Calls function once per item of arguments and returns the list of latencies
+    '''
+    latencies = []
+
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def benchmark_load_model(repeat):
+    '''
+        Cold model construction and weight loading, falls back to untrained weights if the model file isn't present
+        since the timing of everything else doesn't depend on the weight values
+    '''
+    has_weights = os.path.exists(face_detection.MODEL_PATH)
+    load = face_detection.load_model if has_weights else models.cnn_model_2
+
+    latencies = time_calls(lambda _: load(), range(repeat))
+    model = load()
+    model.predict(np.zeros((1, 48, 48, 1), dtype=np.uint8))
+
+    result = summarize(latencies)
+    result["weights"] = has_weights
+
+    return model, result
+
+
+def benchmark_frames(model, face, width, height, face_count, frame_count, detectors, detection_max_sizes):
+    '''
+        Times detection (for every detector and detection size), prediction, annotation and encoding on frame_count synthetic frames
+    '''
+    frames = [make_frame(width, height, face_count, face, index) for index in range(frame_count)]
+    results = {}
+    default_detector, default_detection_max_size = face_detection.FACE_DETECTOR, face_detection.DETECTION_MAX_SIZE
+
+    for detector in detectors:
+        for detection_max_size in detection_max_sizes:
+            face_detection.FACE_DETECTOR = detector
+            face_detection.DETECTION_MAX_SIZE = detection_max_size
+            face_detection._face_detector = None
+
+            # First call builds the detector, it isn't part of the steady state latency
+            face_detection.detect_faces(frames[0][0])
+
+            detected_faces = []
+            latencies = time_calls(lambda frame: detected_faces.append(len(face_detection.detect_faces(frame[0]))), frames)
+
+            result = summarize(latencies)
+            result["recall"] = float(np.mean([min(detected, face_count) for detected in detected_faces]) / face_count) if face_count else None
+            results["detect_%s_%d" % (detector, detection_max_size)] = result
+
+        face_detection._face_detector = None
+        face_detection.detect_faces(frames[0][0], video=True)
+
+        detected_faces = []
+        latencies = time_calls(lambda frame: detected_faces.append(len(face_detection.detect_faces(frame[0], video=True))), frames)
+
+        # Video frames were always detected at 1/4 of their size before the size cap, their detection area must never be larger
+        scale = face_detection.detection_scale(frames[0][0], video=True)
+        result = summarize(latencies)
+        result["recall"] = float(np.mean([min(detected, face_count) for detected in detected_faces]) / face_count) if face_count else None
+        result["detection_area_ratio"] = (scale / 0.25) ** 2
+        results["detect_video_%s_%d" % (detector, face_detection.VIDEO_DETECTION_MAX_SIZE)] = result
+
+    # The end to end benchmark runs with the configured detector
+    face_detection.FACE_DETECTOR, face_detection.DETECTION_MAX_SIZE = default_detector, default_detection_max_size
+    face_detection._face_detector = None
+
+    # Pre-processing, prediction and annotation use the known face boxes so they always see exactly face_count faces
+    results["preprocess"] = summarize(time_calls(lambda frame: face_detection.preprocess_frame_faces([frame]), frames), frame_count * face_count)
+    results["predict"] = summarize(time_calls(lambda frame: face_detection.batch_prediction(face_detection.preprocess_frame_faces([frame]), model), frames),
+                                   frame_count * face_count)
+
+    labels = [face_detection.CLASS_LABELS[index % len(face_detection.CLASS_LABELS)] for index in range(face_count)]
+    results["annotate"] = summarize(time_calls(lambda frame: face_detection.annotate_frame(frame[0].copy(), frame[1], labels), frames))
+
+    return results
+
+
+def benchmark_encoders(face, width, height, face_count, frame_count, encoders):
+    '''
+        Encode throughput and output size of every encoder on the same annotated frames
+        The time includes release(), since the ffmpeg encoder keeps working on the frames that were piped into it
+    '''
+    frames = []
+    labels = [face_detection.CLASS_LABELS[index % len(face_detection.CLASS_LABELS)] for index in range(face_count)]
+
+    for index in range(frame_count):
+        frame, face_boxes = make_frame(width, height, face_count, face, index)
+        face_detection.annotate_frame(frame, face_boxes, labels)
+        frames.append(frame)
+
+    results = {}
+
+    for encoder in encoders:
+        backend, _, codec = encoder.partition('-')
+
+        if backend == 'ffmpeg' and not video_encoding.ffmpeg_available():
+            print("Skipping", encoder, "since ffmpeg isn't installed")
+            continue
+
+        settings = {"codec": codec} if codec else {}
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_file = os.path.join(temp_dir, 'output.mp4' if codec == 'h264' else 'output.webm')
+
+            start = time.perf_counter()
+            output_video = video_encoding.create_video_writer(output_file, 10.0, (width, height), backend, **settings)
+            for frame in frames:
+                output_video.write(frame)
+            output_video.release()
+            total = time.perf_counter() - start
+
+            results["encode_" + encoder] = {"count": frame_count, "total_s": total, "throughput_per_s": frame_count / total,
+                                            "size_bytes": os.path.getsize(output_file)}
+
+    return results
+
+
+def benchmark_video(model, face, width, height, face_count, frame_count):
+    '''
+        End to end time of process_video() on a synthetic video, reported per input frame
+    '''
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_file = os.path.join(temp_dir, 'input.avi')
+        output_file = os.path.join(temp_dir, 'output.webm')
+
+        input_video = cv2.VideoWriter(input_file, cv2.VideoWriter_fourcc(*'MJPG'), 30.0, (width, height))
+        for index in range(frame_count):
+            input_video.write(make_frame(width, height, face_count, face, index)[0])
+        input_video.release()
+
+        start = time.perf_counter()
+        face_detection.process_video(input_file, output_file, model)
+        total = time.perf_counter() - start
+
+    return {"count": frame_count, "total_s": total, "throughput_per_s": frame_count / total}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=APP_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    '''
+        Prints one line per benchmark and stage, with the change in mean latency (or throughput) against the baseline if given
+    '''
+    for name, stages in results["benchmarks"].items():
+        print(name)
+
+        for stage, result in stages.items():
+            line = "    %-24s" % stage
+
+            if "mean_ms" in result:
+                line += "mean %9.2f ms   p50 %9.2f ms   p99 %9.2f ms" % (result["mean_ms"], result["p50_ms"], result["p99_ms"])
+            if result.get("throughput_per_s"):
+                line += "   %9.1f /s" % result["throughput_per_s"]
+            if "size_bytes" in result:
+                line += "   %9.1f KB" % (result["size_bytes"] / 1024.0)
+            if "detection_area_ratio" in result:
+                line += "   %5.2fx area of 1/4 scale" % result["detection_area_ratio"]
+
+            baseline_result = (baseline or {}).get("benchmarks", {}).get(name, {}).get(stage)
+            if baseline_result and baseline_result.get("throughput_per_s") and result.get("throughput_per_s"):
+                line += "   (%+.1f%% throughput)" % (100.0 * (result["throughput_per_s"] / baseline_result["throughput_per_s"] - 1))
+
+            print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stage level benchmark of the face_detection pipeline')
+    parser.add_argument('--resolutions', type=parse_resolutions, default=parse_resolutions('640x480,1280x720,1920x1080'),
+                        help='Comma separated WIDTHxHEIGHT frame sizes')
+    parser.add_argument('--faces', type=parse_ints, default=[1, 4, 16], help='Comma separated number of faces per frame')
+    parser.add_argument('--frames', type=int, default=30, help='Number of frames per benchmark')
+    parser.add_argument('--detectors', default=face_detection.FACE_DETECTOR, help='Comma separated face detector backends')
+    parser.add_argument('--detection-max-sizes', type=parse_ints, default=[face_detection.DETECTION_MAX_SIZE],
+                        help='Comma separated DETECTION_MAX_SIZE values')
+    parser.add_argument('--load-repeat', type=int, default=3, help='Number of times the model is loaded')
+    parser.add_argument('--encoders', default=DEFAULT_ENCODERS, help='Comma separated output encoders, "opencv" or "ffmpeg-<codec>"')
+    parser.add_argument('--skip-video', action='store_true', help='Skip the end to end process_video() benchmark')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='JSON file the results are written to')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    # Read before the run, --compare and --output may well be the same file (both default to bench_results.json in the README)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    # Results of the benchmark are never cached
+    face_detection.result_cache.RESULT_CACHE_ENABLED = False
+
+    face = load_face()
+    model, load_result = benchmark_load_model(args.load_repeat)
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "platform": {"python": sys.version.split()[0], "machine": platform.machine(), "processor": platform.processor(), "cpus": os.cpu_count()},
+        "settings": {
+            "frames": args.frames,
+            "video_frame_read_rate": face_detection.VIDEO_FRAME_READ_RATE,
+            "video_sampling_mode": face_detection.VIDEO_SAMPLING_MODE,
+            "face_tracking": face_detection.FACE_TRACKING
+        },
+        "benchmarks": {"load_model": {"load_model": load_result}}
+    }
+
+    for width, height in args.resolutions:
+        for face_count in args.faces:
+            name = "%dx%d_%dfaces" % (width, height, face_count)
+            print("Running", name)
+
+            stages = benchmark_frames(model, face, width, height, face_count, args.frames, args.detectors.split(','), args.detection_max_sizes)
+            stages.update(benchmark_encoders(face, width, height, face_count, args.frames, args.encoders.split(',')))
+            if not args.skip_video:
+                stages["process_video"] = benchmark_video(model, face, width, height, face_count, args.frames)
+
+            results["benchmarks"][name] = stages
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print_results(results, baseline)
+    print("Results written to", args.output)
+    if args.compare and os.path.abspath(args.compare) == os.path.abspath(args.output):
+        print("The baseline", args.compare, "was replaced by these results")
+
+
+if __name__ == '__main__':
+    main()
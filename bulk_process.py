@@ -0,0 +1,262 @@
+# Offline bulk processing of whole directories, without the upload limits of the web app.
+# Walks an input tree and shards its images and videos across a pool of processes, each with its own warm model, running
+# the same create_image_output() / create_video_output() as the RQ workers. Outputs mirror the input tree under the output
+# directory and every processed file gets a record in a JSON lines (or CSV) manifest, written as soon as it is done.
+# Rerunning the same command after a crash skips every file that the manifest already records as done.
+#   python bulk_process.py datasets/faces output/faces
+#   python bulk_process.py datasets/clips output/clips --manifest output/clips.csv --processes 4
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Same file types as the ones accepted by app.py
+IMAGE_EXTENSIONS = {'bmp', 'jpg', 'png', 'jpeg', 'jpe'}
+VIDEO_EXTENSIONS = {'mp4', 'avi', 'wmv', 'flv', 'mpeg'}
+# Images are processed IMAGES_PER_TASK at a time so that their faces are classified in one batch, videos one per task
+IMAGES_PER_TASK = 16
+# How often progress is printed, in seconds
+REPORT_INTERVAL = 10
+
+MANIFEST_FIELDS = ('path', 'kind', 'status', 'output', 'predictions', 'seconds', 'error')
+
+
+def file_kind(filename):
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+
+    if extension in IMAGE_EXTENSIONS:
+        return 'image'
+    if extension in VIDEO_EXTENSIONS:
+        return 'video'
+    return None
+
+
+def find_files(input_dir, exclude_dir=None):
+    '''
+        Returns the (relative_path, kind) of every image and video under input_dir, in a stable order
+        exclude_dir is skipped, so that outputs written inside the input tree aren't picked up as inputs
+    '''
+    files = []
+
+    for dir_path, dir_names, filenames in os.walk(input_dir):
+        dir_names[:] = sorted(name for name in dir_names if os.path.join(dir_path, name) != exclude_dir)
+
+        for filename in sorted(filenames):
+            kind = file_kind(filename)
+            if kind is not None:
+                files.append((os.path.relpath(os.path.join(dir_path, filename), input_dir), kind))
+
+    return files
+
+
+def read_manifest(manifest_path):
+    '''
+        Returns the set of relative paths the manifest records as successfully processed
+        A line cut off by a crash is ignored, its file is simply processed again
+    '''
+    done = set()
+
+    if not os.path.exists(manifest_path):
+        return done
+
+    with open(manifest_path, newline='') as f:
+        if manifest_path.endswith('.csv'):
+            records = csv.DictReader(f)
+        else:
+            records = []
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+
+        for record in records:
+            if record.get('status') == 'ok':
+                done.add(record['path'])
+
+    return done
+
+
+class ManifestWriter:
+    '''
+        Appends records to a JSON lines or CSV manifest (by extension), flushed after every record so that a crash loses nothing
+    '''
+
+    def __init__(self, manifest_path):
+        self.is_csv = manifest_path.endswith('.csv')
+        write_header = self.is_csv and (not os.path.exists(manifest_path) or os.path.getsize(manifest_path) == 0)
+
+        self.file = open(manifest_path, 'a', newline='')
+
+        if self.is_csv:
+            self.writer = csv.DictWriter(self.file, MANIFEST_FIELDS)
+            if write_header:
+                self.writer.writeheader()
+
+    def write(self, record):
+        if self.is_csv:
+            self.writer.writerow(dict(record, predictions=json.dumps(record['predictions'])))
+        else:
+            self.file.write(json.dumps(record) + '\n')
+
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def make_tasks(files, images_per_task=IMAGES_PER_TASK):
+    '''
+        Groups the files into tasks of (kind, directory, filenames): images of the same directory IMAGES_PER_TASK at a time,
+        every video on its own
+    '''
+    tasks = []
+    images_by_dir = {}
+
+    for relative_path, kind in files:
+        directory, filename = os.path.split(relative_path)
+
+        if kind == 'video':
+            tasks.append(('video', directory, [filename]))
+        else:
+            images_by_dir.setdefault(directory, []).append(filename)
+
+    for directory, filenames in images_by_dir.items():
+        for start in range(0, len(filenames), images_per_task):
+            tasks.append(('image', directory, filenames[start: start + images_per_task]))
+
+    return tasks
+
+
+def init_process(use_cache):
+    '''
+        Runs once in every pool process, loads and warms the model that all tasks of the process reuse
+    '''
+    import face_detection
+
+    face_detection.result_cache.RESULT_CACHE_ENABLED = use_cache
+    # Pool processes can't have a pool of their own, the bulk pool already keeps every core busy
+    if face_detection.VIDEO_PROCESSING_MODE == 'segmented':
+        face_detection.VIDEO_PROCESSING_MODE = 'sequential'
+
+    face_detection.warm_model()
+
+
+def run_task(task, input_dir, output_dir):
+    '''
+        Processes a task in a pool process and returns (records, counters), the manifest records of its files and the
+        metrics counters (frames, faces, ...) of the task
+        If a group of images fails, its images are retried one by one so that one broken file doesn't fail the others
+    '''
+    import face_detection
+    import metrics
+    import upload_manifest
+
+    kind, directory, filenames = task
+    input_dir_path = os.path.join(input_dir, directory)
+    output_dir_path = os.path.join(output_dir, directory)
+    os.makedirs(output_dir_path, exist_ok=True)
+
+    create_output = face_detection.create_image_output if kind == 'image' else face_detection.create_video_output
+
+    def output_name(filename):
+        return filename if kind == 'image' else upload_manifest.output_video_filename(filename)
+
+    start = time.time()
+    recorder = metrics.start_job()
+
+    try:
+        predictions = create_output(input_dir_path, output_dir_path, filenames)
+    except Exception:
+        if len(filenames) > 1:
+            records, counters = [], {}
+
+            for filename in filenames:
+                file_records, file_counters = run_task((kind, directory, [filename]), input_dir, output_dir)
+                records.extend(file_records)
+                for counter, value in file_counters.items():
+                    counters[counter] = counters.get(counter, 0) + value
+
+            return records, counters
+
+        return [{"path": os.path.join(directory, filenames[0]), "kind": kind, "status": "error", "output": None, "predictions": None,
+                 "seconds": round(time.time() - start, 3), "error": traceback.format_exc(limit=3)}], {}
+
+    seconds = (time.time() - start) / len(filenames)
+    records = [{"path": os.path.join(directory, filename), "kind": kind, "status": "ok",
+                "output": os.path.join(directory, output_name(filename)), "predictions": predictions.get(filename),
+                "seconds": round(seconds, 3), "error": None} for filename in filenames]
+
+    return records, recorder.to_dict()["counters"]
+
+
+def _run_task(arguments):
+    return run_task(*arguments)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Label every image and video of a directory tree')
+    parser.add_argument('input_dir', help='Directory that is searched recursively for images and videos')
+    parser.add_argument('output_dir', help='Directory the annotated outputs are written to, mirroring the input tree')
+    parser.add_argument('--manifest', help='JSON lines (.jsonl) or CSV (.csv) manifest, output_dir/manifest.jsonl by default')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='Number of processes, each loads its own model')
+    parser.add_argument('--use-cache', action='store_true', help='Use the result cache of the web app (off by default to keep it for uploads)')
+    args = parser.parse_args(argv)
+
+    input_dir, output_dir = os.path.abspath(args.input_dir), os.path.abspath(args.output_dir)
+    manifest_path = os.path.abspath(args.manifest or os.path.join(output_dir, 'manifest.jsonl'))
+    os.makedirs(output_dir, exist_ok=True)
+
+    files = find_files(input_dir, exclude_dir=output_dir)
+    done = read_manifest(manifest_path)
+    pending = [(relative_path, kind) for relative_path, kind in files if relative_path not in done]
+
+    print('%d files found, %d already done, %d to process' % (len(files), len(files) - len(pending), len(pending)))
+    if not pending:
+        return
+
+    tasks = make_tasks(pending)
+    # Videos first, they take longest and would otherwise be the stragglers at the end of the run
+    tasks.sort(key=lambda task: task[0] != 'video')
+
+    # face_detection (and with it the inference stack) is only imported by the pool processes, which load the model
+    # relative to the app root
+    os.chdir(APP_ROOT)
+
+    manifest = ManifestWriter(manifest_path)
+    processed, failed, frames, faces = 0, 0, 0, 0
+    start = last_report = time.time()
+
+    with multiprocessing.get_context('spawn').Pool(args.processes, initializer=init_process, initargs=(args.use_cache,)) as pool:
+        for records, counters in pool.imap_unordered(_run_task, [(task, input_dir, output_dir) for task in tasks]):
+            for record in records:
+                manifest.write(record)
+                processed += 1
+                failed += record['status'] != 'ok'
+
+            frames += counters.get('frames', 0)
+            faces += counters.get('faces', 0)
+
+            if time.time() - last_report >= REPORT_INTERVAL or processed == len(pending):
+                last_report = time.time()
+                elapsed = last_report - start
+                eta = elapsed / processed * (len(pending) - processed)
+                print('%d/%d files (%d failed), %.2f files/s, %.1f frames/s, %.1f faces/s, ETA %.0f s' % (
+                    processed, len(pending), failed, processed / elapsed, frames / elapsed, faces / elapsed, eta))
+
+    manifest.close()
+    print('Manifest written to', manifest_path)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
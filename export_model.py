@@ -0,0 +1,178 @@
+# Exports the trained Keras model (static/model_195.h5) into an optimized TFLite artifact for the tflite inference backend.
+# The graph is frozen in inference mode, so Dropout is removed and BatchNormalization is folded into the convolutions,
+# and the weights (and optionally activations) are quantized. An accuracy parity check against the Keras model is run afterwards
+# on a fixed, labelled hold-out set of faces, and the quantization is recorded next to the artifact (see face_detection.MODEL_VERSION).
+#   python export_model.py --quantization float16
+#   python export_model.py --quantization int8 --output static/model_195_int8.tflite
+# Then run the workers with INFERENCE_BACKEND=tflite (and TFLITE_MODEL_PATH if the output path was changed)
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+# face_detection uses paths relative to the app root
+os.chdir(APP_ROOT)
+
+import face_detection
+import models
+from tflite_model import TFLiteModel
+
+QUANTIZATIONS = ('none', 'dynamic', 'float16', 'int8')
+# Video bundled with the repository whose faces are used for int8 calibration, faces are taken from every
+# CALIBRATION_FRAME_INTERVAL-th frame. Never user uploads, so that the export doesn't depend on whatever was uploaded
+CALIBRATION_VIDEO = 'static/uploads/videos/input_videos/test_video.mp4'
+CALIBRATION_FRAME_INTERVAL = 15
+# Hold-out set of the parity check, 48x48 grayscale faces in a folder per class label, e.g., static/parity_faces/Happy/face.png
+# It is never used for calibration, so that the check isn't biased towards the faces the quantization was tuned on
+PARITY_FACES_GLOB = 'static/parity_faces/*/*.png'
+# Minimum fraction of faces on which both backends have to predict the same class for the parity check to pass
+DEFAULT_MIN_AGREEMENT = 0.98
+
+
+def load_inference_model():
+    '''
+        Builds cnn_model_2 in inference mode (learning phase 0) and loads the trained weights
+    '''
+    tf.keras.backend.set_learning_phase(0)
+    model = models.cnn_model_2()
+    model.load_weights(face_detection.MODEL_PATH)
+    return model
+
+
+def calibration_faces(count):
+    '''
+        Returns a (count, 48, 48, 1) batch of preprocessed faces cropped from the frames of CALIBRATION_VIDEO
+        Augmented with flips and brightness changes since there are only a few distinct faces,
+        and padded with random noise if no face could be found at all
+    '''
+    crops = []
+    video_capture = cv2.VideoCapture(CALIBRATION_VIDEO)
+    frame_index = 0
+
+    while True:
+        ret, frame = video_capture.read()
+        if not ret:
+            break
+
+        if frame_index % CALIBRATION_FRAME_INTERVAL == 0:
+            crops.extend(face_detection.crop_faces(frame, face_detection.detect_faces(frame)))
+        frame_index += 1
+
+    video_capture.release()
+
+    if not crops:
+        return np.random.randint(0, 256, (count, 48, 48, 1)).astype(np.float32)
+
+    faces = face_detection.preprocess_faces(crops).astype(np.float32)
+    samples = []
+
+    for index in range(count):
+        face = faces[index % len(faces)]
+        if (index // len(faces)) % 2:
+            face = face[:, ::-1]
+        samples.append(np.clip(face * np.random.uniform(0.7, 1.3), 0, 255))
+
+    return np.array(samples, dtype=np.float32)
+
+
+def parity_faces():
+    '''
+        Returns (faces, labels) of the hold-out set, a (N, 48, 48, 1) batch and the class index of every face
+    '''
+    class_indices = {label: index for index, label in face_detection.CLASS_LABELS.items()}
+    faces, labels = [], []
+
+    for filename in sorted(glob.glob(PARITY_FACES_GLOB)):
+        label = os.path.basename(os.path.dirname(filename))
+        face = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+
+        if label not in class_indices or face is None:
+            print('Skipping', filename, 'since it isn\'t a face image in a folder named after a class label')
+            continue
+
+        faces.append(cv2.resize(face, (48, 48))[:, :, np.newaxis])
+        labels.append(class_indices[label])
+
+    return np.array(faces, dtype=np.float32).reshape(-1, 48, 48, 1), np.array(labels)
+
+
+def export(model, output_path, quantization, calibration_faces):
+    '''
+        Converts the Keras model in the current session into a .tflite file with the given quantization
+    '''
+    session = tf.keras.backend.get_session()
+    converter = tf.lite.TFLiteConverter.from_session(session, [model.input], [model.output])
+
+    if quantization != 'none':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+
+    elif quantization == 'int8':
+        # Activations are quantized too, their ranges are calibrated on real faces
+        def representative_dataset():
+            for face in calibration_faces:
+                yield [face[np.newaxis]]
+
+        converter.representative_dataset = representative_dataset
+
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+
+    # Read by face_detection, so that results of differently quantized models never share result cache entries
+    with open(output_path + face_detection.TFLITE_METADATA_SUFFIX, 'w') as f:
+        json.dump({"quantization": quantization, "source": os.path.basename(face_detection.MODEL_PATH)}, f)
+
+
+def check_parity(model, output_path, faces, labels, min_agreement):
+    '''
+        Compares the predictions of the exported model against the Keras model on the labelled hold-out faces
+        Returns True if both predict the same class on at least min_agreement of them
+    '''
+    keras_probabilities = model.predict(faces)
+    tflite_probabilities = TFLiteModel(output_path).predict(faces)
+
+    agreement = np.mean(keras_probabilities.argmax(axis=-1) == tflite_probabilities.argmax(axis=-1))
+    max_difference = np.abs(keras_probabilities - tflite_probabilities).max()
+
+    print('Class agreement with Keras: %.2f%% on %d faces, max probability difference %.4f' % (agreement * 100, len(faces), max_difference))
+    print('Accuracy on the hold-out set: Keras %.2f%%, TFLite %.2f%%' % (np.mean(keras_probabilities.argmax(axis=-1) == labels) * 100,
+                                                                       np.mean(tflite_probabilities.argmax(axis=-1) == labels) * 100))
+
+    return agreement >= min_agreement
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the emotion model to an optimized TFLite artifact')
+    parser.add_argument('--quantization', choices=QUANTIZATIONS, default='float16',
+                        help='none, dynamic (int8 weights), float16 (float16 weights) or int8 (int8 weights and activations)')
+    parser.add_argument('--output', default=face_detection.TFLITE_MODEL_PATH, help='Path of the .tflite file')
+    parser.add_argument('--samples', type=int, default=200, help='Number of faces used for int8 calibration')
+    parser.add_argument('--min-agreement', type=float, default=DEFAULT_MIN_AGREEMENT,
+                        help='Fail if the exported model agrees with Keras on less than this fraction of faces')
+    args = parser.parse_args(argv)
+
+    faces, labels = parity_faces()
+    if len(faces) == 0:
+        sys.exit('No hold-out faces found in ' + PARITY_FACES_GLOB)
+
+    model = load_inference_model()
+
+    export(model, args.output, args.quantization, calibration_faces(args.samples))
+    print('Exported', args.output, '(%d KB)' % (os.path.getsize(args.output) // 1024))
+
+    if not check_parity(model, args.output, faces, labels, args.min_agreement):
+        print('Parity check failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,32 +2,339 @@ import cv2
 import face_recognition
 import time
 import os
-import models
+import json
+import queue
+import threading
+import math
+import shutil
+import subprocess
+import tempfile
+import multiprocessing
+import atexit
+import face_tracking
+import result_cache
+import job_progress
+import upload_manifest
+import video_encoding
+import metrics
 import numpy as np
+from contextlib import contextmanager
 
 # Global variables
 MODEL_PATH = 'static/model_195.h5'
+# Backend that runs the emotion model, "keras" (the full TensorFlow graph), "tflite" (optimized export, see export_model.py)
+# or "remote" (the shared inference server of all workers on this machine, see inference_server.py)
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'keras')
+TFLITE_MODEL_PATH = os.getenv('TFLITE_MODEL_PATH', 'static/model_195.tflite')
 # Read webcam feed for a frame every half a second
 WEBCAM_FRAME_READ_TIME = 0.5 
 # Read every third frame from uploaded video
 VIDEO_FRAME_READ_RATE = 3 
+# How frames of uploaded videos are sampled for processing
+#   "rate": every VIDEO_FRAME_READ_RATE-th frame
+#   "time": one frame every VIDEO_SAMPLE_INTERVAL seconds, whatever the FPS of the video
+#   "scene": every VIDEO_FRAME_READ_RATE-th frame is a candidate but it is only processed if the scene changed since the last processed frame
+VIDEO_SAMPLING_MODE = os.getenv('VIDEO_SAMPLING_MODE', 'rate')
+VIDEO_SAMPLE_INTERVAL = float(os.getenv('VIDEO_SAMPLE_INTERVAL', 0.1))
+# Mean absolute difference (0-255) between 32x32 grayscale thumbnails of two frames above which the scene is considered changed
+SCENE_CHANGE_THRESHOLD = 12.0
+# In "scene" mode a candidate is processed anyway once this many candidates in a row were skipped, so the output never freezes for long
+SCENE_MAX_SKIPPED_FRAMES = 10
+# FPS assumed for videos whose container doesn't report one
+DEFAULT_VIDEO_FPS = 30.0
+# How videos are processed
+#   "sequential": one frame after the other
+#   "pipelined": decode, detect, predict and encode run concurrently in their own threads
+#   "segmented": the video is split into frame ranges that are processed in parallel by a pool of processes
+VIDEO_PROCESSING_MODE = os.getenv('VIDEO_PROCESSING_MODE', 'sequential')
+# Maximum number of frames waiting between two stages of the pipelined mode, keeps memory predictable
+PIPELINE_QUEUE_SIZE = 8
+# Number of processes of the segmented mode, each of them loads its own model once
+VIDEO_SEGMENT_PROCESSES = int(os.getenv('VIDEO_SEGMENT_PROCESSES', os.cpu_count() or 1))
+# Segments are never shorter than this many frames, so short clips aren't split into pieces that cost more to stitch than to process
+MIN_SEGMENT_FRAMES = 150
+# Run full face detection only on keyframes of videos and track the faces in between (see face_tracking.py)
+FACE_TRACKING = os.getenv('FACE_TRACKING', 'false').lower() == 'true'
+# Face detector backend used for images and videos, one of the keys of FACE_DETECTORS ("hog", "haar", "lbp" or "dnn")
+FACE_DETECTOR = os.getenv('FACE_DETECTOR', 'hog')
+# Images are downscaled so that their longest side is at most DETECTION_MAX_SIZE pixels before detecting faces
+# Set to 0 to always detect on the full resolution
+DETECTION_MAX_SIZE = int(os.getenv('DETECTION_MAX_SIZE', 500))
+# Video frames are always downscaled to at least 1/4 of their size (as they were before the size cap) and large frames further
+# so that their longest side is at most VIDEO_DETECTION_MAX_SIZE pixels, which trades some recall on small faces for throughput
+VIDEO_DETECTION_SCALE = 0.25
+VIDEO_DETECTION_MAX_SIZE = int(os.getenv('VIDEO_DETECTION_MAX_SIZE', 320))
+# Haar cascade ships with opencv-python, the LBP cascade and the res10 SSD files need to be put in static/detectors/
+# (see "Face Detectors" in the README for where to get them)
+HAAR_CASCADE_PATH = os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+LBP_CASCADE_PATH = 'static/detectors/lbpcascade_frontalface_improved.xml'
+DNN_PROTOTXT_PATH = 'static/detectors/deploy.prototxt'
+DNN_WEIGHTS_PATH = 'static/detectors/res10_300x300_ssd_iter_140000.caffemodel'
+# Minimum confidence of a res10 SSD detection to be considered a face
+DNN_CONFIDENCE_THRESHOLD = 0.5
+# export_model.py records how a .tflite file was quantized in a JSON file next to it, e.g., static/model_195.tflite.json
+TFLITE_METADATA_SUFFIX = '.json'
+
+
+def tflite_quantization(model_path):
+    '''
+        Quantization of a .tflite file as recorded by export_model.py, "unknown" if it wasn't recorded
+    '''
+    try:
+        with open(model_path + TFLITE_METADATA_SUFFIX) as f:
+            return json.load(f)['quantization']
+    except (OSError, ValueError, KeyError):
+        return 'unknown'
+
+
+# Identifies the trained weights in the result cache keys, change it whenever the model file is replaced
+# The quantization of TFLite models is part of it, so results of float and int8 exports at the same path never mix
+if INFERENCE_BACKEND == 'tflite':
+    MODEL_VERSION = os.getenv('MODEL_VERSION', '%s:%s' % (os.path.basename(TFLITE_MODEL_PATH), tflite_quantization(TFLITE_MODEL_PATH)))
+else:
+    MODEL_VERSION = os.getenv('MODEL_VERSION', os.path.basename(MODEL_PATH if INFERENCE_BACKEND == 'keras' else TFLITE_MODEL_PATH))
 CLASS_LABELS = {0: 'Anger', 1: 'Disgust', 2: 'Fear', 3: 'Happy', 4: 'Sad', 5: 'Surprise', 6: 'Neutral'}
 
+# Model shared by every job that runs in this process, populated lazily by get_model()
+_model = None
+# Face detector of this process, populated lazily by get_face_detector()
+_face_detector = None
+# Function called with the predicted labels of every batch, set it with set_prediction_debug_hook() while debugging
+# PREDICTION_DEBUG=true installs one that prints them, like prediction() used to do for every face
+_prediction_debug_hook = None
+# Graph and session the Keras model was built and loaded in, needed to run it from threads other than the one that loaded it
+# (None for the other backends)
+_graph = None
+_session = None
+# Per thread buffer the faces are pre-processed into, see preprocess_frame_faces()
+_face_buffers = threading.local()
+# Process pool of the segmented mode, created on first use and kept until it fails or this process exits
+_segment_pool = None
+# Marks the end of the frames flowing through the pipelined mode
+_END_OF_STREAM = object()
+
 
 def load_model():
+    '''
+        Loads the emotion model with the backend selected by INFERENCE_BACKEND
+        Backends are imported here so that the tflite backend never has to import the whole of TensorFlow
+    '''
+    if INFERENCE_BACKEND == 'tflite':
+        import tflite_model
+        return tflite_model.TFLiteModel(TFLITE_MODEL_PATH)
+
+    if INFERENCE_BACKEND == 'remote':
+        import inference_server
+        return inference_server.RemoteModel(inference_server.INFERENCE_SERVER_ADDRESS)
+
+    import models
     model = models.cnn_model_2()
     model.load_weights(MODEL_PATH)
     return model
 
 
+def set_prediction_debug_hook(hook):
+    '''
+        Installs a function that is called with the list of predicted labels of every batch, None removes it
+    '''
+    global _prediction_debug_hook
+    _prediction_debug_hook = hook
+
+
+if os.getenv('PREDICTION_DEBUG', 'false').lower() == 'true':
+    set_prediction_debug_hook(lambda labels: print('Predictions:', labels))
+
+
+def get_model():
+    '''
+        Returns the model of this process, building and loading its weights only the first time it is called
+        RQ workers call warm_model() at boot so that jobs never pay for load_model()
+    '''
+    global _model, _graph, _session
+
+    if _model is None:
+        _model = load_model()
+
+        if INFERENCE_BACKEND == 'keras':
+            import tensorflow as tf
+            _graph = tf.get_default_graph()
+            _session = tf.keras.backend.get_session()
+
+    return _model
+
+
+@contextmanager
+def model_context():
+    '''
+        The Keras graph and session are thread local in TensorFlow 1.x, so threads other than the one that loaded the model have to
+        enter both explicitly before running the model, otherwise they get a new session without the trained weights
+        Does nothing for the other backends
+    '''
+    if _graph is None:
+        yield
+    else:
+        with _graph.as_default(), _session.as_default():
+            yield
+
+
+def warm_model():
+    '''
+        Loads the process wide model and runs a dummy forward pass on it, then validates and creates the face detector
+        The first predict call builds the prediction function, so doing it here keeps that cost out of the first job
+    '''
+    model = get_model()
+    model.predict(np.zeros((1, 48, 48, 1), dtype=np.uint8))
+    validate_face_detector()
+    return model
+
+
+def create_hog_detector():
+    '''
+        Default face_recognition (dlib) HOG detector, most accurate of the CPU backends but also the slowest
+    '''
+    return face_recognition.face_locations
+
+
+def create_cascade_detector(cascade_path):
+    '''
+        OpenCV Haar or LBP cascade detector, several times faster than HOG at the cost of some recall and more false positives
+    '''
+    cascade = cv2.CascadeClassifier(cascade_path)
+
+    if cascade.empty():
+        raise IOError('Could not load face cascade from ' + cascade_path)
+
+    def detect(image):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        faces = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(20, 20))
+        return [(int(y), int(x + w), int(y + h), int(x)) for (x, y, w, h) in faces]
+
+    return detect
+
+
+def create_dnn_detector():
+    '''
+        OpenCV DNN detector running the res10 300x300 SSD Caffe model on the CPU
+        Fast and more robust to pose than the cascades
+    '''
+    net = cv2.dnn.readNetFromCaffe(DNN_PROTOTXT_PATH, DNN_WEIGHTS_PATH)
+
+    def detect(image):
+        height, width = image.shape[:2]
+
+        # Mean values are the ones the res10 model was trained with
+        blob = cv2.dnn.blobFromImage(cv2.resize(image, (300, 300)), 1.0, (300, 300), (104.0, 177.0, 123.0))
+        net.setInput(blob)
+        detections = net.forward()
+
+        face_locations = []
+        for confidence, x1, y1, x2, y2 in detections[0, 0, :, 2:7]:
+            if confidence < DNN_CONFIDENCE_THRESHOLD:
+                continue
+
+            left, right = max(int(x1 * width), 0), min(int(x2 * width), width)
+            top, bottom = max(int(y1 * height), 0), min(int(y2 * height), height)
+
+            if right > left and bottom > top:
+                face_locations.append((top, right, bottom, left))
+
+        return face_locations
+
+    return detect
+
+
+# Available face detector backends, FACE_DETECTOR selects which one is used
+# Every backend is a function that takes a BGR image and returns a list of (top, right, bottom, left) face locations on it
+FACE_DETECTORS = {
+    'hog': create_hog_detector,
+    'haar': lambda: create_cascade_detector(HAAR_CASCADE_PATH),
+    'lbp': lambda: create_cascade_detector(LBP_CASCADE_PATH),
+    'dnn': create_dnn_detector
+}
+
+
+# Files the detector backends need besides their packages
+FACE_DETECTOR_FILES = {
+    'lbp': [LBP_CASCADE_PATH],
+    'dnn': [DNN_PROTOTXT_PATH, DNN_WEIGHTS_PATH]
+}
+
+
+def validate_face_detector():
+    '''
+        Checks FACE_DETECTOR and the files it needs, then creates the detector. Called by warm_model() so that a misconfigured
+        backend stops the worker at boot with a clear message instead of failing its first job with an opaque cv2.error
+    '''
+    if FACE_DETECTOR not in FACE_DETECTORS:
+        raise ValueError('Unknown FACE_DETECTOR "%s", expected one of %s' % (FACE_DETECTOR, ', '.join(sorted(FACE_DETECTORS))))
+
+    missing_files = [path for path in FACE_DETECTOR_FILES.get(FACE_DETECTOR, []) if not os.path.isfile(path)]
+    if missing_files:
+        raise IOError('FACE_DETECTOR=%s needs %s, see "Face Detectors" in the README' % (FACE_DETECTOR, ', '.join(missing_files)))
+
+    return get_face_detector()
+
+
+def get_face_detector():
+    '''
+        Returns the face detector of this process selected by FACE_DETECTOR, creating it only the first time it is called
+    '''
+    global _face_detector
+
+    if _face_detector is None:
+        _face_detector = FACE_DETECTORS[FACE_DETECTOR]()
+
+    return _face_detector
+
+
+def detection_scale(image, video=False):
+    '''
+        Returns the factor an image has to be downscaled by so that its longest side is at most DETECTION_MAX_SIZE
+        Small images are left as they are (factor 1.0)
+        Video frames are downscaled by VIDEO_DETECTION_SCALE, or more so that their longest side is at most VIDEO_DETECTION_MAX_SIZE
+    '''
+    longest_side = max(image.shape[:2])
+    scale, max_size = (VIDEO_DETECTION_SCALE, VIDEO_DETECTION_MAX_SIZE) if video else (1.0, DETECTION_MAX_SIZE)
+
+    if max_size <= 0 or longest_side * scale <= max_size:
+        return scale
+
+    return max_size / float(longest_side)
+
+
+def downscale_for_detection(image, video=False):
+    '''
+        Returns (small_image, scale) where small_image is the image downscaled by detection_scale()
+    '''
+    scale = detection_scale(image, video)
+
+    if scale == 1.0:
+        return image, scale
+
+    return cv2.resize(image, (0, 0), fx=scale, fy=scale), scale
+
+
+def detect_faces(image, video=False):
+    '''
+        Detects faces on the image with the selected backend after adaptive downscaling, video frames are downscaled more
+        Returns the face locations on the original image, without the ones that have nothing left on it (see face_box_visible())
+    '''
+    small_image, scale = downscale_for_detection(image, video)
+
+    with metrics.timed('detect'):
+        face_locations = get_face_detector()(small_image)
+
+    return [face_box for face_box in get_face_boxes(face_locations, 1.0 / scale) if face_box_visible(face_box, image.shape)]
+
+
 def create_webcam_output():
     '''
-        Not used in current Flask App, but could in the future :P
+        Not used in current Flask App, the web version of this is the live mode (see live_worker.py)
         Reads local webcam feed and processes a frame every 0.5 seconds (can modify using WEBCAM_FRAME_READ_TIME variable),
         Annotates result and displays it in real-time
     '''
     
-    model = load_model()
+    model = get_model()
 
     video_capture = cv2.VideoCapture(0)
     face_locations = []
@@ -38,23 +345,19 @@ def create_webcam_output():
     while True:
         ret, frame = video_capture.read()
 
-        # Reducing frame to 1/4 of its size. Used for faster execution
-        small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-        rgb_small_frame = small_frame[:, :, ::-1]
-
         # Only process every other frame of video to save time
         # Check if 0.5 sec has passed
         if time.time() - start_time >= WEBCAM_FRAME_READ_TIME: 
 
-            # Find all the faces in the current frame of video
-            face_locations = face_recognition.face_locations(rgb_small_frame)
+            # Find all the faces in the current frame of video, detect_faces() downscales it for faster execution
+            face_locations = detect_faces(frame, video=True)
             print(face_locations)
 
             # Set start timer
             start_time = time.time()
 
         # Annotate frame with right class label
-        detect_emotion_and_annotate_frame(frame, face_locations[:2], model, scale_multiplier=4)
+        detect_emotion_and_annotate_frame(frame, face_locations[:2], model)
 
         # Display the resulting image
         cv2.imshow('Video', frame)
@@ -77,35 +380,85 @@ def create_image_output(input_dir_path, output_dir_path, image_filenames):
             input_dir_path: Directory path of input images
             output_dir_path: The directory path of output images
             image_filenames: Filenames of images that have been uploaded by given user with given user_uuid (verified in app.py)
+
+        Returns:
+            Dictionary of the predictions of every image by filename, a list with the box (on the input image, not on the
+            resized output image) and label of each face
     '''
 
     # If there's no input images to process (because user only uploaded videos) then stop processing
     if len(os.listdir(input_dir_path)) == 0:
-        return
+        return {}
 
-    # Relatively time consuming step, so minimize calls to this as much as possible
-    model = load_model() 
+    # Relatively time consuming step, so the model is loaded once per process and reused across jobs
+    model = get_model()
 
-    # Iterate through each image in the input directory
+    image_predictions = {}
+    images = []
+    image_face_boxes = []
+    original_shapes = []
+    cache_misses = []
+
+    # Iterate through each image in the input directory and collect the face crops of all images
     for file_name in image_filenames:
 
         full_filename = input_dir_path + '/' + file_name
+        output_filename = output_dir_path + '/' + file_name
+
+        # Identical uploads are served straight from the result cache
+        cache_key = result_cache.cache_key(full_filename, image_cache_settings())
+        with metrics.timed('file_io'):
+            cached_predictions = result_cache.get(cache_key, output_filename)
+
+        metrics.increment('images')
 
-        old_image = cv2.imread(full_filename)
+        if cached_predictions is not None:
+            metrics.increment('cache_hits')
+            image_predictions[file_name] = cached_predictions
+            job_progress.file_done('image', file_name)
+            continue
+
+        with metrics.timed('file_io'):
+            old_image = cv2.imread(full_filename)
 
         # Resizing image to height 500 while maintaining aspect ratio so that all images are brought to approx same size
         # while displaying on web page (can change height if required)
         image = resize_image_with_aspect_ratio(old_image, window_height=500)
 
-        face_locations = face_recognition.face_locations(image)
+        face_boxes = detect_faces(image)
+
+        cache_misses.append((file_name, output_filename, cache_key))
+        images.append(image)
+        image_face_boxes.append(face_boxes)
+        original_shapes.append(old_image.shape)
+
+    # Run the model once on the faces of every image of the upload
+    class_labels = batch_prediction(preprocess_frame_faces(zip(images, image_face_boxes)), model)
 
-        detect_emotion_and_annotate_frame(image, face_locations, model)
+    start = 0
+    for (file_name, output_filename, cache_key), image, face_boxes, original_shape in zip(cache_misses, images, image_face_boxes, original_shapes):
+        end = start + len(face_boxes)
+        # Predictions refer to the input image, the output image is only the resized copy shown on the web page
+        original_boxes = scale_face_boxes(face_boxes, image.shape, original_shape)
+        annotate_frame(image, face_boxes, class_labels[start: end])
+
+        predictions = [{"box": list(face_box), "label": class_label} for face_box, class_label in zip(original_boxes, class_labels[start: end])]
+        image_predictions[file_name] = predictions
 
         # Save output image
-        cv2.imwrite(output_dir_path + '/' + file_name, image)
+        with metrics.timed('file_io'):
+            cv2.imwrite(output_filename, image)
+            result_cache.put(cache_key, output_filename, predictions)
+
+        # The image can be shown while the rest of the batch is still being processed
+        job_progress.file_done('image', file_name)
+
+        start = end
 
     print("Output Images created")
 
+    return image_predictions
+
 
 def resize_image_with_aspect_ratio(image, window_height=500):
     '''
@@ -125,64 +478,645 @@ def create_video_output(input_dir_path, output_dir_path, video_filenames):
         The VIDEO_FRAME_READ_RATE global variable determines how often a video's frame will be read for processing (annotation). This is done to save
         time on the overall processing as reading each frame is redundant
         According to current setting, every third frame of the video will be read for processing.
+        VIDEO_SAMPLING_MODE can switch this to time based or scene change driven sampling (see read_sampled_frames)
+        The VIDEO_PROCESSING_MODE global variable selects between processing each video sequentially, with a pipeline of concurrent stages
+        or in segments across a pool of processes
+        If upload_manifest.VIDEO_OUTPUT_MODE is "annotations", no video is encoded and only a timeline is written (see process_video_annotations)
 
         Parameters:
             input_dir_path: Directory path of input video
             output_dir_path: The directory path of output video
             video_filenames: Filenames of videos that have been uploaded by given user with given user_uuid (verified in app.py)
+
+        Returns:
+            Dictionary of the predicted class labels of every processed frame by video filename
     '''
 
     # If there's no input videos to process (because user only uploaded images) then stop processing
     if len(os.listdir(input_dir_path)) == 0:
-        return
+        return {}
     
-    # Relatively time consuming step, so minimize calls to this as much as possible
-    model = load_model()
+    # Relatively time consuming step, so the model is loaded once per process and reused across jobs
+    model = get_model()
+
+    video_frame_labels = {}
 
     # Iterate through each video in the input directory
     for file_name in video_filenames:
 
         full_file_name = input_dir_path + '/' + file_name
 
-        out_file = output_dir_path + '/' + file_name.split('.')[0] + '.webm'
+        out_file = output_dir_path + '/' + upload_manifest.output_video_filename(file_name)
 
-        input_video = cv2.VideoCapture(full_file_name)
-        height = input_video.get(cv2.CAP_PROP_FRAME_HEIGHT)
-        width = input_video.get(cv2.CAP_PROP_FRAME_WIDTH)
+        # Identical uploads are served straight from the result cache
+        cache_key = result_cache.cache_key(full_file_name, video_cache_settings())
+        with metrics.timed('file_io'):
+            cached_frame_labels = result_cache.get(cache_key, out_file)
 
-        # Create output_video using VP8 Format which creates .webm video and with fixed FPS = 10.0
-        # Also, note that size format is (width, height) and not (height, width)
-        
-        output_video = cv2.VideoWriter(out_file, cv2.VideoWriter_fourcc(*'VP80'), 10.0, (int(width), int(height)))
+        metrics.increment('videos')
 
-        count = 0
+        if cached_frame_labels is not None:
+            metrics.increment('cache_hits')
+            video_frame_labels[file_name] = cached_frame_labels
+            job_progress.file_done('video', file_name)
+            continue
 
-        while input_video.isOpened():
-            ret, frame = input_video.read()
+        if upload_manifest.VIDEO_OUTPUT_MODE == 'annotations':
+            frame_labels = process_video_annotations(full_file_name, out_file, model)
+        elif VIDEO_PROCESSING_MODE == 'pipelined':
+            frame_labels = process_video_pipelined(full_file_name, out_file, model)
+        elif VIDEO_PROCESSING_MODE == 'segmented':
+            frame_labels = process_video_segmented(full_file_name, out_file, model)
+        else:
+            frame_labels = process_video(full_file_name, out_file, model)
+
+        with metrics.timed('file_io'):
+            result_cache.put(cache_key, out_file, frame_labels)
+
+        video_frame_labels[file_name] = frame_labels
+        job_progress.file_done('video', file_name)
+
+        print("Output Video created")
+
+    return video_frame_labels
+
+
+def image_cache_settings():
+    '''
+        Everything besides the input bytes that changes an output image, used for the result cache key
+    '''
+    return {
+        "type": "image", 
+        "model_version": MODEL_VERSION, 
+        "inference_backend": INFERENCE_BACKEND, 
+        "window_height": 500, 
+        "box_coordinates": "original",
+        "face_detector": FACE_DETECTOR, 
+        "detection_max_size": DETECTION_MAX_SIZE
+    }
+
+
+def video_cache_settings():
+    '''
+        Everything besides the input bytes that changes an output video, used for the result cache key
+    '''
+    return {
+        "type": "video", 
+        "model_version": MODEL_VERSION, 
+        "inference_backend": INFERENCE_BACKEND, 
+        "frame_read_rate": VIDEO_FRAME_READ_RATE, 
+        "sampling_mode": VIDEO_SAMPLING_MODE, 
+        "sample_interval": VIDEO_SAMPLE_INTERVAL, 
+        "scene_change_threshold": SCENE_CHANGE_THRESHOLD, 
+        "face_tracking": FACE_TRACKING,
+        "face_detector": FACE_DETECTOR, 
+        "detection_max_size": VIDEO_DETECTION_MAX_SIZE,
+        "detection_scale": VIDEO_DETECTION_SCALE,
+        "output_mode": upload_manifest.VIDEO_OUTPUT_MODE,
+        "video_encoder": video_encoding.VIDEO_ENCODER,
+        "ffmpeg_settings": [video_encoding.FFMPEG_CODEC, video_encoding.FFMPEG_PRESET, video_encoding.FFMPEG_CRF, video_encoding.FFMPEG_BITRATE]
+    }
+
+
+def video_sampling_step(fps):
+    '''
+        Returns the number of input frames between two sampled frames for the selected VIDEO_SAMPLING_MODE
+    '''
+
+    if VIDEO_SAMPLING_MODE == 'time':
+        return max(1, int(round(fps * VIDEO_SAMPLE_INTERVAL)))
+
+    return VIDEO_FRAME_READ_RATE
+
+
+def open_video(input_file, output_file):
+    '''
+        Opens the input video for reading and creates the output video it will be annotated into
+        The FPS of the output video is the FPS of the input divided by the sampling step, so that both have the same duration
+
+        Returns:
+            (input_video, output_video, step) where step is the video_sampling_step() of the input
+            The videos must be released by the caller
+    '''
+
+    input_video = cv2.VideoCapture(input_file)
+    height = input_video.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    width = input_video.get(cv2.CAP_PROP_FRAME_WIDTH)
+    fps = input_video.get(cv2.CAP_PROP_FPS) or DEFAULT_VIDEO_FPS
+
+    step = video_sampling_step(fps)
+
+    # Create output_video with the configured encoding backend (VP8 .webm by default)
+    # Also, note that size format is (width, height) and not (height, width)
+    output_video = video_encoding.create_video_writer(output_file, fps / step, (int(width), int(height)))
+
+    return input_video, output_video, step
+
+
+def _scene_thumbnail(frame):
+    return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (32, 32), interpolation=cv2.INTER_AREA)
+
+
+def read_sampled_frames(input_video, step, start_frame=0, end_frame=None):
+    '''
+        Generator that yields the sampled frames of the input video as (frame, repeat) pairs
+        Every step-th frame is a candidate. Frames in between are only grabbed, which skips most of their decoding cost,
+        and candidates are retrieved (decoded). repeat is the number of times the frame has to be written to the output
+        to fill the time until the next sampled frame, which is always 1 except in "scene" mode
+        start_frame and end_frame limit reading to the frame range [start_frame, end_frame) of the video (see process_video_segmented)
+    '''
+
+    count = start_frame
+    pending_frame, pending_repeat, last_thumbnail = None, 0, None
+
+    if start_frame > 0:
+        input_video.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    else:
+        job_progress.start_video(int(input_video.get(cv2.CAP_PROP_FRAME_COUNT)))
+
+    while input_video.isOpened() and (end_frame is None or count < end_frame):
+
+        with metrics.timed('decode'):
+            if not input_video.grab():
+                break
+
+        if count % step == 0:
+            with metrics.timed('decode'):
+                ret, frame = input_video.retrieve()
 
             if ret is False:
                 break
-            
-            # Read every third frame
-            if count % VIDEO_FRAME_READ_RATE == 0:        
 
-                # Resizing frame to 1/4th of its size to save time for detecting faces
-                small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
+            if VIDEO_SAMPLING_MODE != 'scene':
+                yield frame, 1
+
+            else:
+                # Candidates that look like the last processed frame just extend how long that frame is shown
+                thumbnail = _scene_thumbnail(frame)
+                scene_changed = last_thumbnail is None or cv2.absdiff(thumbnail, last_thumbnail).mean() > SCENE_CHANGE_THRESHOLD
+
+                if scene_changed or pending_repeat > SCENE_MAX_SKIPPED_FRAMES:
+                    if pending_frame is not None:
+                        yield pending_frame, pending_repeat
+                    pending_frame, pending_repeat, last_thumbnail = frame, 1, thumbnail
+                else:
+                    pending_repeat += 1
+
+        count += 1
+        job_progress.frame_read(count)
+
+    if pending_frame is not None:
+        yield pending_frame, pending_repeat
+
+
+def detect_video_frame_faces(frame, tracker=None):
+    '''
+        Detects the faces of a video frame, the frame is downscaled by detection_scale(video=True) to save time for detecting faces
+        If a FaceTracker is given, full detection only runs on its keyframes and the boxes are tracked in between
+
+        Returns:
+            (track_ids, face_locations) pair, with face locations on the original frame
+            track_ids is None when no tracker is used
+    '''
+
+    small_frame, scale = downscale_for_detection(frame, video=True)
+
+    with metrics.timed('detect'):
+        if tracker is None:
+            track_ids, face_locations = None, get_face_detector()(small_frame)
+        else:
+            track_ids, face_locations = tracker.update(small_frame)
+
+    metrics.increment('frames')
+
+    # Multiplying by the inverse of the scale gives the face locations on the original frame
+    face_boxes = get_face_boxes(face_locations, 1.0 / scale)
+    visible = [face_box_visible(face_box, frame.shape) for face_box in face_boxes]
+
+    if track_ids is not None:
+        track_ids = [track_id for track_id, is_visible in zip(track_ids, visible) if is_visible]
+
+    return track_ids, [face_box for face_box, is_visible in zip(face_boxes, visible) if is_visible]
+
+
+def classify_and_annotate_video_frame(frame, face_locations, model, track_ids=None, label_smoother=None):
+    '''
+        Runs the model on the faces of a video frame and annotates it
+        If a LabelSmoother is given, the labels of each track are smoothed over its last few predictions before annotating
+    '''
+
+    class_labels = batch_prediction(preprocess_frame_faces([(frame, face_locations)]), model)
+
+    if label_smoother is not None:
+        class_labels = label_smoother.smooth(track_ids, class_labels)
+
+    annotate_frame(frame, face_locations, class_labels)
+
+    return list(class_labels)
+
+
+def create_video_trackers():
+    '''
+        Returns a new (FaceTracker, LabelSmoother) pair for a video if FACE_TRACKING is enabled, else (None, None)
+        Trackers hold the state of a single video so a new pair is needed for every video
+    '''
+
+    if not FACE_TRACKING:
+        return None, None
+
+    return face_tracking.FaceTracker(get_face_detector()), face_tracking.LabelSmoother()
+
+
+def process_video(input_file, output_file, model, start_frame=0, end_frame=None):
+    '''
+        Processes a single video sequentially, i.e., decoding, detection, prediction and encoding of a frame 
+        all happen one after another before the next frame is read
+
+        Parameters:
+            input_file: Path of the input video
+            output_file: Path of the output .webm video
+            model: Model that will run the prediction
+            start_frame, end_frame: Only process the frame range [start_frame, end_frame) of the video, the whole video by default
+
+        Returns:
+            List with the predicted class labels of every processed frame
+    '''
+
+    input_video, output_video, step = open_video(input_file, output_file)
+    tracker, label_smoother = create_video_trackers()
+    frame_labels = []
+
+    for frame, repeat in read_sampled_frames(input_video, step, start_frame, end_frame):
+
+        track_ids, face_locations = detect_video_frame_faces(frame, tracker)
+
+        frame_labels.append(classify_and_annotate_video_frame(frame, face_locations, model, track_ids, label_smoother))
+
+        # Write each frame to output_video
+        with metrics.timed('encode'):
+            for _ in range(repeat):
+                output_video.write(frame)
+
+    input_video.release()
+    output_video.release()
+
+    return frame_labels
+
+
+def process_video_annotations(input_file, timeline_file, model):
+    '''
+        Processes a single video without drawing on or re-encoding any frame, the faces and emotions are written to a timeline instead
+        The timeline is a JSON lines file. Its first line describes the video:
+            {"fps", "width", "height", "class_labels"}
+        and every following line a sampled frame:
+            {"frame", "time", "duration", "boxes", "labels", "probabilities"}
+        time and duration (in seconds) give when the frame is shown and for how long its annotations hold, boxes are
+        (top, right, bottom, left) on the original frame and probabilities has one column per entry of class_labels
+
+        Parameters:
+            input_file: Path of the input video
+            timeline_file: Path of the output .timeline.jsonl file
+            model: Model that will run the prediction
+
+        Returns:
+            List with the predicted class labels of every processed frame
+    '''
+
+    input_video = cv2.VideoCapture(input_file)
+    fps = input_video.get(cv2.CAP_PROP_FPS) or DEFAULT_VIDEO_FPS
+    step = video_sampling_step(fps)
+
+    tracker, label_smoother = create_video_trackers()
+    frame_labels = []
+    frame_index = 0
+
+    with open(timeline_file, 'w') as f:
+        f.write(json.dumps({
+            "fps": fps,
+            "width": int(input_video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(input_video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "class_labels": CLASS_LABELS
+        }) + '\n')
+
+        for frame, repeat in read_sampled_frames(input_video, step):
+            track_ids, face_locations = detect_video_frame_faces(frame, tracker)
+
+            probabilities = batch_probabilities(preprocess_frame_faces([(frame, face_locations)]), model)
+            class_labels = [CLASS_LABELS[class_index] for class_index in probabilities.argmax(axis=-1)]
+
+            if label_smoother is not None:
+                class_labels = label_smoother.smooth(track_ids, class_labels)
+
+            frame_labels.append(class_labels)
+
+            with metrics.timed('file_io'):
+                f.write(json.dumps({
+                    "frame": frame_index,
+                    "time": round(frame_index / fps, 3),
+                    "duration": round(repeat * step / fps, 3),
+                    "boxes": [[int(coordinate) for coordinate in face_location] for face_location in face_locations],
+                    "labels": class_labels,
+                    "probabilities": np.round(probabilities, 4).tolist()
+                }) + '\n')
+
+            frame_index += repeat * step
+
+    input_video.release()
+
+    return frame_labels
+
+
+def video_segments(input_file, step):
+    '''
+        Splits a video into (start_frame, end_frame) ranges, one per segment process
+        Segments start on a multiple of the sampling step, so the same frames are sampled as when processing the whole video at once
+        Videos that are too short, or whose container doesn't report a frame count (common for flv, wmv and mpeg), are a single
+        segment that reads the whole video
+    '''
+
+    input_video = cv2.VideoCapture(input_file)
+    frame_count = int(input_video.get(cv2.CAP_PROP_FRAME_COUNT))
+    input_video.release()
+
+    if frame_count < MIN_SEGMENT_FRAMES:
+        return [(0, None)]
+
+    segment_count = max(1, min(VIDEO_SEGMENT_PROCESSES, frame_count // MIN_SEGMENT_FRAMES))
+    segment_length = max(1, int(math.ceil(frame_count / float(segment_count) / step))) * max(1, step)
+
+    # The container's frame count can be off, so the last segment reads until the end of the video
+    segments = [(start, start + segment_length) for start in range(0, frame_count, segment_length)]
+    segments[-1] = (segments[-1][0], None)
+
+    return segments
+
+
+def _get_segment_pool():
+    '''
+        Returns the process pool of the segmented mode, every process of it loads and warms its model once when it starts
+        Processes are spawned rather than forked since TensorFlow doesn't survive a fork of a process that already loaded a model
+    '''
+    global _segment_pool
+
+    if _segment_pool is None:
+        _segment_pool = multiprocessing.get_context('spawn').Pool(VIDEO_SEGMENT_PROCESSES, initializer=warm_model)
+
+    return _segment_pool
+
+
+@atexit.register
+def _close_segment_pool():
+    '''
+        Terminates the process pool of the segmented mode, the next video creates a new one
+        Called when map() raised, e.g., on a job timeout or when a segment process died, since its processes may still
+        be stuck on the unfinished segments of that job, and when the worker shuts down
+    '''
+    global _segment_pool
+
+    if _segment_pool is not None:
+        pool, _segment_pool = _segment_pool, None
+        pool.terminate()
+        pool.join()
+
+
+def _process_video_segment(segment):
+    '''
+        Runs in a segment process, processes one frame range of a video into its own output file
+        Returns the frame labels along with the raw metrics of the segment, so that they can be merged into the metrics of the job
+    '''
+    input_file, output_file, start_frame, end_frame = segment
+
+    recorder = metrics.start_job()
+    frame_labels = process_video(input_file, output_file, get_model(), start_frame, end_frame)
+
+    return frame_labels, recorder.stages, recorder.counters
+
+
+def concatenate_videos(input_files, output_file):
+    '''
+        Stitches videos with the same codec, size and FPS into output_file in the given order
+        Uses the ffmpeg concat demuxer when ffmpeg is installed, which copies the streams without re-encoding them,
+        and falls back to decoding and re-encoding every frame with OpenCV otherwise
+    '''
+
+    ffmpeg = shutil.which('ffmpeg')
+
+    if ffmpeg is not None:
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as list_file:
+            for input_file in input_files:
+                list_file.write("file '%s'\n" % os.path.abspath(input_file))
 
-                face_locations = face_recognition.face_locations(small_frame)
+        try:
+            subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_file.name, '-c', 'copy', output_file], check=True)
+        finally:
+            os.remove(list_file.name)
+
+        return
 
-                # Scale multiplier = 4 since 1/4 = 0.25
-                # so we can obtain the actual face locations on the original frame by multiplying face_locations by 4
-                detect_emotion_and_annotate_frame(frame, face_locations, model, scale_multiplier=4) 
+    output_video = None
 
-                output_video.write(frame) # Write each frame to output_video
+    for input_file in input_files:
+        input_video = cv2.VideoCapture(input_file)
 
-            count += 1
+        if output_video is None:
+            size = (int(input_video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(input_video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            output_video = video_encoding.OpenCVVideoWriter(output_file, input_video.get(cv2.CAP_PROP_FPS), size)
+
+        while True:
+            ret, frame = input_video.read()
+            if ret is False:
+                break
+            output_video.write(frame)
 
         input_video.release()
+
+    if output_video is not None:
         output_video.release()
 
-        print("Output Video created")
+
+def process_video_segmented(input_file, output_file, model):
+    '''
+        Processes a single video by splitting it into frame range segments (seeking with CAP_PROP_POS_FRAMES)
+        that are processed in parallel by a pool of VIDEO_SEGMENT_PROCESSES processes, each with its own model loaded once
+        The per-segment .webm outputs are then stitched into output_file in order
+        Videos too short to be split are processed in this process with process_video()
+
+        Parameters:
+            input_file: Path of the input video
+            output_file: Path of the output .webm video
+            model: Model that will run the prediction if the video isn't split
+
+        Returns:
+            List with the predicted class labels of every processed frame
+    '''
+
+    input_video = cv2.VideoCapture(input_file)
+    step = video_sampling_step(input_video.get(cv2.CAP_PROP_FPS) or DEFAULT_VIDEO_FPS)
+    input_video.release()
+
+    segments = video_segments(input_file, step)
+
+    if len(segments) <= 1:
+        return process_video(input_file, output_file, model)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file))) as segment_dir:
+        # Segments are written in the container of the output, which depends on the codec
+        segment_files = [os.path.join(segment_dir, 'segment_%d%s' % (index, os.path.splitext(output_file)[1])) for index in range(len(segments))]
+
+        # map() returns the results in the order of the segments, whichever process finishes first
+        try:
+            results = _get_segment_pool().map(_process_video_segment,
+                                              [(input_file, segment_file, start, end) for segment_file, (start, end) in zip(segment_files, segments)])
+        # Also the job timeout of RQ, which is raised in the middle of map()
+        except BaseException:
+            _close_segment_pool()
+            raise
+
+        with metrics.timed('encode'):
+            concatenate_videos(segment_files, output_file)
+
+    frame_labels = []
+    for segment_labels, segment_stages, segment_counters in results:
+        frame_labels.extend(segment_labels)
+        metrics.current_recorder().merge(segment_stages, segment_counters)
+
+    return frame_labels
+
+
+def _put_until_stopped(stage_queue, item, stop_event):
+    '''
+        Puts item on a bounded stage queue, giving up if the pipeline was stopped because some other stage failed
+        Otherwise a stage could block forever on a full queue whose consumer is gone
+    '''
+
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def _get_until_stopped(stage_queue, stop_event):
+    '''
+        Gets the next item from a stage queue, returns _END_OF_STREAM if the pipeline was stopped
+    '''
+
+    while not stop_event.is_set():
+        try:
+            return stage_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+    return _END_OF_STREAM
+
+
+def _iterate_stage_queue(stage_queue, stop_event):
+    '''
+        Yields the items of a stage queue until the end of stream marker (or the pipeline stopping)
+        The marker is compared by identity since items may be numpy arrays
+    '''
+
+    while True:
+        item = _get_until_stopped(stage_queue, stop_event)
+
+        if item is _END_OF_STREAM:
+            return
+
+        yield item
+
+
+def _run_pipeline_stage(stage, input_queue, output_queue, stop_event, errors):
+    '''
+        Target of every pipeline thread. Runs stage on each item of input_queue and puts the result on output_queue
+        input_queue is None for the first stage, in which case stage is a generator producing the items,
+        output_queue is None for the last stage, in which case results are discarded.
+        The end of stream marker is always forwarded so that the following stage finishes as well
+    '''
+
+    try:
+        if input_queue is None:
+            items = stage()
+        else:
+            items = (stage(item) for item in _iterate_stage_queue(input_queue, stop_event))
+
+        for item in items:
+            if output_queue is not None and not _put_until_stopped(output_queue, item, stop_event):
+                break
+
+    except Exception as e:
+        errors.append(e)
+        stop_event.set()
+
+    finally:
+        if output_queue is not None:
+            _put_until_stopped(output_queue, _END_OF_STREAM, stop_event)
+
+
+def process_video_pipelined(input_file, output_file, model):
+    '''
+        Processes a single video with a staged pipeline where decoding, face detection, prediction and encoding 
+        each run in their own thread and are connected by bounded queues of size PIPELINE_QUEUE_SIZE
+        Since every stage is a single thread reading a FIFO queue, frames reach the writer in the same order they were decoded
+        OpenCV, dlib and TensorFlow release the GIL during the heavy work, so the stages actually overlap on multiple cores
+
+        Parameters:
+            input_file: Path of the input video
+            output_file: Path of the output .webm video
+            model: Model that will run the prediction
+
+        Returns:
+            List with the predicted class labels of every processed frame
+    '''
+
+    input_video, output_video, step = open_video(input_file, output_file)
+    frame_labels = []
+
+    # The tracker is only used by the detector thread and the label smoother only by the classifier thread
+    tracker, label_smoother = create_video_trackers()
+
+    def decode():
+        return read_sampled_frames(input_video, step)
+
+    def detect(sampled_frame):
+        return sampled_frame + detect_video_frame_faces(sampled_frame[0], tracker)
+
+    def classify(detection):
+        frame, repeat, track_ids, face_locations = detection
+        with model_context():
+            frame_labels.append(classify_and_annotate_video_frame(frame, face_locations, model, track_ids, label_smoother))
+        return frame, repeat
+
+    def write(sampled_frame):
+        frame, repeat = sampled_frame
+        with metrics.timed('encode'):
+            for _ in range(repeat):
+                output_video.write(frame)
+
+    stop_event = threading.Event()
+    errors = []
+    stages = [decode, detect, classify, write]
+    stage_queues = [None] + [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in stages[1:]] + [None]
+
+    threads = [threading.Thread(target=_run_pipeline_stage, args=(stage, stage_queues[i], stage_queues[i + 1], stop_event, errors), daemon=True)
+                for i, stage in enumerate(stages)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    input_video.release()
+    output_video.release()
+
+    # Surface the first failure of any stage to the job, just like the sequential mode would
+    if errors:
+        raise errors[0]
+
+    return frame_labels
 
 
 def prediction(image, model):
@@ -193,30 +1127,249 @@ def prediction(image, model):
         Current model requires images/frames in the format:
             (number_of_images, height, width, channels) as a grayscale image, so channels = 1
 
-        So we first resize image to 48x48 then reshape it to (1, 48, 48, 1) because we only have a single image
+        So we first convert it to grayscale, resize it to 48x48 and reshape it to (1, 48, 48, 1) because we only have a single image
+        Kept for single image callers, batch_prediction() should be preferred whenever there is more than one face
 
         Parameters:
-            image: Image to predict on
+            image: BGR image to predict on
             model: Model that will run the prediction
     '''
 
-    img = cv2.resize(image, (48, 48))
-    
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return batch_prediction(preprocess_faces([image]), model)[0]
 
-    img = np.reshape(gray, (1, 48, 48, 1))
-    
-    predictions = model.predict_classes(img)
-    print('Predictions:', CLASS_LABELS[predictions[0]])
-    
-    return CLASS_LABELS[predictions[0]]
+
+def grayscale_frame(frame):
+    '''
+        Converts a BGR frame to the grayscale the model was trained on
+        Faces used to be flipped to RGB and then converted as if they were BGR, so the frame is converted as if it were RGB
+        which gives the same weighting of the channels without the flip
+    '''
+    return cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+
+
+def _face_batch_buffer(size):
+    '''
+        Returns a (size, 48, 48, 1) view of a uint8 buffer that is allocated once per thread and only grows when a batch doesn't fit
+    '''
+    buffer = getattr(_face_buffers, 'buffer', None)
+
+    if buffer is None or len(buffer) < size:
+        buffer = np.empty((max(size, 2 * len(buffer) if buffer is not None else 16), 48, 48, 1), dtype=np.uint8)
+        _face_buffers.buffer = buffer
+
+    return buffer[:size]
+
+
+def preprocess_frame_faces(frame_face_boxes):
+    '''
+        Single pass pre-processing of the faces of one or more frames into one (N, 48, 48, 1) grayscale batch for the model
+        Every frame with faces is converted to grayscale once, each face is cropped from it as a view (no copy)
+        and resized straight into its slot of the batch. Must be called before the frames are annotated,
+        otherwise the drawn rectangles end up inside the crops fed to the model
+
+        The batch is a buffer reused by every call from the same thread, so it is only valid until the next call
+
+        Parameters:
+            frame_face_boxes: Iterable of (frame, face_boxes) pairs, face boxes are (top, right, bottom, left) on the BGR frame
+    '''
+
+    frame_face_boxes = [(frame, face_boxes) for frame, face_boxes in frame_face_boxes if len(face_boxes)]
+    batch = _face_batch_buffer(sum(len(face_boxes) for _, face_boxes in frame_face_boxes))
+    index = 0
+
+    for frame, face_boxes in frame_face_boxes:
+        gray = grayscale_frame(frame)
+
+        for top, right, bottom, left in face_boxes:
+            # Boxes of some detectors can reach past the top left corner, negative indices would wrap around
+            face = gray[max(top, 0): bottom, max(left, 0): right]
+
+            # Detected boxes are never empty (see face_box_visible()), any other empty crop gets a blank face
+            # so that the batch stays aligned with the face boxes instead of failing the whole job
+            if face.size == 0:
+                batch[index] = 0
+            else:
+                cv2.resize(face, (48, 48), dst=batch[index, :, :, 0])
+            index += 1
+
+    return batch
+
+
+def preprocess_faces(images):
+    '''
+        Converts a list of BGR face images (crops of a frame or whole images) into a single (N, 48, 48, 1) grayscale batch
+        Same as preprocess_frame_faces() with every image treated as a frame with a single face box covering all of it
+    '''
+    return preprocess_frame_faces((image, [(0, image.shape[1], image.shape[0], 0)]) for image in images)
+
+
+def batch_prediction(faces, model):
+    '''
+        Batched version of prediction(), the model is run only once on the pre-processed (N, 48, 48, 1) batch of all faces
+        So the number of model calls per frame no longer grows with the number of faces in the frame
+
+        Parameters:
+            faces: Batch returned by preprocess_frame_faces() or preprocess_faces()
+            model: Model that will run the prediction
+
+        Returns:
+            Array of class labels, one for each face in the same order as in the batch
+    '''
+
+    if len(faces) == 0:
+        return np.array([], dtype=object)
+
+    predictions = batch_probabilities(faces, model).argmax(axis=-1)
+
+    labels = np.array([CLASS_LABELS[class_index] for class_index in predictions], dtype=object)
+
+    if _prediction_debug_hook is not None:
+        _prediction_debug_hook(list(labels))
+
+    return labels
+
+
+def batch_probabilities(faces, model):
+    '''
+        Runs the model once on the pre-processed (N, 48, 48, 1) batch of all faces and returns the (N, 7) array of class probabilities
+        Column i is the probability of CLASS_LABELS[i]
+    '''
+
+    if len(faces) == 0:
+        return np.zeros((0, len(CLASS_LABELS)), dtype=np.float32)
+
+    with metrics.timed('predict'):
+        probabilities = model.predict(faces)
+
+    metrics.increment('faces', len(faces))
+
+    return probabilities
+
+
+def decode_image(data):
+    '''
+        Decodes the bytes of an encoded image (jpg, png, bmp, ...) in memory, returns None if they aren't a valid image
+    '''
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def encode_image(image, extension='.jpg'):
+    '''
+        Encodes an image in memory and returns its bytes
+    '''
+    ret, buffer = cv2.imencode(extension, image)
+    return buffer.tobytes()
+
+
+def predict_images(images, model, annotate=False):
+    '''
+        In-memory counterpart of create_image_output() used by the /api/predict route, nothing is read from or written to disk
+        The faces of all images are detected, then classified with a single batched model call
+
+        Parameters:
+            images: List of decoded BGR images
+            model: Model that will run the prediction
+            annotate: Whether to also return the annotated images
+
+        Returns:
+            (results, annotated_images) where results has one list per image with a dict per face containing its box
+            (on the original image), label and class probabilities. annotated_images is None unless annotate is set
+    '''
+
+    image_face_boxes = [detect_faces(image) for image in images]
+
+    probabilities = batch_probabilities(preprocess_frame_faces(zip(images, image_face_boxes)), model)
+    class_labels = [CLASS_LABELS[class_index] for class_index in probabilities.argmax(axis=-1)]
+
+    results = []
+    annotated_images = [] if annotate else None
+    start = 0
+
+    for image, face_boxes in zip(images, image_face_boxes):
+        end = start + len(face_boxes)
+
+        results.append([{
+            "box": {"top": top, "right": right, "bottom": bottom, "left": left},
+            "label": class_label,
+            "probabilities": {CLASS_LABELS[index]: float(probability) for index, probability in enumerate(face_probabilities)}
+        } for (top, right, bottom, left), class_label, face_probabilities in zip(face_boxes, class_labels[start: end], probabilities[start: end])])
+
+        if annotate:
+            annotated_image = image.copy()
+            annotate_frame(annotated_image, face_boxes, class_labels[start: end])
+            annotated_images.append(annotated_image)
+
+        start = end
+
+    return results, annotated_images
+
+
+def get_face_boxes(face_locations, scale_multiplier=1):
+    '''
+        Multiplying face locations by the scale to get corresponding locations on the original frame (for webcam & video)
+        Returns list of (top, right, bottom, left) tuples
+    '''
+    return [(int(top * scale_multiplier), int(right * scale_multiplier), int(bottom * scale_multiplier), int(left * scale_multiplier)) 
+                for (top, right, bottom, left) in face_locations]
+
+
+def face_box_visible(face_box, shape):
+    '''
+        Whether anything of a (top, right, bottom, left) face box is left on an image of the given shape once it is clipped to it
+        Detectors can return boxes past the edges of the image, the crop of a box that lies completely outside of it is empty
+    '''
+    top, right, bottom, left = face_box
+    return min(bottom, shape[0]) > max(top, 0) and min(right, shape[1]) > max(left, 0)
+
+
+def scale_face_boxes(face_boxes, from_shape, to_shape):
+    '''
+        Maps face boxes found on an image of from_shape to the same image resized to to_shape, e.g., from the resized output image
+        back to the input image. Returns list of (top, right, bottom, left) tuples
+    '''
+    y_scale = to_shape[0] / float(from_shape[0])
+    x_scale = to_shape[1] / float(from_shape[1])
+
+    return [(int(top * y_scale), int(right * x_scale), int(bottom * y_scale), int(left * x_scale))
+                for (top, right, bottom, left) in face_boxes]
+
+
+def crop_faces(frame, face_boxes):
+    '''
+        Crops every face box out of the frame as a view (no copy), this must be done before the frame is annotated
+        otherwise the drawn rectangle ends up inside the crop. The crops can be pre-processed with preprocess_faces()
+    '''
+    return [frame[max(top, 0): bottom, max(left, 0): right] for (top, right, bottom, left) in face_boxes]
+
+
+def annotate_frame(frame, face_boxes, class_labels):
+    '''
+        Draws a rectangle on every face box and adds text representing the emotion predicted on the image 
+        a few pixels off of the bottom line of the corresponding rectangle
+
+        Parameters:
+            frame: Input video frame or image
+            face_boxes: List of face boxes on the frame (already scaled to the frame size)
+            class_labels: Predicted class label for each face box
+    '''
+
+    font = cv2.FONT_HERSHEY_DUPLEX
+
+    with metrics.timed('annotate'):
+        for (top, right, bottom, left), class_label in zip(face_boxes, class_labels):
+
+            # Draw a box around the face
+            cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
+
+            # Draw a label with a name below the face
+            cv2.putText(frame, class_label, (left + 6, bottom + 6), font, 1.5, (255, 255, 255), 1, cv2.LINE_AA)
 
 
 def detect_emotion_and_annotate_frame(frame, face_locations, model, scale_multiplier=1):
     '''
-        This function draws a rectangle/s on the face location/s
-        Then it runs the model on the face location to obtain emotion prediction
-        It then adds text representing the emotion predicted on the image a few pixels off of the bottom line of the corresponding rectangles
+        This function runs the model on all the face locations of the frame in a single batch to obtain emotion predictions
+        It then draws a rectangle/s on the face location/s and adds text representing the emotion predicted on the image 
+        a few pixels off of the bottom line of the corresponding rectangles
 
         Parameters:
             frame: Input video frame or image
@@ -226,26 +1379,16 @@ def detect_emotion_and_annotate_frame(frame, face_locations, model, scale_multip
             scale_multiplier: If the original frame was downscaled to obtain face_locations (for saving processing time) 
             then multiplying the face_locations by the downscaled multiplier can be done to obtain the actual face_locations on the original frame
             (see create_video_output function to see this logic in action)
-    '''
-
-    # For each face detected in the frame
-    for (top, right, bottom, left) in face_locations:
 
-        # Multiplying face location by the scale to get corresponding location on the original_frame (for webcam & video)
-        top *= scale_multiplier
-        right *= scale_multiplier
-        bottom *= scale_multiplier
-        left *= scale_multiplier
-
-        # Draw a box around the face
-        cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
-
-        font = cv2.FONT_HERSHEY_DUPLEX
+        Returns:
+            Array of predicted class labels, one for each face location
+    '''
 
-        # Get class_label result from prediction()
-        class_label = prediction(frame[top: bottom, left: right][:, :, ::-1], model)
+    face_boxes = get_face_boxes(face_locations, scale_multiplier)
 
-        # Draw a label with a name below the face
-        cv2.putText(frame, class_label, (left + 6, bottom + 6), font, 1.5, (255, 255, 255), 1, cv2.LINE_AA)
+    # Get class_labels of all faces from a single batched prediction
+    class_labels = batch_prediction(preprocess_frame_faces([(frame, face_boxes)]), model)
 
+    annotate_frame(frame, face_boxes, class_labels)
 
+    return class_labels
@@ -0,0 +1,163 @@
+# Face tracking used by create_video_output so that the expensive face detection only needs to run on keyframes.
+# Face locations are in the same (top, right, bottom, left) format that face_recognition uses.
+
+import cv2
+from collections import Counter, deque
+
+# Run full face detection on every TRACKING_KEYFRAME_INTERVAL-th processed frame, boxes are propagated by the tracker in between
+TRACKING_KEYFRAME_INTERVAL = 10
+# Minimum IoU for a new detection to be considered the same face as an existing track
+TRACKING_MIN_IOU = 0.3
+# Number of most recent predictions of a track that are used to smooth its emotion label
+LABEL_SMOOTHING_WINDOW = 5
+
+
+def create_opencv_tracker():
+    '''
+        MOSSE is the cheapest of the OpenCV trackers and good enough for faces that barely move between frames
+        It moved to the cv2.legacy namespace in newer OpenCV versions
+    '''
+    if hasattr(cv2, 'TrackerMOSSE_create'):
+        return cv2.TrackerMOSSE_create()
+    return cv2.legacy.TrackerMOSSE_create()
+
+
+def intersection_over_union(location_a, location_b):
+    '''
+        Intersection over Union of two (top, right, bottom, left) face locations
+    '''
+    top_a, right_a, bottom_a, left_a = location_a
+    top_b, right_b, bottom_b, left_b = location_b
+
+    intersection_width = min(right_a, right_b) - max(left_a, left_b)
+    intersection_height = min(bottom_a, bottom_b) - max(top_a, top_b)
+
+    if intersection_width <= 0 or intersection_height <= 0:
+        return 0.0
+
+    intersection = intersection_width * intersection_height
+    area_a = (right_a - left_a) * (bottom_a - top_a)
+    area_b = (right_b - left_b) * (bottom_b - top_b)
+
+    return intersection / float(area_a + area_b - intersection)
+
+
+class FaceTracker:
+    '''
+        Tracks the faces of a single video across its processed frames
+        Full detection is run on keyframes, i.e., every keyframe_interval frames or as soon as any tracker loses its face,
+        and in between the boxes are propagated with an OpenCV tracker per face
+        New detections are matched to the existing tracks by IoU so that a face keeps its track id across keyframes
+
+        Parameters:
+            detect_faces: Function that takes a frame and returns a list of face locations on it
+            keyframe_interval: Number of frames between two full detections
+            min_iou: Minimum IoU for a detection to continue an existing track
+    '''
+
+    def __init__(self, detect_faces, keyframe_interval=TRACKING_KEYFRAME_INTERVAL, min_iou=TRACKING_MIN_IOU):
+        self.detect_faces = detect_faces
+        self.keyframe_interval = keyframe_interval
+        self.min_iou = min_iou
+
+        # Each track is a [track_id, face_location, opencv_tracker] list
+        self.tracks = []
+        # Start due for a keyframe so that the first frame always gets a full detection
+        self.frames_since_keyframe = keyframe_interval
+        self.next_track_id = 0
+
+    def update(self, frame):
+        '''
+            Returns (track_ids, face_locations) of the faces on the given frame, in matching order
+        '''
+
+        if self.frames_since_keyframe >= self.keyframe_interval or not self._propagate(frame):
+            self._detect(frame)
+
+        self.frames_since_keyframe += 1
+
+        return [track[0] for track in self.tracks], [track[1] for track in self.tracks]
+
+    def _propagate(self, frame):
+        '''
+            Moves every track with its OpenCV tracker, returns False if any of them lost its face (low confidence)
+            or if its box drifted off the frame, i.e., nothing of it is left once it is clipped to the frame
+        '''
+        height, width = frame.shape[:2]
+
+        for track in self.tracks:
+            ok, (x, y, w, h) = track[2].update(frame)
+
+            if not ok:
+                return False
+
+            top, right, bottom, left = max(int(y), 0), min(int(x + w), width), min(int(y + h), height), max(int(x), 0)
+
+            if right <= left or bottom <= top:
+                return False
+
+            track[1] = (top, right, bottom, left)
+
+        return True
+
+    def _detect(self, frame):
+        '''
+            Runs full detection and greedily matches the detections to the existing tracks by highest IoU
+            Unmatched detections start new tracks and unmatched tracks are dropped
+        '''
+        face_locations = self.detect_faces(frame)
+
+        candidates = sorted(((intersection_over_union(track[1], location), track_index, location_index)
+                                for track_index, track in enumerate(self.tracks)
+                                for location_index, location in enumerate(face_locations)), reverse=True)
+
+        track_ids = [None] * len(face_locations)
+        used_tracks = set()
+
+        for iou, track_index, location_index in candidates:
+            if iou < self.min_iou:
+                break
+
+            if track_index in used_tracks or track_ids[location_index] is not None:
+                continue
+
+            used_tracks.add(track_index)
+            track_ids[location_index] = self.tracks[track_index][0]
+
+        self.tracks = []
+
+        for track_id, location in zip(track_ids, face_locations):
+            if track_id is None:
+                track_id = self.next_track_id
+                self.next_track_id += 1
+
+            top, right, bottom, left = location
+            opencv_tracker = create_opencv_tracker()
+            opencv_tracker.init(frame, (left, top, right - left, bottom - top))
+
+            self.tracks.append([track_id, location, opencv_tracker])
+
+        self.frames_since_keyframe = 0
+
+
+class LabelSmoother:
+    '''
+        Smooths the predicted emotion of every track with a majority vote over its last window predictions
+        This removes the single frame label flicker of the raw per-frame predictions
+        Only the history of tracks that are still alive is kept
+    '''
+
+    def __init__(self, window=LABEL_SMOOTHING_WINDOW):
+        self.window = window
+        self.history = {}
+
+    def smooth(self, track_ids, class_labels):
+        self.history = {track_id: self.history.get(track_id, deque(maxlen=self.window)) for track_id in track_ids}
+
+        smoothed_labels = []
+
+        for track_id, class_label in zip(track_ids, class_labels):
+            self.history[track_id].append(class_label)
+            smoothed_labels.append(Counter(self.history[track_id]).most_common(1)[0][0])
+
+        return smoothed_labels
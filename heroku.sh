@@ -1,3 +1,6 @@
 #!/bin/bash
-gunicorn app:app --daemon
+# Threads so that open event streams (jobs/<job_key>/events) don't block other requests, app.py keeps at most
+# EVENTS_MAX_STREAMS (8) of them open so that the other half of the threads is always left for the other routes
+# /api/predict runs the model from whichever thread serves the request, through face_detection.model_context()
+gunicorn app:app --daemon --worker-class gthread --threads 16
 python worker.py
\ No newline at end of file
@@ -0,0 +1,301 @@
+# Shared local inference server of the emotion model, selected on the workers with INFERENCE_BACKEND=remote.
+# Instead of every RQ worker process holding its own copy of the model and running it on the few faces of its current job,
+# the workers send their preprocessed faces to this server over a Unix socket (or localhost TCP). The server collects the
+# requests of all concurrent jobs into dynamic batches, bounded by INFERENCE_MAX_BATCH_SIZE faces and INFERENCE_MAX_WAIT seconds,
+# runs them through a single model and sends every worker back the class probabilities of its faces.
+#   python inference_server.py            (runs the model with INFERENCE_SERVER_BACKEND, "keras" or "tflite")
+# The RemoteModel client only depends on numpy and the standard library, so workers using it never import TensorFlow.
+#
+# Protocol, all integers are unsigned 32 bit big endian:
+#   request:  face count N, then N * 48 * 48 float32 pixels
+#   response: face count N, then N * 7 float32 class probabilities (N = ERROR_COUNT and a UTF-8 message length and message on errors)
+
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import numpy as np
+
+# "unix:<path>" or "<host>:<port>", shared by the server and the workers
+INFERENCE_SERVER_ADDRESS = os.getenv('INFERENCE_SERVER_ADDRESS', 'unix:/tmp/emotion-recognizer-inference.sock')
+# Backend the server runs the model with, see face_detection.load_model()
+INFERENCE_SERVER_BACKEND = os.getenv('INFERENCE_SERVER_BACKEND', 'keras')
+# A batch is run as soon as it holds this many faces...
+INFERENCE_MAX_BATCH_SIZE = int(os.getenv('INFERENCE_MAX_BATCH_SIZE', 64))
+# ...or this many seconds after its first request arrived, whichever comes first
+INFERENCE_MAX_WAIT = float(os.getenv('INFERENCE_MAX_WAIT', 0.005))
+# How often the server prints its batching statistics, in seconds
+STATS_INTERVAL = 60
+
+FACE_SHAPE = (48, 48, 1)
+CLASS_COUNT = 7
+ERROR_COUNT = 0xFFFFFFFF
+_HEADER = struct.Struct('!I')
+
+
+def parse_address(address):
+    '''
+        Returns (socket_family, address) of an INFERENCE_SERVER_ADDRESS
+    '''
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def _receive_exactly(connection, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+
+    while received < size:
+        count = connection.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError('Connection closed by the inference server')
+        received += count
+
+    return buffer
+
+
+def _receive_array(connection, item_shape):
+    '''
+        Reads a count header followed by that many float32 items of item_shape, returns None if the peer closed the connection
+    '''
+    header = connection.recv(_HEADER.size, socket.MSG_WAITALL)
+    if len(header) < _HEADER.size:
+        return None
+
+    count, = _HEADER.unpack(header)
+
+    if count == ERROR_COUNT:
+        length, = _HEADER.unpack(bytes(_receive_exactly(connection, _HEADER.size)))
+        raise RuntimeError('Inference server error: ' + bytes(_receive_exactly(connection, length)).decode())
+
+    data = _receive_exactly(connection, count * int(np.prod(item_shape)) * 4)
+    return np.frombuffer(data, dtype=np.float32).reshape((count,) + item_shape)
+
+
+def _send_array(connection, array):
+    connection.sendall(_HEADER.pack(len(array)) + np.ascontiguousarray(array, dtype=np.float32).tobytes())
+
+
+class RemoteModel:
+    '''
+        Client of the inference server with the predict() / predict_classes() interface of the Keras model,
+        so that the rest of the pipeline doesn't need to know where the model runs
+        Keeps one connection per process and reconnects once if the server was restarted in between
+
+        Parameters:
+            address: INFERENCE_SERVER_ADDRESS of the server
+    '''
+
+    def __init__(self, address=INFERENCE_SERVER_ADDRESS):
+        self.address = address
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        family, address = parse_address(self.address)
+        self.connection = socket.socket(family, socket.SOCK_STREAM)
+        self.connection.connect(address)
+
+    def predict(self, batch):
+        '''
+            Returns the class probabilities of a (N, 48, 48, 1) batch
+        '''
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self.connect()
+
+                    _send_array(self.connection, batch)
+                    probabilities = _receive_array(self.connection, (CLASS_COUNT,))
+
+                    if probabilities is None:
+                        raise ConnectionError('Connection closed by the inference server')
+
+                    return probabilities
+
+                except (ConnectionError, OSError):
+                    self.connection = None
+                    if attempt == 1:
+                        raise
+
+    def predict_classes(self, batch):
+        return self.predict(batch).argmax(axis=-1)
+
+
+class _Request:
+    def __init__(self, faces):
+        self.faces = faces
+        self.probabilities = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    '''
+        Runs the requests of all connections through the model in dynamic batches from a single thread
+        A batch is closed once it holds max_batch_size faces or max_wait seconds after its first request arrived
+        Requests are never split, a request that doesn't fit into the current batch starts the next one
+
+        Parameters:
+            model: Model with a predict() method
+            max_batch_size, max_wait: See INFERENCE_MAX_BATCH_SIZE and INFERENCE_MAX_WAIT
+            model_context: Context manager the model has to be run in (see face_detection.model_context)
+    '''
+
+    def __init__(self, model, max_batch_size=INFERENCE_MAX_BATCH_SIZE, max_wait=INFERENCE_MAX_WAIT, model_context=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.model_context = model_context
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.faces = 0
+
+    def predict(self, faces):
+        '''
+            Called from the connection threads, blocks until the probabilities of the faces were computed
+        '''
+        request = _Request(faces)
+        self.requests.put(request)
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.probabilities
+
+    def next_batch(self, pending):
+        '''
+            Collects the requests of the next batch, starting with the pending request left over from the last batch
+            Returns (batch, pending)
+        '''
+        batch = [pending if pending is not None else self.requests.get()]
+        face_count = len(batch[0].faces)
+        deadline = time.perf_counter() + self.max_wait
+
+        while face_count < self.max_batch_size:
+            try:
+                request = self.requests.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+
+            if face_count + len(request.faces) > self.max_batch_size:
+                return batch, request
+
+            batch.append(request)
+            face_count += len(request.faces)
+
+        return batch, None
+
+    def run(self):
+        pending = None
+
+        while True:
+            batch, pending = self.next_batch(pending)
+
+            try:
+                faces = np.concatenate([request.faces for request in batch])
+
+                if self.model_context is not None:
+                    with self.model_context():
+                        probabilities = self.model.predict(faces)
+                else:
+                    probabilities = self.model.predict(faces)
+
+                start = 0
+                for request in batch:
+                    request.probabilities = probabilities[start: start + len(request.faces)]
+                    start += len(request.faces)
+
+                self.batches += 1
+                self.faces += len(faces)
+
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+
+            for request in batch:
+                request.done.set()
+
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+    '''
+        Serves the requests of one worker connection, one after the other
+    '''
+
+    def handle(self):
+        while True:
+            faces = _receive_array(self.request, FACE_SHAPE)
+            if faces is None:
+                return
+
+            # Empty requests never reach the model
+            if len(faces) == 0:
+                _send_array(self.request, np.zeros((0, CLASS_COUNT), dtype=np.float32))
+                continue
+
+            try:
+                probabilities = self.server.batcher.predict(faces)
+            except Exception as e:
+                message = str(e).encode()
+                self.request.sendall(_HEADER.pack(ERROR_COUNT) + _HEADER.pack(len(message)) + message)
+                continue
+
+            _send_array(self.request, probabilities)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def print_stats(batcher):
+    while True:
+        time.sleep(STATS_INTERVAL)
+        if batcher.batches:
+            print('Inference server: %d batches, %.1f faces per batch' % (batcher.batches, batcher.faces / float(batcher.batches)))
+
+
+def serve(address=INFERENCE_SERVER_ADDRESS):
+    '''
+        Loads the model with INFERENCE_SERVER_BACKEND and serves it on address forever
+    '''
+    # The server is the only process that loads the model, so it is the one that pays for importing the inference stack
+    import face_detection
+    face_detection.INFERENCE_BACKEND = INFERENCE_SERVER_BACKEND
+    model = face_detection.warm_model()
+
+    batcher = MicroBatcher(model, model_context=face_detection.model_context)
+    threading.Thread(target=batcher.run, daemon=True).start()
+    threading.Thread(target=print_stats, args=(batcher,), daemon=True).start()
+
+    family, server_address = parse_address(address)
+
+    if family == socket.AF_UNIX:
+        # Left over from a previous run
+        if os.path.exists(server_address):
+            os.remove(server_address)
+        server = _UnixServer(server_address, _ConnectionHandler)
+    else:
+        server = _TCPServer(server_address, _ConnectionHandler)
+
+    server.batcher = batcher
+    print('Inference server listening on', address)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve()
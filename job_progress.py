@@ -0,0 +1,125 @@
+# Progress reporting of the jobs of a batch.
+# While a sub-job runs, face_detection reports every finished file and the frames read from the current video. The progress
+# (finished files, frames, ETA) is saved to the RQ job's meta and published on the Redis pub/sub channel of its batch, which the
+# /jobs/<job_key>/events route of app.py forwards to the browser as Server-Sent Events, so that it doesn't have to poll and
+# can show finished images before the rest of the batch is done.
+# Only depends on the standard library so that the web process can import it cheaply.
+
+import json
+import time
+
+# Pub/sub channel of a batch, every sub-job of the batch publishes its progress on it
+PROGRESS_CHANNEL = 'progress:%s'
+# Frame progress is published at most this often (in seconds), finished files are always published right away
+PROGRESS_INTERVAL = 0.5
+
+
+class ProgressReporter:
+    '''
+        Progress of a single sub-job
+
+        Parameters:
+            job: The RQ job, None if the pipeline was run outside of a worker
+            connection: Redis connection
+            batch_id: Id of the batch the job belongs to, None if it wasn't enqueued as part of a batch
+            files_total: Number of files the job processes
+    '''
+
+    def __init__(self, job, connection, batch_id, files_total):
+        self.job = job
+        self.connection = connection
+        self.batch_id = batch_id
+        self.files_total = files_total
+        self.files_done = []
+        self.frames_done = 0
+        self.frames_total = 0
+        self.start_time = time.time()
+        self.last_publish = 0.0
+
+    def eta(self):
+        '''
+            Estimated number of seconds until the job is done, extrapolated from the fraction of work done so far
+            Videos count as partly done by the fraction of their frames read, None until anything was done
+        '''
+        done = len(self.files_done)
+        if self.frames_total:
+            done += min(1.0, self.frames_done / float(self.frames_total))
+
+        if done == 0 or self.files_total == 0:
+            return None
+
+        fraction = done / float(self.files_total)
+        return (time.time() - self.start_time) * (1 - fraction) / fraction
+
+    def to_dict(self):
+        return {
+            "files_done": list(self.files_done),
+            "files_total": self.files_total,
+            "frames_done": self.frames_done,
+            "frames_total": self.frames_total,
+            "eta_seconds": self.eta()
+        }
+
+    def publish(self, force=False):
+        if not force and time.time() - self.last_publish < PROGRESS_INTERVAL:
+            return
+
+        self.last_publish = time.time()
+        progress = self.to_dict()
+
+        if self.job is not None:
+            self.job.meta['progress'] = progress
+            self.job.save_meta()
+
+        if self.batch_id is not None:
+            progress["job_id"] = self.job.get_id() if self.job is not None else None
+            self.connection.publish(PROGRESS_CHANNEL % self.batch_id, json.dumps(progress))
+
+    def start_video(self, frames_total):
+        self.frames_done = 0
+        self.frames_total = frames_total
+        self.publish(force=True)
+
+    def frame_read(self, frames_done):
+        self.frames_done = frames_done
+        self.publish()
+
+    def file_done(self, kind, filename):
+        self.files_done.append({"kind": kind, "filename": filename})
+        self.frames_done, self.frames_total = 0, 0
+        self.publish(force=True)
+
+
+# Reporter of the job running in this process, None outside of a job so that reporting is a no-op
+_reporter = None
+
+
+def start_job(job, connection, files_total):
+    '''
+        Starts reporting the progress of a new job and returns its reporter
+        The batch id is read from the job's meta, where enqueue_batch() of app.py put it
+    '''
+    global _reporter
+    batch_id = job.meta.get('batch_id') if job is not None else None
+    _reporter = ProgressReporter(job, connection, batch_id, files_total)
+    return _reporter
+
+
+def finish_job():
+    global _reporter
+    _reporter = None
+
+
+def start_video(frames_total):
+    if _reporter is not None:
+        _reporter.start_video(frames_total)
+
+
+def frame_read(frames_done):
+    if _reporter is not None:
+        _reporter.frame_read(frames_done)
+
+
+def file_done(kind, filename):
+    if _reporter is not None:
+        _reporter.file_done(kind, filename)
@@ -0,0 +1,142 @@
+# Redis protocol of the live streaming mode, shared by the web process (app.py) and the live worker (live_worker.py).
+# A stream reads frames either from the browser, which posts webcam frames to the web process, or from an RTSP URL
+# or a video file, which the live worker reads itself. Only the newest input frame of a stream is kept, so frames that arrive
+# while the worker is busy replace each other instead of queueing up, and the worker drops frames that are already older than
+# LIVE_LATENCY_TARGET when it gets to them. Every posted frame also pushes its stream id onto a list the worker blocks on,
+# so the worker doesn't have to poll idle streams. Annotated frames (JPEG) and their predictions (JSON) are published on pub/sub
+# channels of the stream, from which the web process streams them to the browser as MJPEG and Server-Sent Events.
+# Only depends on the standard library so that the web process can import it cheaply.
+
+import json
+import os
+import time
+import uuid
+
+# Frames older than this many seconds when the worker gets to them are dropped instead of processed
+LIVE_LATENCY_TARGET = float(os.getenv('LIVE_LATENCY_TARGET', 0.5))
+# Streams that nobody pushes frames to or watches for this many seconds are stopped
+STREAM_IDLE_TTL = 60
+
+# Source of streams whose frames are posted by the browser
+BROWSER_SOURCE = 'browser'
+
+STREAMS_KEY = 'live:streams'
+# List of the ids of the streams that got a new frame, the live worker blocks on it
+FRAME_READY_KEY = 'live:ready'
+SOURCE_KEY = 'live:%s:source'
+INPUT_KEY = 'live:%s:input'
+FRAMES_CHANNEL = 'live:%s:frames'
+RESULTS_CHANNEL = 'live:%s:results'
+
+
+def create_stream(connection, source):
+    '''
+        Registers a new stream for the live worker and returns its id
+
+        Parameters:
+            connection: Redis connection
+            source: BROWSER_SOURCE, an RTSP URL or the path of a video file
+    '''
+    stream_id = uuid.uuid4().hex
+
+    pipeline = connection.pipeline()
+    pipeline.set(SOURCE_KEY % stream_id, source, ex=STREAM_IDLE_TTL)
+    pipeline.sadd(STREAMS_KEY, stream_id)
+    pipeline.execute()
+
+    return stream_id
+
+
+def stream_source(connection, stream_id):
+    '''
+        Returns the source of the stream, None if it doesn't exist (anymore)
+    '''
+    source = connection.get(SOURCE_KEY % stream_id)
+    return source.decode() if source is not None else None
+
+
+def touch_stream(connection, stream_id):
+    '''
+        Keeps the stream alive for another STREAM_IDLE_TTL seconds, returns False if it doesn't exist anymore
+    '''
+    return bool(connection.expire(SOURCE_KEY % stream_id, STREAM_IDLE_TTL))
+
+
+def stop_stream(connection, stream_id):
+    pipeline = connection.pipeline()
+    pipeline.delete(SOURCE_KEY % stream_id, INPUT_KEY % stream_id)
+    pipeline.srem(STREAMS_KEY, stream_id)
+    pipeline.execute()
+
+
+def active_streams(connection):
+    '''
+        Returns {stream_id: source} of every stream that is still alive, streams that expired are removed
+    '''
+    stream_ids = [stream_id.decode() for stream_id in connection.smembers(STREAMS_KEY)]
+    if not stream_ids:
+        return {}
+
+    sources = connection.mget([SOURCE_KEY % stream_id for stream_id in stream_ids])
+    streams = {}
+
+    for stream_id, source in zip(stream_ids, sources):
+        if source is None:
+            connection.srem(STREAMS_KEY, stream_id)
+        else:
+            streams[stream_id] = source.decode()
+
+    return streams
+
+
+def push_frame(connection, stream_id, frame_bytes):
+    '''
+        Stores an encoded frame posted by the browser as the newest input frame of the stream, replacing any frame that
+        the worker hasn't taken yet. The arrival time is what the latency target is measured against
+    '''
+    pipeline = connection.pipeline()
+    pipeline.hset(INPUT_KEY % stream_id, mapping={"frame": frame_bytes, "time": time.time()})
+    pipeline.expire(INPUT_KEY % stream_id, STREAM_IDLE_TTL)
+    pipeline.expire(SOURCE_KEY % stream_id, STREAM_IDLE_TTL)
+    pipeline.rpush(FRAME_READY_KEY, stream_id)
+    # Doesn't pile up while no live worker is running
+    pipeline.expire(FRAME_READY_KEY, STREAM_IDLE_TTL)
+    pipeline.execute()
+
+
+def wait_for_frame(connection, timeout):
+    '''
+        Blocks until a browser stream got a new frame, returns its stream id or None after timeout seconds (an integer)
+        A stream id can be returned more than once for the same frame, pop_frame() then returns None
+    '''
+    item = connection.blpop(FRAME_READY_KEY, timeout=timeout)
+    return item[1].decode() if item is not None else None
+
+
+def pop_frame(connection, stream_id):
+    '''
+        Takes the newest input frame of the stream, returns (frame_bytes, arrival_time) or None if there is no new frame
+    '''
+    pipeline = connection.pipeline()
+    pipeline.hgetall(INPUT_KEY % stream_id)
+    pipeline.delete(INPUT_KEY % stream_id)
+    item, _ = pipeline.execute()
+
+    if not item:
+        return None
+
+    return item[b'frame'], float(item[b'time'])
+
+
+def is_stale(arrival_time, now=None):
+    return (now or time.time()) - arrival_time > LIVE_LATENCY_TARGET
+
+
+def publish_output(connection, stream_id, jpeg_bytes, result):
+    '''
+        Publishes an annotated frame and its predictions to whoever is watching the stream
+    '''
+    pipeline = connection.pipeline()
+    pipeline.publish(FRAMES_CHANNEL % stream_id, jpeg_bytes)
+    pipeline.publish(RESULTS_CHANNEL % stream_id, json.dumps(result))
+    pipeline.execute()
@@ -0,0 +1,270 @@
+# Dedicated worker of the live streaming mode (see live_stream.py).
+# Keeps a warm model and serves every active stream: takes the newest frame of each stream, drops it if it is already older
+# than LIVE_LATENCY_TARGET, otherwise detects and classifies its faces and publishes the annotated frame and the predictions.
+#   python live_worker.py                                  (serves the streams started on the /live page)
+#   python live_worker.py --source video.mp4               (plays a prerecorded video as a live source and reports latencies)
+#   python live_worker.py --source video.mp4 --output out.webm
+
+import argparse
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import face_detection
+import live_stream
+import video_encoding
+
+# How long run_local() sleeps when its source had no new frame, in seconds
+IDLE_SLEEP = 0.01
+# How often serve() reads the list of active streams, in seconds (an integer, it is also the timeout of the blocking wait for frames)
+STREAMS_REFRESH_INTERVAL = 1
+
+
+class CaptureSource(threading.Thread):
+    '''
+        Reads an RTSP stream or a video file in its own thread and only keeps the newest frame, so that a slow consumer
+        always gets the most recent frame instead of a backlog. Video files are played at their own FPS, as if they were live
+
+        Parameters:
+            source: RTSP URL or path of a video file
+            on_frame: Called without arguments whenever a new frame arrived and once the source ended
+    '''
+
+    def __init__(self, source, on_frame=None):
+        super().__init__(daemon=True)
+        self.source = source
+        self.on_frame = on_frame
+        self.lock = threading.Lock()
+        self.frame = None
+        self.arrival_time = None
+        self.frames_read = 0
+        self.ended = threading.Event()
+
+    def run(self):
+        capture = cv2.VideoCapture(self.source)
+        is_file = not self.source.startswith(('rtsp://', 'rtsps://'))
+        frame_interval = 1.0 / (capture.get(cv2.CAP_PROP_FPS) or face_detection.DEFAULT_VIDEO_FPS)
+        next_frame_time = time.time()
+
+        while not self.ended.is_set():
+            ret, frame = capture.read()
+            if ret is False:
+                break
+
+            if is_file:
+                next_frame_time += frame_interval
+                time.sleep(max(0.0, next_frame_time - time.time()))
+
+            with self.lock:
+                self.frame, self.arrival_time = frame, time.time()
+                self.frames_read += 1
+
+            if self.on_frame is not None:
+                self.on_frame()
+
+        capture.release()
+        self.ended.set()
+
+        if self.on_frame is not None:
+            self.on_frame()
+
+    def latest(self):
+        '''
+            Takes the newest frame, returns (frame, arrival_time) or None if no frame arrived since the last call
+        '''
+        with self.lock:
+            if self.frame is None:
+                return None
+
+            item = self.frame, self.arrival_time
+            self.frame = None
+            return item
+
+    def stop(self):
+        self.ended.set()
+
+
+class LatencyStats:
+    '''
+        Counts processed and dropped frames and the latency from the arrival of a frame until its result is published
+    '''
+
+    def __init__(self):
+        self.latencies = []
+        self.dropped = 0
+
+    def summary(self):
+        latencies = np.array(self.latencies or [0.0]) * 1000
+        return 'processed %d, dropped %d, latency p50 %.1f ms, p99 %.1f ms, max %.1f ms' % (
+            len(self.latencies), self.dropped, np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.max())
+
+
+def process_frame(frame, model):
+    '''
+        Detects and classifies the faces of a frame, returns (faces, annotated_frame) in the format of the /api/predict route
+    '''
+    results, annotated_frames = face_detection.predict_images([frame], model, annotate=True)
+    return results[0], annotated_frames[0]
+
+
+def wait_for_browser_frames(connection, ready):
+    '''
+        Forwards the ids of the browser streams that got a new frame to the ready queue, runs in its own thread
+    '''
+    while True:
+        stream_id = live_stream.wait_for_frame(connection, STREAMS_REFRESH_INTERVAL)
+        if stream_id is not None:
+            ready.put(stream_id)
+
+
+def serve(connection):
+    '''
+        Serves the streams registered in Redis forever
+        Blocks until a stream has a new frame: browser streams are signalled through Redis (see live_stream.wait_for_frame()),
+        capture sources by their thread, so idle streams cost nothing
+    '''
+    model = face_detection.warm_model()
+    captures = {}
+    stats = {}
+    streams = {}
+    # Ids of the streams that (probably) have a new frame
+    ready = queue.Queue()
+
+    def refresh_streams():
+        streams.clear()
+        streams.update(live_stream.active_streams(connection))
+
+        # Stop reading sources of streams that were stopped or expired
+        for stream_id in set(captures) | set(stats):
+            if stream_id not in streams:
+                if stream_id in captures:
+                    captures.pop(stream_id).stop()
+                print('Stream', stream_id, 'ended:', stats.pop(stream_id, LatencyStats()).summary())
+
+        # Start reading the sources of new streams, they signal their frames themselves
+        for stream_id, source in streams.items():
+            if source != live_stream.BROWSER_SOURCE and stream_id not in captures:
+                captures[stream_id] = CaptureSource(source, on_frame=lambda stream_id=stream_id: ready.put(stream_id))
+                captures[stream_id].start()
+
+    threading.Thread(target=wait_for_browser_frames, args=(connection, ready), daemon=True).start()
+    last_refresh = 0
+
+    while True:
+        if time.time() - last_refresh >= STREAMS_REFRESH_INTERVAL:
+            refresh_streams()
+            last_refresh = time.time()
+
+        try:
+            stream_id = ready.get(timeout=STREAMS_REFRESH_INTERVAL)
+        except queue.Empty:
+            continue
+
+        # Streams started since the streams were last read
+        if stream_id not in streams:
+            refresh_streams()
+            last_refresh = time.time()
+
+        source = streams.get(stream_id)
+
+        if source is None:
+            continue
+
+        if source == live_stream.BROWSER_SOURCE:
+            item = live_stream.pop_frame(connection, stream_id)
+            if item is not None:
+                item = face_detection.decode_image(item[0]), item[1]
+        else:
+            item = captures[stream_id].latest()
+
+            # The stream ends with its video file
+            if item is None and captures[stream_id].ended.is_set():
+                live_stream.stop_stream(connection, stream_id)
+
+        if item is None or item[0] is None:
+            continue
+
+        frame, arrival_time = item
+        stream_stats = stats.setdefault(stream_id, LatencyStats())
+
+        if live_stream.is_stale(arrival_time):
+            stream_stats.dropped += 1
+            continue
+
+        faces, annotated_frame = process_frame(frame, model)
+        latency = time.time() - arrival_time
+        stream_stats.latencies.append(latency)
+
+        live_stream.publish_output(connection, stream_id, face_detection.encode_image(annotated_frame),
+                                   {"faces": faces, "latency_ms": round(latency * 1000, 1), "dropped": stream_stats.dropped})
+
+
+def run_local(source, output_file=None):
+    '''
+        Plays a video file (or RTSP URL) as a live source through the same drop and process loop as serve(), without Redis
+        Annotated frames are written to output_file if given. Returns the LatencyStats
+    '''
+    model = face_detection.warm_model()
+    capture = CaptureSource(source)
+    capture.start()
+
+    stats = LatencyStats()
+    output_video = None
+
+    while True:
+        item = capture.latest()
+
+        if item is None:
+            # Checked again after the source ended, its last frame may have arrived in between
+            if capture.ended.is_set():
+                item = capture.latest()
+                if item is None:
+                    break
+            else:
+                time.sleep(IDLE_SLEEP)
+                continue
+
+        frame, arrival_time = item
+
+        if live_stream.is_stale(arrival_time):
+            stats.dropped += 1
+            continue
+
+        faces, annotated_frame = process_frame(frame, model)
+        stats.latencies.append(time.time() - arrival_time)
+
+        if output_file is not None:
+            if output_video is None:
+                size = (annotated_frame.shape[1], annotated_frame.shape[0])
+                output_video = video_encoding.create_video_writer(output_file, face_detection.DEFAULT_VIDEO_FPS, size)
+            output_video.write(annotated_frame)
+
+    if output_video is not None:
+        output_video.release()
+
+    # Frames the source replaced before they were taken never reached the loop, they count as dropped too
+    stats.dropped = capture.frames_read - len(stats.latencies)
+
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Live streaming worker')
+    parser.add_argument('--source', help='Play this video file (or RTSP URL) as a live source locally instead of serving the web app')
+    parser.add_argument('--output', help='With --source, write the annotated frames to this video file')
+    args = parser.parse_args(argv)
+
+    if args.source:
+        print(run_local(args.source, args.output).summary())
+        return
+
+    # Imported here so that local runs don't need Redis
+    from worker import conn
+    serve(conn)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,538 @@
+# End to end load test of the web app and its RQ workers, fully offline on one machine.
+# Starts a throwaway local redis-server (or uses an existing Redis with --redis-url), --workers worker.py processes and the Flask
+# app in a server with --web-threads threads (as many as gunicorn runs, see heroku.sh), then simulates --sessions concurrent users.
+# Every session uploads mixed batches of images and videos through /uploads, starts them with /jobs, follows them through the
+# /jobs/<job_key>/events stream (or polls /jobs/<job_key> once the server refuses the stream) until they are done and loads
+# /results and the output files, just like the browser does. With more sessions than EVENTS_MAX_STREAMS this shows that open
+# event streams don't starve the other routes of threads. Reports end-to-end latency percentiles, queue wait per queue,
+# worker utilization, refused event streams and error rates.
+# With --fake-redis, Redis is replaced by fakeredis and the app and a single worker thread share this process instead.
+#   python loadtest.py --sessions 20 --workers 4
+#   python loadtest.py --sessions 32 --web-threads 16
+#   python loadtest.py --media samples/ --sessions 50 --batches 3 --images 4 --videos 1 --output loadtest.json
+
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+import bulk_process
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# How often a session polls the status of its batch, in seconds (the same as the home page does)
+POLL_INTERVAL = 0.25
+# A batch that isn't done after this many seconds counts as an error
+BATCH_TIMEOUT = 600
+# Timeout of a single HTTP request, in seconds
+REQUEST_TIMEOUT = 60
+# How long the workers may take to load their models before the test gives up, in seconds
+STARTUP_TIMEOUT = 300
+# Number of threads of the web server, the same as gunicorn's --threads in heroku.sh
+WEB_THREADS = 16
+
+# Synthetic media generated when no --media directory is given
+SYNTHETIC_SIZE = (640, 480)
+SYNTHETIC_IMAGE_FACES = (1, 2, 4)
+SYNTHETIC_VIDEO_FRAMES = (45, 150)
+SYNTHETIC_VIDEO_FPS = 15.0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_redis_server(log_dir):
+    '''
+        Starts a local redis-server without persistence on a free port, returns (process, url)
+    '''
+    port = free_port()
+    log = open(os.path.join(log_dir, 'redis.log'), 'w')
+
+    try:
+        process = subprocess.Popen(['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+                                   stdout=log, stderr=subprocess.STDOUT)
+    except OSError:
+        sys.exit('redis-server was not found, install it, pass --redis-url or use --fake-redis')
+
+    return process, 'redis://127.0.0.1:%d' % port
+
+
+def wait_for_redis(connection, timeout=10):
+    deadline = time.time() + timeout
+
+    while True:
+        try:
+            return connection.ping()
+        except Exception:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def make_media(media_dir):
+    '''
+        Writes synthetic images and short videos with faces tiled from the benchmark's face image (see benchmark.py) to media_dir
+    '''
+    # Imported here since it loads the inference stack, which isn't needed when real media is given
+    import cv2
+    import benchmark
+
+    face = benchmark.load_face()
+    width, height = SYNTHETIC_SIZE
+
+    for face_count in SYNTHETIC_IMAGE_FACES:
+        frame, _ = benchmark.make_frame(width, height, face_count, face)
+        cv2.imwrite(os.path.join(media_dir, 'faces_%d.jpg' % face_count), frame)
+
+    for frame_count in SYNTHETIC_VIDEO_FRAMES:
+        video = cv2.VideoWriter(os.path.join(media_dir, 'clip_%d.avi' % frame_count), cv2.VideoWriter_fourcc(*'MJPG'),
+                                SYNTHETIC_VIDEO_FPS, (width, height))
+        for index in range(frame_count):
+            video.write(benchmark.make_frame(width, height, 2, face, index)[0])
+        video.release()
+
+
+def load_media(media_dir):
+    '''
+        Returns {"image": [paths], "video": [paths]} of the media files under media_dir
+    '''
+    media = {"image": [], "video": []}
+
+    for relative_path, kind in bulk_process.find_files(media_dir):
+        media[kind].append(os.path.join(media_dir, relative_path))
+
+    return media
+
+
+def start_worker_processes(count, redis_url, env, log_dir):
+    '''
+        Starts count worker.py processes, exactly as they run in production, logging to log_dir
+    '''
+    env = dict(env, REDISTOGO_URL=redis_url)
+    processes = []
+
+    for index in range(count):
+        log = open(os.path.join(log_dir, 'worker-%d.log' % index), 'w')
+        processes.append(subprocess.Popen([sys.executable, 'worker.py'], cwd=APP_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT))
+
+    return processes
+
+
+def start_worker_thread(connection):
+    '''
+        Runs a single RQ worker in a thread of this process, for --fake-redis where Redis only exists in this process
+        Only one, since the pipeline keeps the metrics and progress of the current job per process, like every SimpleWorker does
+    '''
+    from rq import Queue, SimpleWorker
+    from rq.timeouts import BaseDeathPenalty
+    import face_detection
+    import worker
+
+    class NoDeathPenalty(BaseDeathPenalty):
+        # Job timeouts rely on signals, which only the main thread receives
+        def setup_death_penalty(self):
+            pass
+
+        def cancel_death_penalty(self):
+            pass
+
+    class ThreadWorker(SimpleWorker):
+        death_penalty_class = NoDeathPenalty
+
+        def _install_signal_handlers(self):
+            pass
+
+    def work():
+        # Warmed in the thread that runs the jobs, which doesn't rely on model_context() to find the model's session
+        face_detection.warm_model()
+        ThreadWorker([Queue(name, connection=connection) for name in worker.listen], connection=connection).work()
+
+    threading.Thread(target=work, daemon=True).start()
+
+
+def wait_for_workers(connection, count, processes, log_dir):
+    '''
+        Waits until count workers registered with Redis, i.e., finished warming up their models
+    '''
+    from rq import Worker
+
+    deadline = time.time() + STARTUP_TIMEOUT
+
+    while len(Worker.all(connection=connection)) < count:
+        if any(process.poll() is not None for process in processes):
+            sys.exit('A worker exited during startup, see the logs in ' + log_dir)
+        if time.time() > deadline:
+            sys.exit('The workers didn\'t start within %d seconds, see the logs in %s' % (STARTUP_TIMEOUT, log_dir))
+        time.sleep(0.5)
+
+
+def start_web_server(flask_app, threads):
+    '''
+        Serves the app from a server with a fixed number of threads in a background thread, returns (server, base_url)
+        Like gunicorn's gthread workers, requests wait for a free thread, so requests that hold on to a thread show up
+        as latency of the other requests
+    '''
+    from werkzeug.serving import BaseWSGIServer
+
+    class PooledWSGIServer(BaseWSGIServer):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.executor = ThreadPoolExecutor(threads)
+
+        def process_request(self, request, client_address):
+            self.executor.submit(self.process_request_thread, request, client_address)
+
+        def process_request_thread(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    # One log line per request would drown the report
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    server = PooledWSGIServer('127.0.0.1', free_port(), flask_app)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+class StageError(Exception):
+    '''
+        Failure of one stage ("home", "upload", "jobs", "events", "poll", "job", "timeout", "results" or "files") of a session's batch
+    '''
+
+    def __init__(self, stage, message):
+        super().__init__(message)
+        self.stage = stage
+
+
+def check(response, stage):
+    if response.status_code >= 400:
+        raise StageError(stage, 'HTTP %d' % response.status_code)
+    return response
+
+
+def follow_events(http, base_url, batch_id, uploaded, record):
+    '''
+        Follows a batch through its event stream until it finished or failed and returns its last status
+        Reconnects whenever the server closes the stream like EventSource does, returns None if the server refused the stream
+        (503), the browser polls then
+    '''
+    while True:
+        with http.get(base_url + '/jobs/%s/events' % batch_id, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            if response.status_code == 503:
+                record['events_refused'] = True
+                return None
+            check(response, 'events')
+
+            for line in response.iter_lines():
+                if not line.startswith(b'data: '):
+                    continue
+
+                data = json.loads(line[len(b'data: '):].decode())
+                if data['job_status'] in ('finished', 'failed'):
+                    return data
+
+        if time.time() - uploaded > BATCH_TIMEOUT:
+            raise StageError('timeout', 'Batch %s not done after %d seconds' % (batch_id, BATCH_TIMEOUT))
+
+
+def poll_status(http, base_url, batch_id, uploaded):
+    '''
+        Polls the status of a batch until it finished or failed and returns its last status
+    '''
+    while True:
+        data = check(http.get(base_url + '/jobs/' + batch_id, timeout=REQUEST_TIMEOUT), 'poll').json()['data']
+
+        if data['job_status'] in ('finished', 'failed'):
+            return data
+        if time.time() - uploaded > BATCH_TIMEOUT:
+            raise StageError('timeout', 'Batch %s not done after %d seconds' % (batch_id, BATCH_TIMEOUT))
+
+        time.sleep(POLL_INTERVAL)
+
+
+def run_batch(http, base_url, image_paths, video_paths, video_file_type, record, events=True):
+    '''
+        Runs one batch through the same routes as the browser and adds its batch id and timings to record
+        The batch is followed through its event stream if events is True, else (or if the stream is refused) it is polled
+        Raises StageError if any stage fails
+    '''
+    start = time.time()
+    check(http.get(base_url + '/', timeout=REQUEST_TIMEOUT), 'home')
+
+    for path in image_paths + video_paths:
+        with open(path, 'rb') as f:
+            check(http.post(base_url + '/uploads', files={'file': (os.path.basename(path), f)}, timeout=REQUEST_TIMEOUT), 'upload')
+
+    uploaded = time.time()
+
+    response = http.post(base_url + '/jobs', timeout=REQUEST_TIMEOUT, allow_redirects=False)
+    if response.status_code != 202:
+        raise StageError('jobs', 'HTTP %d' % response.status_code)
+    batch_id = record['batch_id'] = response.json()['job_id']
+
+    data = follow_events(http, base_url, batch_id, uploaded, record) if events else None
+    if data is None:
+        data = poll_status(http, base_url, batch_id, uploaded)
+
+    if data['job_status'] == 'failed':
+        raise StageError('job', 'Batch %s failed' % batch_id)
+
+    processed = time.time()
+
+    check(http.get(base_url + '/results', timeout=REQUEST_TIMEOUT), 'results')
+    for filename in data['job_result']['image_filenames']:
+        check(http.get(base_url + '/results/image/' + filename, timeout=REQUEST_TIMEOUT), 'files')
+    for filename in data['job_result']['video_filenames']:
+        check(http.get(base_url + '/results/%s/%s' % (video_file_type, filename), timeout=REQUEST_TIMEOUT), 'files')
+
+    done = time.time()
+
+    record.update(upload_s=uploaded - start, processing_s=processed - uploaded, results_s=done - processed, latency_s=done - start)
+
+
+def run_session(index, base_url, media, args, video_file_type, records):
+    '''
+        One simulated user, runs args.batches batches one after the other and appends a record per batch to records
+    '''
+    rng = random.Random(args.seed + index)
+    time.sleep(rng.uniform(0, args.ramp_up))
+
+    # Every session has its own cookies, i.e., its own user_uuid
+    http = requests.Session()
+
+    for batch in range(args.batches):
+        image_paths = [rng.choice(media['image']) for _ in range(args.images)] if media['image'] else []
+        video_paths = [rng.choice(media['video']) for _ in range(args.videos)] if media['video'] else []
+        record = {"session": index, "batch": batch, "images": len(image_paths), "videos": len(video_paths), "batch_id": None,
+                  "events_refused": False, "error": None}
+        start = time.time()
+
+        try:
+            run_batch(http, base_url, image_paths, video_paths, video_file_type, record, not args.poll)
+        except StageError as e:
+            record.update(error=e.stage, message=str(e), latency_s=time.time() - start)
+        except requests.RequestException as e:
+            record.update(error='connection', message=str(e), latency_s=time.time() - start)
+
+        records.append(record)
+
+
+def fetch_jobs(connection, batch_ids):
+    '''
+        Returns the sub-jobs of the given batches that still exist
+    '''
+    from rq.job import Job
+    import app
+
+    job_ids = [job_id.decode() for batch_id in batch_ids for job_id in connection.lrange(app.BATCH_KEY_PREFIX + batch_id, 0, -1)]
+    return [job for job in Job.fetch_many(job_ids, connection=connection) if job is not None]
+
+
+def percentiles(values):
+    if not values:
+        return None
+
+    values = np.array(values)
+    return {
+        "count": len(values),
+        "mean_s": float(values.mean()),
+        "p50_s": float(np.percentile(values, 50)),
+        "p90_s": float(np.percentile(values, 90)),
+        "p99_s": float(np.percentile(values, 99)),
+        "max_s": float(values.max())
+    }
+
+
+def summarize(records, jobs, worker_count, wall_time):
+    '''
+        Latency percentiles of the successful batches, error rates per stage, queue wait per queue and worker utilization
+    '''
+    succeeded = [record for record in records if record['error'] is None]
+    errors = {}
+    for record in records:
+        if record['error'] is not None:
+            errors[record['error']] = errors.get(record['error'], 0) + 1
+
+    queue_waits, busy_time = {}, 0.0
+    for job in jobs:
+        if job.started_at is None:
+            continue
+        queue_waits.setdefault(job.origin, []).append((job.started_at - job.enqueued_at).total_seconds())
+        if job.ended_at is not None:
+            busy_time += (job.ended_at - job.started_at).total_seconds()
+
+    return {
+        "batches": len(records),
+        "wall_time_s": wall_time,
+        "throughput_batches_per_s": len(succeeded) / wall_time if wall_time > 0 else None,
+        "error_rate": (len(records) - len(succeeded)) / float(len(records)) if records else None,
+        "errors": errors,
+        "events_refused": sum(record['events_refused'] for record in records),
+        "latency": {stage: percentiles([record[stage] for record in succeeded])
+                    for stage in ('latency_s', 'upload_s', 'processing_s', 'results_s')},
+        "queue_wait": {queue: percentiles(waits) for queue, waits in sorted(queue_waits.items())},
+        "jobs": len(jobs),
+        "jobs_failed": sum(job.get_status() == 'failed' for job in jobs),
+        "worker_utilization": busy_time / (worker_count * wall_time) if wall_time > 0 else None
+    }
+
+
+def print_summary(summary):
+    def row(name, stats):
+        if stats is None:
+            print('  %-16s -' % name)
+        else:
+            print('  %-16s p50 %8.2f s   p90 %8.2f s   p99 %8.2f s   max %8.2f s   (%d)' % (
+                name, stats['p50_s'], stats['p90_s'], stats['p99_s'], stats['max_s'], stats['count']))
+
+    print('%d batches in %.1f s, %.3f batches/s, error rate %.1f%% %s' % (
+        summary['batches'], summary['wall_time_s'], summary['throughput_batches_per_s'] or 0,
+        (summary['error_rate'] or 0) * 100, summary['errors'] or ''))
+
+    print('%d batches were polled since the server refused their event stream' % summary['events_refused'])
+
+    print('End to end latency of successful batches:')
+    for stage, stats in summary['latency'].items():
+        row(stage[:-2], stats)
+
+    print('Queue wait of %d sub-jobs (%d failed):' % (summary['jobs'], summary['jobs_failed']))
+    for queue, stats in summary['queue_wait'].items():
+        row(queue, stats)
+
+    print('Worker utilization: %.1f%%' % ((summary['worker_utilization'] or 0) * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End to end load test of the web app and its workers')
+    parser.add_argument('--sessions', type=int, default=10, help='Number of concurrent simulated users')
+    parser.add_argument('--batches', type=int, default=1, help='Number of batches every session uploads, one after the other')
+    parser.add_argument('--images', type=int, default=3, help='Number of images per batch')
+    parser.add_argument('--videos', type=int, default=1, help='Number of videos per batch')
+    parser.add_argument('--workers', type=int, default=2, help='Number of worker.py processes')
+    parser.add_argument('--web-threads', type=int, default=WEB_THREADS, help='Number of threads of the web server')
+    parser.add_argument('--poll', action='store_true', help='Poll the status of the batches instead of following their event streams')
+    parser.add_argument('--media', help='Directory of sample images and videos, synthetic ones are generated if not given')
+    parser.add_argument('--ramp-up', type=float, default=0.0, help='Sessions start at random times within this many seconds')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random choice of files per batch')
+    parser.add_argument('--redis-url', help='Use this Redis instead of starting a local redis-server (its queues should be empty)')
+    parser.add_argument('--fake-redis', action='store_true', help='Use fakeredis with the app and a single worker in this process')
+    parser.add_argument('--use-cache', action='store_true', help='Let the workers use the result cache (off so that repeated files are processed)')
+    parser.add_argument('--output', help='JSON file the summary and the records of every batch are written to')
+    args = parser.parse_args(argv)
+
+    log_dir = tempfile.mkdtemp(prefix='loadtest-')
+
+    # Inherited by the worker processes and read by the modules imported below
+    if not args.use_cache:
+        os.environ['RESULT_CACHE'] = 'false'
+
+    media_dir = args.media
+    if media_dir is None:
+        media_dir = os.path.join(log_dir, 'media')
+        os.makedirs(media_dir)
+        make_media(media_dir)
+
+    media = load_media(os.path.abspath(media_dir))
+    if not media['image'] and not media['video']:
+        sys.exit('No images or videos found in ' + media_dir)
+
+    redis_process, worker_processes = None, []
+
+    if args.fake_redis:
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit('--fake-redis needs the fakeredis package, pip install fakeredis')
+
+        # Replaced before app is imported, so that the app, its queues and the worker thread all share it
+        import worker
+        worker.conn = fakeredis.FakeStrictRedis()
+        connection = worker.conn
+        worker_count = 1
+    else:
+        redis_url = args.redis_url
+        if redis_url is None:
+            redis_process, redis_url = start_redis_server(log_dir)
+
+        os.environ['REDISTOGO_URL'] = redis_url
+        import worker
+        connection = worker.conn
+        wait_for_redis(connection)
+        worker_count = args.workers
+
+    # The app reads its Redis connection from worker.py when it is imported, i.e., only now
+    os.chdir(APP_ROOT)
+    import app
+    import upload_manifest
+
+    server = None
+
+    try:
+        if args.fake_redis:
+            start_worker_thread(connection)
+        else:
+            worker_processes = start_worker_processes(worker_count, redis_url, os.environ, log_dir)
+
+        print('Waiting for %d workers to warm up (logs in %s)' % (worker_count, log_dir))
+        wait_for_workers(connection, worker_count, worker_processes, log_dir)
+
+        server, base_url = start_web_server(app.app, args.web_threads)
+        video_file_type = 'timeline' if upload_manifest.VIDEO_OUTPUT_MODE == 'annotations' else 'video'
+
+        print('Running %d sessions of %d batches (%d images, %d videos) against %s' % (
+            args.sessions, args.batches, args.images, args.videos, base_url))
+
+        records = []
+        sessions = [threading.Thread(target=run_session, args=(index, base_url, media, args, video_file_type, records))
+                    for index in range(args.sessions)]
+
+        start = time.time()
+        for session in sessions:
+            session.start()
+        for session in sessions:
+            session.join()
+        wall_time = time.time() - start
+
+        jobs = fetch_jobs(connection, [record['batch_id'] for record in records if record['batch_id']])
+        summary = summarize(records, jobs, worker_count, wall_time)
+
+    finally:
+        if server is not None:
+            server.shutdown()
+        for process in worker_processes:
+            process.terminate()
+        if redis_process is not None:
+            redis_process.terminate()
+
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"settings": vars(args), "summary": summary, "records": records}, f, indent=2)
+        print('Results written to', args.output)
+
+    if summary['error_rate']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+# Timing instrumentation of the prediction pipeline.
+# Stages of face_detection are wrapped in timed(stage), which records latency histograms and counters for the job currently running
+# in this process. When a job ends, successfully or not, its metrics are attached to the RQ job's meta and added to totals
+# kept in Redis under the job's outcome, which the /metrics route of app.py renders in the Prometheus text format.
+# Only depends on the standard library so that the web process can import it cheaply.
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Stages of the pipeline that are timed, "job" is the whole job from start_job() to finish_job()
+STAGES = ('decode', 'detect', 'predict', 'annotate', 'encode', 'file_io', 'job')
+# How a job ended, every metric of a job is recorded under its outcome
+OUTCOMES = ('success', 'failed', 'timeout')
+# Upper bounds (in seconds) of the latency histogram buckets
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+# Redis hashes holding the totals over all jobs
+STAGES_KEY = 'metrics:stages'
+COUNTERS_KEY = 'metrics:counters'
+# Prefix of every metric name exposed on /metrics
+METRIC_PREFIX = 'emotion_recognizer_'
+
+
+class MetricsRecorder:
+    '''
+        Latency histograms per stage and plain counters (frames, faces, ...) of a single job
+        Thread safe, since the stages of the pipelined video mode record from their own threads
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = {"count": 0, "sum": 0.0, "buckets": [0] * len(HISTOGRAM_BUCKETS)}
+
+            stage_metrics = self.stages[stage]
+            stage_metrics["count"] += 1
+            stage_metrics["sum"] += seconds
+
+            for index, upper_bound in enumerate(HISTOGRAM_BUCKETS):
+                if seconds <= upper_bound:
+                    stage_metrics["buckets"][index] += 1
+                    break
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def merge(self, stages, counters):
+        '''
+            Adds the raw stages and counters of another recorder, e.g., one that ran in a segment process of face_detection
+        '''
+        with self.lock:
+            for stage, metrics in stages.items():
+                if stage not in self.stages:
+                    self.stages[stage] = {"count": 0, "sum": 0.0, "buckets": [0] * len(HISTOGRAM_BUCKETS)}
+
+                stage_metrics = self.stages[stage]
+                stage_metrics["count"] += metrics["count"]
+                stage_metrics["sum"] += metrics["sum"]
+                stage_metrics["buckets"] = [own + other for own, other in zip(stage_metrics["buckets"], metrics["buckets"])]
+
+            for counter, value in counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def to_dict(self):
+        '''
+            JSON serializable summary of the job, this is what ends up in the RQ job's meta
+        '''
+        with self.lock:
+            return {
+                "stages": {stage: {"count": metrics["count"], "seconds": metrics["sum"]} for stage, metrics in self.stages.items()},
+                "counters": dict(self.counters)
+            }
+
+
+# Recorder of the job running in this process, replaced by start_job()
+_recorder = MetricsRecorder()
+
+
+def start_job():
+    '''
+        Starts recording the metrics of a new job and returns its recorder
+    '''
+    global _recorder
+    _recorder = MetricsRecorder()
+    return _recorder
+
+
+def current_recorder():
+    return _recorder
+
+
+@contextmanager
+def timed(stage):
+    '''
+        Context manager that records how long its block took under the given stage of the current job
+    '''
+    recorder = _recorder
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        recorder.observe(stage, time.perf_counter() - start)
+
+
+def increment(counter, value=1):
+    _recorder.increment(counter, value)
+
+
+def finish_job(recorder, job, connection, outcome='success'):
+    '''
+        Attaches the metrics of a job that ended to its meta and adds them to the totals in Redis under its outcome
+        Must also be called for jobs that failed or timed out, otherwise they never show up on /metrics
+
+        Parameters:
+            recorder: MetricsRecorder returned by start_job()
+            job: The RQ job, None if the pipeline was run outside of a worker (then only the Redis totals are updated)
+            connection: Redis connection
+            outcome: One of OUTCOMES
+    '''
+    recorder.observe('job', time.perf_counter() - recorder.start)
+
+    if job is not None:
+        job.meta['metrics'] = dict(recorder.to_dict(), outcome=outcome)
+        job.save_meta()
+
+    pipeline = connection.pipeline()
+
+    with recorder.lock:
+        for stage, metrics in recorder.stages.items():
+            pipeline.hincrby(STAGES_KEY, '%s:%s:count' % (stage, outcome), metrics["count"])
+            pipeline.hincrbyfloat(STAGES_KEY, '%s:%s:sum' % (stage, outcome), metrics["sum"])
+
+            for upper_bound, bucket_count in zip(HISTOGRAM_BUCKETS, metrics["buckets"]):
+                if bucket_count:
+                    pipeline.hincrby(STAGES_KEY, '%s:%s:bucket:%s' % (stage, outcome, upper_bound), bucket_count)
+
+        for counter, value in recorder.counters.items():
+            pipeline.hincrby(COUNTERS_KEY, '%s:%s' % (counter, outcome), value)
+
+    pipeline.hincrby(COUNTERS_KEY, 'jobs:' + outcome, 1)
+    pipeline.execute()
+
+
+def _format_bound(upper_bound):
+    return '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+
+
+def render_prometheus(connection):
+    '''
+        Renders the totals over all jobs in the Prometheus text exposition format
+    '''
+    stages = {key.decode(): float(value) for key, value in connection.hgetall(STAGES_KEY).items()}
+    counters = {}
+    for key, value in connection.hgetall(COUNTERS_KEY).items():
+        counter, _, outcome = key.decode().partition(':')
+        counters.setdefault(counter, {})[outcome] = int(value)
+
+    histogram = METRIC_PREFIX + 'stage_duration_seconds'
+    lines = [
+        '# HELP %s Time spent in each stage of the prediction pipeline' % histogram,
+        '# TYPE %s histogram' % histogram
+    ]
+
+    for stage in STAGES:
+        for outcome in OUTCOMES:
+            prefix = '%s:%s:' % (stage, outcome)
+            if prefix + 'count' not in stages:
+                continue
+
+            labels = 'stage="%s",outcome="%s"' % (stage, outcome)
+
+            # Buckets are stored individually and are cumulative in the exposition format
+            cumulative_count = 0
+            for upper_bound in HISTOGRAM_BUCKETS:
+                cumulative_count += stages.get('%sbucket:%s' % (prefix, upper_bound), 0)
+                lines.append('%s_bucket{%s,le="%s"} %d' % (histogram, labels, _format_bound(upper_bound), cumulative_count))
+
+            lines.append('%s_sum{%s} %f' % (histogram, labels, stages[prefix + 'sum']))
+            lines.append('%s_count{%s} %d' % (histogram, labels, stages[prefix + 'count']))
+
+    for counter, values in sorted(counters.items()):
+        name = METRIC_PREFIX + counter + '_total'
+        lines.append('# TYPE %s counter' % name)
+        for outcome, value in sorted(values.items()):
+            lines.append('%s{outcome="%s"} %d' % (name, outcome, value))
+
+    return '\n'.join(lines) + '\n'
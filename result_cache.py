@@ -0,0 +1,156 @@
+# Content addressed cache of processed uploads used by create_image_output and create_video_output.
+# Entries are keyed by a hash of the input file bytes, the model version and the processing settings,
+# so the same file uploaded again (under a different unique filename) is served without being reprocessed.
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+# Directory holding one sub-directory per cache entry with the annotated output and the predictions
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', os.path.join(APP_ROOT, 'static/uploads/cache/'))
+# Set RESULT_CACHE to false to always reprocess uploads
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE', 'true').lower() == 'true'
+# Total size of the cache in bytes, least recently used entries are evicted above it
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+# Entries older than this many seconds are evicted no matter how often they are used (default 7 days)
+RESULT_CACHE_MAX_AGE = int(os.getenv('RESULT_CACHE_MAX_AGE', 7 * 24 * 60 * 60))
+
+OUTPUT_NAME = 'output'
+PREDICTIONS_NAME = 'predictions.json'
+# Read input files in chunks of 1 MB while hashing so that large videos aren't loaded in memory
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def cache_key(input_file, settings):
+    '''
+        Returns the cache key of an input file, i.e., SHA-256 of its bytes together with the given processing settings
+        settings must contain everything that changes the output, like the model version and frame sampling rate
+    '''
+    sha = hashlib.sha256()
+
+    with open(input_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+
+    sha.update(json.dumps(settings, sort_keys=True).encode())
+
+    return sha.hexdigest()
+
+
+def _entry_output_file(entry_dir):
+    for name in os.listdir(entry_dir):
+        if name.startswith(OUTPUT_NAME):
+            return os.path.join(entry_dir, name)
+    return None
+
+
+def get(key, output_file):
+    '''
+        Looks up key in the cache, on a hit the cached output is placed at output_file and the cached predictions are returned
+        Returns None on a miss (or if caching is disabled)
+    '''
+    if not RESULT_CACHE_ENABLED:
+        return None
+
+    entry_dir = os.path.join(RESULT_CACHE_DIR, key)
+
+    try:
+        cached_output_file = _entry_output_file(entry_dir)
+
+        with open(os.path.join(entry_dir, PREDICTIONS_NAME)) as f:
+            predictions = json.load(f)
+
+        # Hard link if possible since outputs are never modified in place, copy otherwise
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        try:
+            os.link(cached_output_file, output_file)
+        except OSError:
+            shutil.copyfile(cached_output_file, output_file)
+
+    # Missing or half evicted entry
+    except (OSError, TypeError, ValueError):
+        return None
+
+    # Mark entry as recently used for the eviction policy
+    os.utime(entry_dir, None)
+
+    return predictions
+
+
+def put(key, output_file, predictions):
+    '''
+        Stores the output file and predictions of a processed upload under key and evicts old entries if needed
+        The entry is written to a temporary directory first and renamed into place so that readers never see half written entries
+    '''
+    if not RESULT_CACHE_ENABLED:
+        return
+
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+
+    entry_dir = os.path.join(RESULT_CACHE_DIR, key)
+    temp_dir = os.path.join(RESULT_CACHE_DIR, '.tmp-' + uuid.uuid4().hex)
+    os.makedirs(temp_dir)
+
+    try:
+        shutil.copyfile(output_file, os.path.join(temp_dir, OUTPUT_NAME + os.path.splitext(output_file)[1]))
+
+        with open(os.path.join(temp_dir, PREDICTIONS_NAME), 'w') as f:
+            json.dump(predictions, f)
+
+        os.rename(temp_dir, entry_dir)
+
+    # Another worker stored the same entry in the meantime, keep theirs
+    except OSError:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    evict()
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def evict():
+    '''
+        Removes entries older than RESULT_CACHE_MAX_AGE, then removes least recently used entries
+        until the cache fits in RESULT_CACHE_MAX_BYTES
+    '''
+    now = time.time()
+    entries = []
+
+    for name in os.listdir(RESULT_CACHE_DIR):
+        entry_dir = os.path.join(RESULT_CACHE_DIR, name)
+
+        try:
+            last_used = os.path.getmtime(entry_dir)
+
+            # Leftover temporary directories of crashed writers
+            if name.startswith('.tmp-'):
+                if now - last_used > RESULT_CACHE_MAX_AGE:
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+
+            # The predictions file is written once when the entry is created, so its mtime is the age of the entry
+            if now - os.path.getmtime(os.path.join(entry_dir, PREDICTIONS_NAME)) > RESULT_CACHE_MAX_AGE:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+
+            entries.append((last_used, _directory_size(entry_dir), entry_dir))
+
+        # Evicted by another worker while iterating
+        except OSError:
+            continue
+
+    total_size = sum(size for _, size, _ in entries)
+
+    for _, size, entry_dir in sorted(entries):
+        if total_size <= RESULT_CACHE_MAX_BYTES:
+            break
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
@@ -0,0 +1,92 @@
+# Startup time report of the web and worker processes.
+# Imports a module in a fresh interpreter with "python -X importtime", then prints the total import time, the peak memory
+# and the packages that cost the most to import. Also flags heavy inference packages that the web process should never import.
+#   python startup_report.py            (web process, i.e., "import app")
+#   python startup_report.py --module face_detection --top 20
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Packages that belong to the inference stack and must only be imported inside RQ workers
+HEAVY_PACKAGES = ('tensorflow', 'keras', 'cv2', 'dlib', 'face_recognition', 'face_recognition_models', 'scipy', 'h5py')
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Runs in the child interpreter after the import, prints the peak RSS and which heavy packages got loaded
+CHILD_CODE = '''
+import resource, sys
+import {module}
+print('maxrss_kb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+print('heavy', ','.join(sorted(package for package in {heavy!r} if package in sys.modules)))
+'''
+
+
+def run_import(module):
+    '''
+        Imports module in a fresh interpreter and returns (importtime_lines, maxrss_kb, heavy_packages)
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD_CODE.format(module=module, heavy=HEAVY_PACKAGES)],
+                            cwd=APP_ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1] if result.stderr else 'Import failed')
+        sys.exit(result.returncode)
+
+    output = dict(line.split(' ', 1) for line in result.stdout.splitlines() if ' ' in line)
+    heavy_packages = [package for package in output.get('heavy', '').strip().split(',') if package]
+
+    return result.stderr.splitlines(), int(output['maxrss_kb']), heavy_packages
+
+
+def parse_importtime(lines):
+    '''
+        Parses "import time: self [us] | cumulative | imported package" lines and returns the summed
+        import time in microseconds of every top-level package, together with the total import time
+    '''
+    packages = {}
+    total = 0
+
+    for line in lines:
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        self_time, cumulative_time, name = line[len('import time:'):].split('|')
+        self_time = int(self_time)
+
+        total += self_time
+        # Time of sub-modules is attributed to their top-level package
+        top_level = name.strip().split('.')[0]
+        packages[top_level] = packages.get(top_level, 0) + self_time
+
+    return packages, total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report the import cost of the web (or worker) process')
+    parser.add_argument('--module', default='app', help='Module to import, "app" for the web process')
+    parser.add_argument('--top', type=int, default=15, help='Number of most expensive packages to show')
+    args = parser.parse_args(argv)
+
+    lines, maxrss_kb, heavy_packages = run_import(args.module)
+    packages, total = parse_importtime(lines)
+
+    print('import %s: %.2f s, peak RSS %.1f MB' % (args.module, total / 1e6, maxrss_kb / 1024.0))
+    print()
+    print('%-32s %10s %7s' % ('package', 'ms', '%'))
+
+    for package, package_time in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print('%-32s %10.1f %6.1f%%' % (package, package_time / 1000.0, 100.0 * package_time / max(total, 1)))
+
+    if heavy_packages:
+        print()
+        print('Inference packages imported:', ', '.join(heavy_packages))
+
+        # The web process must not pay for the inference stack
+        if args.module == 'app':
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+// Maximum rate at which webcam frames are posted to the server, a frame is only posted once the previous one was accepted
+var MAX_FRAMES_PER_SECOND = 10;
+// Width webcam frames are scaled down to before they are posted, detection downscales them anyway
+var FRAME_WIDTH = 640;
+
+// The server closes the MJPEG stream after a minute (EVENTS_MAX_DURATION), so the image reconnects a little before that
+// The event stream reconnects by itself
+var MJPEG_RECONNECT_INTERVAL = 50 * 1000;
+// The server refuses streams (503) while it has too many open, both streams are retried after this many milliseconds then
+var STREAM_RETRY_INTERVAL = 5 * 1000;
+
+var streamID = null;
+var events = null;
+var mjpegTimer = null;
+
+/**
+	* Starts a live stream on the server and shows its annotated frames and predictions
+	* @param {String} source: "browser" to stream the webcam, an RTSP URL or the filename of an uploaded video
+	* @param {Function} onStarted: Called with the stream id once the stream was created
+*/
+function startStream(source, onStarted) {
+	$.ajax({
+		url: '/live/streams',
+		method: 'POST',
+		data: JSON.stringify({source: source}),
+		contentType: 'application/json'
+	})
+	.done((res) => {
+		streamID = res['stream_id'];
+
+		var id = streamID;
+		$("#live-output").attr('src', `/live/streams/${id}/mjpeg`);
+		$("#live-output").off('error').on('error', () => {
+			if (streamID === id)
+				setTimeout(() => $("#live-output").attr('src', `/live/streams/${id}/mjpeg?t=${Date.now()}`), STREAM_RETRY_INTERVAL);
+		});
+		mjpegTimer = setInterval(() => $("#live-output").attr('src', `/live/streams/${id}/mjpeg?t=${Date.now()}`), MJPEG_RECONNECT_INTERVAL);
+		$("#stop-stream").show();
+
+		watchStreamEvents(id);
+
+		if (onStarted)
+			onStarted(streamID);
+	})
+	.fail((err) => {
+		$("#live-status").text(err['responseJSON'] ? err['responseJSON']['error'] : 'Could not start the stream');
+	});
+}
+
+/**
+	* Shows the predictions of a live stream from its event stream
+	* The browser reconnects by itself when the server closes the stream, but not after it refused it (503), so that is retried here
+	* @param {String} id: Id of the live stream
+*/
+function watchStreamEvents(id) {
+	if (streamID !== id)
+		return;
+
+	var source = events = new EventSource(`/live/streams/${id}/events`);
+	source.onmessage = (event) => {
+		var result = JSON.parse(event.data);
+		var labels = result['faces'].map((face) => face['label']).join(', ') || 'no faces';
+		$("#live-status").text(`${labels} (latency ${result['latency_ms']} ms, ${result['dropped']} frames dropped)`);
+	};
+	source.onerror = () => {
+		if (source.readyState === EventSource.CLOSED)
+			setTimeout(() => watchStreamEvents(id), STREAM_RETRY_INTERVAL);
+	};
+}
+
+/**
+	* Posts the current webcam frame as a JPEG, then schedules the next one
+	* Waiting for each post keeps at most one frame in flight, so a slow connection lowers the frame rate instead of adding latency
+*/
+function postWebcamFrame(video, canvas, id) {
+	if (streamID !== id)
+		return;
+
+	var started = Date.now();
+	canvas.width = FRAME_WIDTH;
+	canvas.height = Math.round(FRAME_WIDTH * video.videoHeight / video.videoWidth) || FRAME_WIDTH * 3 / 4;
+	canvas.getContext('2d').drawImage(video, 0, 0, canvas.width, canvas.height);
+
+	canvas.toBlob((blob) => {
+		fetch(`/live/streams/${id}/frames`, {method: 'POST', body: blob})
+		.then((res) => {
+			if (!res.ok)
+				return;
+
+			var wait = Math.max(0, 1000 / MAX_FRAMES_PER_SECOND - (Date.now() - started));
+			setTimeout(() => postWebcamFrame(video, canvas, id), wait);
+		});
+	}, 'image/jpeg', 0.8);
+}
+
+function stopStream() {
+	if (streamID === null)
+		return;
+
+	$.ajax({url: `/live/streams/${streamID}`, method: 'DELETE'});
+
+	if (events !== null)
+		events.close();
+	clearInterval(mjpegTimer);
+
+	var video = $("#webcam")[0];
+	if (video.srcObject) {
+		video.srcObject.getTracks().forEach((track) => track.stop());
+		video.srcObject = null;
+	}
+
+	streamID = null;
+	$("#live-output").removeAttr('src');
+	$("#stop-stream").hide();
+}
+
+$(document).ready(function() {
+	$("#start-webcam").on('click', function() {
+		stopStream();
+
+		navigator.mediaDevices.getUserMedia({video: true, audio: false})
+		.then((mediaStream) => {
+			var video = $("#webcam")[0];
+			video.srcObject = mediaStream;
+
+			startStream('browser', (id) => {
+				var canvas = document.createElement('canvas');
+				if (video.readyState >= 2)
+					postWebcamFrame(video, canvas, id);
+				else
+					video.onloadeddata = () => postWebcamFrame(video, canvas, id);
+			});
+		})
+		.catch((err) => {
+			$("#live-status").text('Webcam not available: ' + err);
+		});
+	});
+
+	$("#start-source").on('click', function() {
+		stopStream();
+		startStream($("#stream-source").val());
+	});
+
+	$("#stop-stream").on('click', stopStream);
+
+	$(window).on('beforeunload', stopStream);
+});
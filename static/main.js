@@ -66,7 +66,7 @@ $(document).ready(function() {
 					// Because once job is submitted, the button is still visible on the home page while output is being loaded
 					// and so the user can keep clicking the button and create infinite number of Redis jobs
 					$("#results").off('click');
-					getJobStatus(res['job_id']);
+					watchJobStatus(res['job_id']);
 				}
 			})
 			.fail((err) => {
@@ -82,6 +82,72 @@ $(document).ready(function() {
 });
 
 
+/**
+	* Follows the status of the given job through the Server-Sent Events stream of the "jobs/job_id/events" route
+	* The server pushes an event whenever the job makes progress, so finished images are shown as soon as they are ready
+	* Falls back to polling with getJobStatus() in browsers without EventSource and when the stream keeps failing,
+	* e.g., behind a proxy that doesn't pass event streams through or when the server has too many streams open (503)
+	* @param {String} jobId: Job ID of job to keep track of
+*/
+function watchJobStatus(jobID) {
+	if (!window.EventSource) {
+		getJobStatus(jobID);
+		return;
+	}
+
+	var source = new EventSource(`/jobs/${jobID}/events`);
+	// The browser reconnects by itself when the stream is closed, e.g., after the server's maximum duration,
+	// so only a stream that was given up on or that failed several times in a row without an event falls back to polling
+	var errors = 0;
+
+	source.onerror = () => {
+		errors += 1;
+		if (source.readyState === EventSource.CLOSED || errors >= 3) {
+			source.close();
+			getJobStatus(jobID);
+		}
+	};
+
+	source.onmessage = (event) => {
+		errors = 0;
+		var data = JSON.parse(event.data);
+		showProgress(data);
+
+		if (data['job_status'] === 'finished') {
+			source.close();
+			window.location.href = '../results';
+		}
+		else if (data['job_status'] === 'failed') {
+			source.close();
+		}
+	};
+}
+
+
+/**
+	* Shows the progress of the job below the loading spinners along with the images that are already done
+	* @param {Object} data: Job status as returned by the "jobs/job_id" route
+*/
+function showProgress(data) {
+	var progress = data['progress'];
+	if (!progress)
+		return;
+
+	var text = `${progress['files_done']} of ${progress['files_total']} files done`;
+	if (progress['frames_total'] > 0)
+		text += `, ${progress['frames_done']} of ${progress['frames_total']} video frames read`;
+	if (progress['eta_seconds'] !== null)
+		text += `, about ${Math.ceil(progress['eta_seconds'])} s left`;
+
+	$("#progress").text(text);
+
+	progress['ready_images'].forEach((filename) => {
+		if ($(`#partial-results img[data-filename="${filename}"]`).length === 0)
+			$("#partial-results").append(`<img class="output-img" data-filename="${filename}" src="/results/image/${filename}">`);
+	});
+}
+
+
 /**
 	* Poller function that asks for job status of given job every 2 seconds via an AJAX GET request to "jobs/job_id" route
 	* If job has finished execution, i.e., jobStatus = finished, then, send client to results page
@@ -96,6 +162,7 @@ function getJobStatus(jobID) {
 	})
 	.done((res) => {
 		var jobStatus = res['data']['job_status'];
+		showProgress(res['data']);
 
 		if (jobStatus === 'finished') {
 			window.location.href = '../results';
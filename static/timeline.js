@@ -0,0 +1,98 @@
+/**
+	* Draws the faces and emotions of a video timeline (written by the workers when VIDEO_OUTPUT_MODE is "annotations")
+	* on a canvas laid over the original video, so that no annotated video has to be encoded, stored and downloaded
+	* Every ".annotated-video" element holds a video, a canvas and the URL of its timeline in data-timeline
+*/
+
+/**
+	* Parses a JSON lines timeline, the first line describes the video and every other line a sampled frame
+	* @param {String} text: Contents of the timeline file
+	* @return {Object} : {header, entries} with entries sorted by time
+*/
+function parseTimeline(text) {
+	var lines = text.split('\n').filter((line) => line.trim().length > 0).map((line) => JSON.parse(line));
+
+	return {
+		header: lines[0],
+		entries: lines.slice(1)
+	};
+}
+
+/**
+	* Binary search for the timeline entry whose annotations hold at the given time, null if there is none
+*/
+function findTimelineEntry(entries, time) {
+	var low = 0, high = entries.length - 1, found = null;
+
+	while (low <= high) {
+		var middle = (low + high) >> 1;
+
+		if (entries[middle]['time'] <= time) {
+			found = entries[middle];
+			low = middle + 1;
+		}
+		else {
+			high = middle - 1;
+		}
+	}
+
+	if (found === null || time > found['time'] + found['duration'])
+		return null;
+
+	return found;
+}
+
+/**
+	* Draws the boxes and labels of the entry on the canvas
+	* The video is scaled to fit its element while keeping its aspect ratio, so boxes are scaled and offset the same way
+*/
+function drawTimelineEntry(video, canvas, entry) {
+	canvas.width = video.clientWidth;
+	canvas.height = video.clientHeight;
+
+	var context = canvas.getContext('2d');
+	context.clearRect(0, 0, canvas.width, canvas.height);
+
+	if (entry === null || !video.videoWidth)
+		return;
+
+	var scale = Math.min(canvas.width / video.videoWidth, canvas.height / video.videoHeight);
+	var offsetX = (canvas.width - video.videoWidth * scale) / 2;
+	var offsetY = (canvas.height - video.videoHeight * scale) / 2;
+
+	context.lineWidth = 2;
+	context.strokeStyle = 'rgb(255, 0, 0)';
+	context.fillStyle = 'rgb(255, 255, 255)';
+	context.font = '14px sans-serif';
+
+	entry['boxes'].forEach((box, index) => {
+		// Boxes are (top, right, bottom, left) on the original frame
+		var left = offsetX + box[3] * scale, top = offsetY + box[0] * scale;
+		var width = (box[1] - box[3]) * scale, height = (box[2] - box[0]) * scale;
+
+		context.strokeRect(left, top, width, height);
+		context.fillText(entry['labels'][index], left + 3, top + height + 14);
+	});
+}
+
+$(document).ready(function() {
+	$(".annotated-video").each(function() {
+		var video = $(this).find("video")[0];
+		var canvas = $(this).find("canvas")[0];
+
+		$.get($(this).data("timeline"), null, null, 'text').done((text) => {
+			var timeline = parseTimeline(text);
+
+			var draw = function() {
+				drawTimelineEntry(video, canvas, findTimelineEntry(timeline.entries, video.currentTime));
+
+				// Redraw on every animation frame while playing, timeupdate events only fire a few times per second
+				if (!video.paused && !video.ended)
+					window.requestAnimationFrame(draw);
+			};
+
+			$(video).on('play seeked loadeddata', draw);
+			draw();
+		});
+	});
+});
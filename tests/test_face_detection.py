@@ -0,0 +1,97 @@
+import pytest
+
+pytest.importorskip('cv2')
+pytest.importorskip('face_recognition')
+np = pytest.importorskip('numpy')
+
+import face_detection
+
+# Frame sizes of common videos, (height, width)
+VIDEO_FRAME_SHAPES = [(240, 320), (480, 640), (720, 1280), (1080, 1920), (2160, 3840), (1920, 1080)]
+
+
+def frame(height, width):
+    return np.zeros((height, width, 3), dtype=np.uint8)
+
+
+@pytest.mark.parametrize('shape', VIDEO_FRAME_SHAPES)
+def test_video_detection_area_never_exceeds_quarter_scale(shape):
+    small_frame, scale = face_detection.downscale_for_detection(frame(*shape), video=True)
+
+    # Video frames were always detected at 1/4 of their size before the detection size cap
+    assert scale <= face_detection.VIDEO_DETECTION_SCALE
+    assert small_frame.shape[0] * small_frame.shape[1] <= shape[0] * shape[1] * 0.25 ** 2 + max(shape)
+
+
+def test_large_video_frames_are_capped(monkeypatch):
+    monkeypatch.setattr(face_detection, 'VIDEO_DETECTION_MAX_SIZE', 320)
+
+    assert face_detection.detection_scale(frame(480, 640), video=True) == 0.25
+    assert face_detection.detection_scale(frame(2160, 3840), video=True) == pytest.approx(320 / 3840.0)
+
+
+def test_images_are_capped_at_detection_max_size(monkeypatch):
+    monkeypatch.setattr(face_detection, 'DETECTION_MAX_SIZE', 500)
+
+    assert face_detection.detection_scale(frame(300, 400)) == 1.0
+    assert face_detection.detection_scale(frame(480, 640)) == pytest.approx(500 / 640.0)
+
+    monkeypatch.setattr(face_detection, 'DETECTION_MAX_SIZE', 0)
+    assert face_detection.detection_scale(frame(2160, 3840)) == 1.0
+
+
+def test_empty_crops_are_blank_faces():
+    image = np.full((100, 100, 3), 255, dtype=np.uint8)
+    # Zero area, inverted and completely outside of the image
+    face_boxes = [(10, 60, 60, 10), (40, 40, 80, 40), (50, 20, 20, 50), (150, 250, 200, 150), (10, 60, 60, 10)]
+
+    batch = face_detection.preprocess_frame_faces([(image, face_boxes)])
+
+    assert batch.shape == (5, 48, 48, 1)
+    assert batch[0].min() == 255 and batch[4].min() == 255
+    assert not batch[1: 4].any()
+
+
+def test_boxes_off_the_image_are_not_detected(monkeypatch):
+    image = frame(100, 100)
+    detections = [(10, 60, 60, 10), (-50, 20, -5, -40), (120, 180, 190, 110), (30, 30, 70, 30)]
+    monkeypatch.setattr(face_detection, 'get_face_detector', lambda: lambda small_image: detections)
+
+    assert face_detection.detect_faces(image) == [(10, 60, 60, 10)]
+
+
+class StubTracker:
+    def update(self, small_frame):
+        # The 100x100 frame is detected at 25x25, the second box is off the frame
+        return [0, 1], [(2, 15, 15, 2), (30, 40, 45, 30)]
+
+
+def test_tracked_boxes_off_the_frame_are_dropped_with_their_track_ids():
+    assert face_detection.detect_video_frame_faces(frame(100, 100), StubTracker()) == ([0], [(8, 60, 60, 8)])
+
+
+class FailingPool:
+    def __init__(self):
+        self.terminated = False
+
+    def map(self, function, segments):
+        raise RuntimeError('segment process died')
+
+    def terminate(self):
+        self.terminated = True
+
+    def join(self):
+        pass
+
+
+def test_segment_pool_is_replaced_after_a_failed_map(tmp_path, monkeypatch):
+    pool = FailingPool()
+    monkeypatch.setattr(face_detection, '_segment_pool', pool)
+    monkeypatch.setattr(face_detection, 'video_segments', lambda input_file, step: [(0, 150), (150, None)])
+
+    with pytest.raises(RuntimeError):
+        face_detection.process_video_segmented(str(tmp_path / 'input.mp4'), str(tmp_path / 'output.webm'), None)
+
+    # Its processes may still be stuck on the segments of the failed job, so the next video gets a new pool
+    assert pool.terminated
+    assert face_detection._segment_pool is None
@@ -0,0 +1,141 @@
+import pytest
+
+pytest.importorskip('cv2')
+np = pytest.importorskip('numpy')
+
+import face_tracking
+from face_tracking import FaceTracker, LabelSmoother, intersection_over_union
+
+
+class StubTracker:
+    '''
+        Stands in for the OpenCV tracker, keeps its box where it was initialized unless told that it lost the face
+    '''
+
+    def __init__(self):
+        self.box = None
+        self.lost = False
+
+    def init(self, frame, box):
+        self.box = box
+
+    def update(self, frame):
+        return not self.lost, self.box
+
+
+@pytest.fixture(autouse=True)
+def stub_tracker(monkeypatch):
+    monkeypatch.setattr(face_tracking, 'create_opencv_tracker', StubTracker)
+
+
+class Detections:
+    '''
+        Face detector that returns the next list of face locations on every call
+    '''
+
+    def __init__(self, *face_locations):
+        self.face_locations = list(face_locations)
+        self.calls = 0
+
+    def __call__(self, frame):
+        self.calls += 1
+        return self.face_locations.pop(0)
+
+
+FRAME = np.zeros((200, 200, 3), dtype=np.uint8)
+
+
+def test_intersection_over_union():
+    location = (0, 10, 10, 0)
+
+    assert intersection_over_union(location, location) == 1.0
+    # Half of each box overlaps the other: 50 / (100 + 100 - 50)
+    assert intersection_over_union(location, (0, 15, 10, 5)) == pytest.approx(1 / 3.0)
+    # Touching and disjoint boxes don't overlap
+    assert intersection_over_union(location, (0, 20, 10, 10)) == 0.0
+    assert intersection_over_union(location, (50, 60, 60, 50)) == 0.0
+
+
+def test_detections_keep_the_track_id_of_the_overlapping_track():
+    detect_faces = Detections([(0, 50, 50, 0), (100, 150, 150, 100)],
+                              [(102, 152, 152, 102), (2, 52, 52, 2)])
+    tracker = FaceTracker(detect_faces, keyframe_interval=1)
+
+    assert tracker.update(FRAME) == ([0, 1], [(0, 50, 50, 0), (100, 150, 150, 100)])
+    # The faces are detected in the opposite order on the next keyframe
+    assert tracker.update(FRAME) == ([1, 0], [(102, 152, 152, 102), (2, 52, 52, 2)])
+
+
+def test_low_iou_detections_start_new_tracks():
+    detect_faces = Detections([(0, 50, 50, 0)], [(0, 100, 50, 45)])
+    tracker = FaceTracker(detect_faces, keyframe_interval=1, min_iou=0.3)
+
+    tracker.update(FRAME)
+
+    assert tracker.update(FRAME)[0] == [1]
+
+
+def test_each_track_continues_at_most_one_detection():
+    detect_faces = Detections([(0, 50, 50, 0)], [(0, 50, 50, 0), (0, 52, 50, 2)])
+    tracker = FaceTracker(detect_faces, keyframe_interval=1)
+
+    tracker.update(FRAME)
+
+    # The detection with the highest IoU continues the track, the other one starts a new track
+    assert tracker.update(FRAME)[0] == [0, 1]
+
+
+def test_boxes_are_propagated_between_keyframes():
+    detect_faces = Detections([(10, 50, 60, 20)])
+    tracker = FaceTracker(detect_faces, keyframe_interval=3)
+
+    results = [tracker.update(FRAME) for _ in range(3)]
+
+    assert detect_faces.calls == 1
+    assert results == [([0], [(10, 50, 60, 20)])] * 3
+
+
+def test_lost_face_triggers_a_detection():
+    detect_faces = Detections([(10, 50, 60, 20)], [(12, 52, 62, 22)])
+    tracker = FaceTracker(detect_faces, keyframe_interval=10)
+
+    tracker.update(FRAME)
+    tracker.tracks[0][2].lost = True
+
+    assert tracker.update(FRAME) == ([0], [(12, 52, 62, 22)])
+    assert detect_faces.calls == 2
+
+
+@pytest.mark.parametrize('box', [(250, 10, 40, 40), (-80, 10, 40, 40), (10, 250, 40, 40), (10, 10, 0, 40)])
+def test_box_drifted_off_the_frame_triggers_a_detection(box):
+    detect_faces = Detections([(10, 50, 60, 20)], [(12, 52, 62, 22)])
+    tracker = FaceTracker(detect_faces, keyframe_interval=10)
+
+    tracker.update(FRAME)
+    # The tracker reports an (x, y, width, height) box that has nothing left on the 200x200 frame
+    tracker.tracks[0][2].box = box
+
+    assert tracker.update(FRAME) == ([0], [(12, 52, 62, 22)])
+    assert detect_faces.calls == 2
+
+
+def test_label_smoother_majority_vote():
+    smoother = LabelSmoother(window=3)
+
+    assert smoother.smooth([0], ['Happy']) == ['Happy']
+    assert smoother.smooth([0], ['Sad']) == ['Happy']
+    assert smoother.smooth([0], ['Sad']) == ['Sad']
+    # Happy dropped out of the window
+    assert smoother.smooth([0], ['Happy']) == ['Sad']
+
+
+def test_label_smoother_keeps_tracks_apart_and_drops_lost_tracks():
+    smoother = LabelSmoother(window=5)
+
+    smoother.smooth([0, 1], ['Happy', 'Angry'])
+    assert smoother.smooth([1, 0], ['Sad', 'Sad']) == ['Angry', 'Happy']
+
+    # Track 0 disappeared, so its history is gone when the id shows up again
+    smoother.smooth([1], ['Sad'])
+    assert list(smoother.history) == [1]
+    assert smoother.smooth([0], ['Neutral']) == ['Neutral']
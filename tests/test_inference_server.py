@@ -0,0 +1,135 @@
+import threading
+import time
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import inference_server
+from inference_server import MicroBatcher, _Request
+
+
+class StubModel:
+    '''
+        Returns the first pixel of every face as all of its class probabilities and records the size of every batch
+    '''
+
+    def __init__(self, error=None):
+        self.error = error
+        self.batch_sizes = []
+
+    def predict(self, faces):
+        self.batch_sizes.append(len(faces))
+        if self.error is not None:
+            raise self.error
+        return np.repeat(faces[:, 0, 0, :], inference_server.CLASS_COUNT, axis=1)
+
+
+def make_faces(count, value):
+    return np.full((count,) + inference_server.FACE_SHAPE, value, dtype=np.float32)
+
+
+def start(batcher):
+    threading.Thread(target=batcher.run, daemon=True).start()
+    return batcher
+
+
+def test_batch_is_closed_at_max_batch_size():
+    batcher = MicroBatcher(StubModel(), max_batch_size=4, max_wait=10)
+    requests = [_Request(make_faces(2, index)) for index in range(3)]
+    for request in requests:
+        batcher.requests.put(request)
+
+    start_time = time.perf_counter()
+    batch, pending = batcher.next_batch(None)
+
+    assert batch == requests[:2]
+    assert pending is None
+    # Full batches don't wait for max_wait
+    assert time.perf_counter() - start_time < 1
+
+
+def test_batch_is_closed_after_max_wait():
+    batcher = MicroBatcher(StubModel(), max_batch_size=64, max_wait=0.05)
+    request = _Request(make_faces(1, 0))
+    batcher.requests.put(request)
+
+    start_time = time.perf_counter()
+    batch, pending = batcher.next_batch(None)
+    elapsed = time.perf_counter() - start_time
+
+    assert batch == [request]
+    assert pending is None
+    assert 0.04 <= elapsed < 1
+
+
+def test_requests_are_never_split():
+    batcher = MicroBatcher(StubModel(), max_batch_size=4, max_wait=0.05)
+    first, second = _Request(make_faces(3, 0)), _Request(make_faces(2, 1))
+    batcher.requests.put(first)
+    batcher.requests.put(second)
+
+    batch, pending = batcher.next_batch(None)
+    assert batch == [first]
+    assert pending is second
+
+    # The left over request starts the next batch
+    batch, pending = batcher.next_batch(pending)
+    assert batch == [second]
+
+
+def test_oversized_request_is_run_on_its_own():
+    model = StubModel()
+    batcher = start(MicroBatcher(model, max_batch_size=4, max_wait=0.01))
+
+    probabilities = batcher.predict(make_faces(6, 3))
+
+    assert probabilities.shape == (6, inference_server.CLASS_COUNT)
+    assert model.batch_sizes == [6]
+
+
+def test_every_caller_gets_its_own_results():
+    model = StubModel()
+    batcher = start(MicroBatcher(model, max_batch_size=16, max_wait=0.05))
+    results = {}
+
+    def call(index):
+        results[index] = batcher.predict(make_faces(index + 1, index))
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    for index in range(5):
+        assert results[index].shape == (index + 1, inference_server.CLASS_COUNT)
+        assert (results[index] == index).all()
+
+    # The concurrent requests were batched together
+    assert len(model.batch_sizes) < 5
+    assert sum(model.batch_sizes) == sum(range(1, 6))
+
+
+def test_model_errors_reach_the_caller():
+    batcher = start(MicroBatcher(StubModel(error=ValueError('broken model')), max_batch_size=4, max_wait=0.01))
+
+    with pytest.raises(ValueError, match='broken model'):
+        batcher.predict(make_faces(1, 0))
+
+
+def test_model_context_is_entered():
+    entered = []
+
+    class Context:
+        def __enter__(self):
+            entered.append(threading.current_thread())
+
+        def __exit__(self, *exc_info):
+            pass
+
+    batcher = start(MicroBatcher(StubModel(), max_batch_size=4, max_wait=0.01, model_context=Context))
+    batcher.predict(make_faces(1, 0))
+
+    assert len(entered) == 1
+    assert entered[0] is not threading.current_thread()
@@ -0,0 +1,65 @@
+import pytest
+
+import metrics
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+class StubJob:
+    def __init__(self):
+        self.meta = {}
+        self.saved = False
+
+    def save_meta(self):
+        self.saved = True
+
+
+@pytest.fixture
+def connection():
+    return fakeredis.FakeStrictRedis()
+
+
+def run_job(connection, outcome, job=None):
+    recorder = metrics.start_job()
+    with metrics.timed('detect'):
+        pass
+    metrics.increment('frames', 3)
+    metrics.finish_job(recorder, job, connection, outcome)
+
+
+def test_jobs_are_counted_per_outcome(connection):
+    run_job(connection, 'success')
+    run_job(connection, 'success')
+    run_job(connection, 'failed')
+    run_job(connection, 'timeout')
+
+    lines = metrics.render_prometheus(connection).splitlines()
+
+    assert 'emotion_recognizer_jobs_total{outcome="success"} 2' in lines
+    assert 'emotion_recognizer_jobs_total{outcome="failed"} 1' in lines
+    assert 'emotion_recognizer_jobs_total{outcome="timeout"} 1' in lines
+    assert 'emotion_recognizer_frames_total{outcome="success"} 6' in lines
+
+
+def test_stage_histograms_are_labelled_with_the_outcome(connection):
+    run_job(connection, 'success')
+    run_job(connection, 'failed')
+
+    lines = metrics.render_prometheus(connection).splitlines()
+
+    for outcome in ('success', 'failed'):
+        for stage in ('detect', 'job'):
+            labels = 'stage="%s",outcome="%s"' % (stage, outcome)
+            assert 'emotion_recognizer_stage_duration_seconds_count{%s} 1' % labels in lines
+            assert 'emotion_recognizer_stage_duration_seconds_bucket{%s,le="+Inf"} 1' % labels in lines
+
+
+def test_outcome_is_attached_to_the_job(connection):
+    job = StubJob()
+
+    run_job(connection, 'timeout', job)
+
+    assert job.saved
+    assert job.meta['metrics']['outcome'] == 'timeout'
+    assert job.meta['metrics']['counters'] == {'frames': 3}
+    assert set(job.meta['metrics']['stages']) == {'detect', 'job'}
@@ -0,0 +1,134 @@
+import os
+import time
+
+import pytest
+
+import result_cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_DIR', str(cache_dir))
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_ENABLED', True)
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_MAX_BYTES', 10 * 1024 * 1024)
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_MAX_AGE', 60 * 60)
+    return cache_dir
+
+
+def write_file(path, content):
+    path.write_bytes(content)
+    return str(path)
+
+
+def set_age(path, seconds):
+    timestamp = time.time() - seconds
+    os.utime(path, (timestamp, timestamp))
+
+
+def test_cache_key_depends_on_bytes_and_settings(tmp_path):
+    first = write_file(tmp_path / 'first.jpg', b'image')
+    same = write_file(tmp_path / 'same.jpg', b'image')
+    other = write_file(tmp_path / 'other.jpg', b'other image')
+
+    assert result_cache.cache_key(first, {"a": 1, "b": 2}) == result_cache.cache_key(same, {"b": 2, "a": 1})
+    assert result_cache.cache_key(first, {"a": 1}) != result_cache.cache_key(other, {"a": 1})
+    assert result_cache.cache_key(first, {"a": 1}) != result_cache.cache_key(first, {"a": 2})
+
+
+def test_put_then_get_restores_output_and_predictions(cache_dir, tmp_path):
+    output_file = write_file(tmp_path / 'output.webm', b'annotated')
+    predictions = [{"box": [1, 2, 3, 4], "label": "Happy"}]
+
+    result_cache.put('key', output_file, predictions)
+
+    restored_file = str(tmp_path / 'restored.webm')
+    assert result_cache.get('key', restored_file) == predictions
+    with open(restored_file, 'rb') as f:
+        assert f.read() == b'annotated'
+
+
+def test_get_replaces_an_existing_output(cache_dir, tmp_path):
+    result_cache.put('key', write_file(tmp_path / 'output.jpg', b'cached'), [])
+    existing_file = write_file(tmp_path / 'existing.jpg', b'stale')
+
+    assert result_cache.get('key', existing_file) == []
+    with open(existing_file, 'rb') as f:
+        assert f.read() == b'cached'
+
+
+def test_miss_and_disabled_cache(cache_dir, tmp_path, monkeypatch):
+    assert result_cache.get('missing', str(tmp_path / 'out.jpg')) is None
+
+    result_cache.put('key', write_file(tmp_path / 'output.jpg', b'x'), [])
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_ENABLED', False)
+
+    assert result_cache.get('key', str(tmp_path / 'out.jpg')) is None
+    result_cache.put('other', write_file(tmp_path / 'other.jpg', b'y'), [])
+    assert not (cache_dir / 'other').exists()
+
+
+def test_put_keeps_an_existing_entry(cache_dir, tmp_path):
+    result_cache.put('key', write_file(tmp_path / 'first.jpg', b'first'), ["first"])
+    result_cache.put('key', write_file(tmp_path / 'second.jpg', b'second'), ["second"])
+
+    assert result_cache.get('key', str(tmp_path / 'out.jpg')) == ["first"]
+    # No temporary directory is left behind
+    assert sorted(os.listdir(str(cache_dir))) == ['key']
+
+
+def test_evict_by_age(cache_dir, tmp_path):
+    result_cache.put('old', write_file(tmp_path / 'old.jpg', b'old'), [])
+    result_cache.put('new', write_file(tmp_path / 'new.jpg', b'new'), [])
+    set_age(str(cache_dir / 'old' / result_cache.PREDICTIONS_NAME), 2 * 60 * 60)
+
+    result_cache.evict()
+
+    assert sorted(os.listdir(str(cache_dir))) == ['new']
+
+
+def test_evict_by_age_even_if_recently_used(cache_dir, tmp_path):
+    result_cache.put('old', write_file(tmp_path / 'old.jpg', b'old'), [])
+    set_age(str(cache_dir / 'old' / result_cache.PREDICTIONS_NAME), 2 * 60 * 60)
+    # A hit marks the entry as used, but doesn't make it younger
+    assert result_cache.get('old', str(tmp_path / 'out.jpg')) == []
+
+    result_cache.evict()
+
+    assert os.listdir(str(cache_dir)) == []
+
+
+def test_evict_stale_temporary_directories(cache_dir, tmp_path):
+    result_cache.put('key', write_file(tmp_path / 'output.jpg', b'x'), [])
+    stale_dir, fresh_dir = cache_dir / '.tmp-stale', cache_dir / '.tmp-fresh'
+    stale_dir.mkdir()
+    fresh_dir.mkdir()
+    set_age(str(stale_dir), 2 * 60 * 60)
+
+    result_cache.evict()
+
+    assert sorted(os.listdir(str(cache_dir))) == ['.tmp-fresh', 'key']
+
+
+def test_evict_least_recently_used_above_max_bytes(cache_dir, tmp_path, monkeypatch):
+    for index, key in enumerate(['a', 'b', 'c']):
+        result_cache.put(key, write_file(tmp_path / ('%s.jpg' % key), b'x' * 1000), [])
+        # a was used longest ago, c most recently
+        set_age(str(cache_dir / key), 30 - index * 10)
+
+    # Using a makes it the most recently used entry
+    result_cache.get('a', str(tmp_path / 'out.jpg'))
+
+    entry_size = result_cache._directory_size(str(cache_dir / 'a'))
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_MAX_BYTES', 2 * entry_size)
+    result_cache.evict()
+
+    assert sorted(os.listdir(str(cache_dir))) == ['a', 'c']
+
+
+def test_put_evicts(cache_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_MAX_BYTES', 0)
+
+    result_cache.put('key', write_file(tmp_path / 'output.jpg', b'x'), [])
+
+    assert os.listdir(str(cache_dir)) == []
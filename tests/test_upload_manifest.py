@@ -0,0 +1,130 @@
+import time
+
+import pytest
+
+import upload_manifest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def connection():
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def upload_folder(tmp_path):
+    for kind in (upload_manifest.IMAGES, upload_manifest.VIDEOS):
+        (tmp_path / kind / ('input_%s' % kind)).mkdir(parents=True)
+        (tmp_path / kind / ('output_%s' % kind)).mkdir(parents=True)
+    return tmp_path
+
+
+def create_upload(upload_folder, kind, filename, with_output=True):
+    paths = [upload_manifest.input_path(kind, filename)]
+    if with_output:
+        paths.append(upload_manifest.output_path(kind, filename))
+    for path in paths:
+        (upload_folder / path).write_bytes(b'data')
+    return paths
+
+
+def expire(connection, paths):
+    connection.zadd(upload_manifest.EXPIRY_KEY, {path: time.time() - 1 for path in paths})
+
+
+class RacingConnection:
+    '''
+        Redis connection on which another collector removes the given paths from the sorted set
+        between this collector's ZRANGEBYSCORE and ZREM
+    '''
+
+    def __init__(self, connection, taken_paths):
+        self.connection = connection
+        self.taken_paths = set(taken_paths)
+
+    def zrangebyscore(self, *args, **kwargs):
+        paths = self.connection.zrangebyscore(*args, **kwargs)
+        if self.taken_paths:
+            self.connection.zrem(upload_manifest.EXPIRY_KEY, *self.taken_paths)
+        return paths
+
+    def zrem(self, *args):
+        return self.connection.zrem(*args)
+
+
+def test_output_video_filename_keeps_the_input_name():
+    assert upload_manifest.output_video_filename('clip.v1.mp4', 'annotations') == 'clip.v1.mp4' + upload_manifest.TIMELINE_SUFFIX
+    assert upload_manifest.output_video_filename('a.mp4', 'video') != upload_manifest.output_video_filename('a.avi', 'video')
+
+
+def test_record_and_get_uploads(connection):
+    upload_manifest.record_upload(connection, 'user', upload_manifest.IMAGES, 'a.jpg')
+    upload_manifest.record_upload(connection, 'user', upload_manifest.VIDEOS, 'b.mp4')
+    upload_manifest.record_upload(connection, 'user', upload_manifest.IMAGES, 'c.jpg')
+    upload_manifest.record_upload(connection, 'other', upload_manifest.IMAGES, 'd.jpg')
+
+    assert upload_manifest.get_uploads(connection, 'user') == (['a.jpg', 'c.jpg'], ['b.mp4'])
+    # Both the input and output of every upload are scheduled for deletion
+    assert connection.zcard(upload_manifest.EXPIRY_KEY) == 8
+
+
+def test_video_durations(connection):
+    upload_manifest.record_upload(connection, 'user', upload_manifest.VIDEOS, 'short.mp4', 4.5)
+    upload_manifest.record_upload(connection, 'user', upload_manifest.VIDEOS, 'unknown.mp4')
+    upload_manifest.record_upload(connection, 'other', upload_manifest.VIDEOS, 'long.mp4', 90.0)
+
+    assert upload_manifest.get_video_durations(connection, 'user') == {'short.mp4': 4.5}
+
+    upload_manifest.results_served(connection, 'user', [], ['short.mp4', 'unknown.mp4'])
+    assert upload_manifest.get_video_durations(connection, 'user') == {}
+
+
+def test_results_served_clears_the_manifest_and_brings_expiry_forward(connection):
+    upload_manifest.record_upload(connection, 'user', upload_manifest.IMAGES, 'a.jpg')
+
+    upload_manifest.results_served(connection, 'user', ['a.jpg'], [])
+
+    assert upload_manifest.get_uploads(connection, 'user') == ([], [])
+    expiry = connection.zscore(upload_manifest.EXPIRY_KEY, upload_manifest.input_path(upload_manifest.IMAGES, 'a.jpg'))
+    assert expiry <= time.time() + upload_manifest.RESULTS_SERVED_TTL
+
+
+def test_collect_garbage_deletes_only_expired_files(connection, upload_folder):
+    expired_paths = create_upload(upload_folder, upload_manifest.IMAGES, 'old.jpg')
+    # The output of a failed job was never written
+    expired_paths += create_upload(upload_folder, upload_manifest.VIDEOS, 'failed.mp4', with_output=False)
+    expire(connection, expired_paths + [upload_manifest.output_path(upload_manifest.VIDEOS, 'failed.mp4')])
+
+    fresh_paths = create_upload(upload_folder, upload_manifest.IMAGES, 'new.jpg')
+    upload_manifest.record_upload(connection, 'user', upload_manifest.IMAGES, 'new.jpg')
+
+    assert upload_manifest.collect_garbage(connection, str(upload_folder)) == 3
+
+    assert not any((upload_folder / path).exists() for path in expired_paths)
+    assert all((upload_folder / path).exists() for path in fresh_paths)
+    assert sorted(connection.zrange(upload_manifest.EXPIRY_KEY, 0, -1)) == sorted(path.encode() for path in fresh_paths)
+
+
+def test_collect_garbage_in_several_batches(connection, upload_folder, monkeypatch):
+    monkeypatch.setattr(upload_manifest, 'GC_BATCH_SIZE', 2)
+    paths = []
+    for index in range(5):
+        paths += create_upload(upload_folder, upload_manifest.IMAGES, '%d.jpg' % index)
+    expire(connection, paths)
+
+    assert upload_manifest.collect_garbage(connection, str(upload_folder)) == 10
+    assert connection.zcard(upload_manifest.EXPIRY_KEY) == 0
+
+
+def test_collect_garbage_leaves_paths_removed_by_another_collector(connection, upload_folder):
+    taken_paths = create_upload(upload_folder, upload_manifest.IMAGES, 'taken.jpg')
+    own_paths = create_upload(upload_folder, upload_manifest.IMAGES, 'own.jpg')
+    expire(connection, taken_paths + own_paths)
+
+    deleted = upload_manifest.collect_garbage(RacingConnection(connection, taken_paths), str(upload_folder))
+
+    assert deleted == 2
+    # The other collector won these paths, so deleting their files is left to it
+    assert all((upload_folder / path).exists() for path in taken_paths)
+    assert not any((upload_folder / path).exists() for path in own_paths)
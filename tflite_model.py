@@ -0,0 +1,60 @@
+# Lightweight TFLite runtime backend for the emotion model, selected with INFERENCE_BACKEND=tflite (see face_detection.load_model).
+# The .tflite artifact is created from the trained Keras model by export_model.py.
+# Uses the standalone tflite_runtime package when it is installed, so that workers don't need to import the whole of TensorFlow,
+# and falls back to the interpreter bundled with TensorFlow otherwise.
+
+import os
+import numpy as np
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    import tensorflow as tf
+    Interpreter = tf.lite.Interpreter
+
+# Number of CPU threads used by the interpreter
+TFLITE_NUM_THREADS = int(os.getenv('TFLITE_NUM_THREADS', os.cpu_count() or 1))
+
+
+class TFLiteModel:
+    '''
+        Runs a .tflite export of cnn_model_2 with the same predict() / predict_classes() interface as the Keras model,
+        so that the rest of the pipeline doesn't need to know which backend is used
+        The interpreter isn't thread safe, only one thread may use an instance at a time
+
+        Parameters:
+            model_path: Path of the .tflite file
+    '''
+
+    def __init__(self, model_path):
+        try:
+            self.interpreter = Interpreter(model_path=model_path, num_threads=TFLITE_NUM_THREADS)
+        # Older interpreters don't take the number of threads
+        except TypeError:
+            self.interpreter = Interpreter(model_path=model_path)
+
+        self.interpreter.allocate_tensors()
+
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = self.interpreter.get_input_details()[0]['shape'][0]
+
+    def predict(self, batch):
+        '''
+            Returns the class probabilities of a (N, 48, 48, 1) batch
+        '''
+        batch = np.asarray(batch, dtype=np.float32)
+
+        # The exported graph has a fixed batch size, so the input is resized whenever the number of faces changes
+        if batch.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch.shape[0]
+
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+
+        return self.interpreter.get_tensor(self.output_index)
+
+    def predict_classes(self, batch):
+        return self.predict(batch).argmax(axis=-1)
@@ -0,0 +1,176 @@
+# Per-user manifest of uploaded files and garbage collection of the upload folders.
+# upload_file records every upload in a Redis list of its user, so the jobs route reads the user's files directly instead of
+# scanning the shared input folders. Every input and output file is also given an expiry time in a Redis sorted set,
+# and the garbage collector (run by the workers) deletes the files whose time has come.
+# Paths are stored relative to the upload folder, e.g., "images/input_images/<filename>".
+# Also decides the name of the output of every video, which depends on VIDEO_OUTPUT_MODE (shared by the web process and the workers).
+
+import os
+import time
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+# Same upload folder as the one configured in app.py
+UPLOAD_FOLDER = os.path.join(APP_ROOT, 'static/uploads/')
+
+# Inputs and outputs are deleted this many seconds after upload at the latest (6 hours), long enough for any job to finish
+UPLOAD_TTL = int(os.getenv('UPLOAD_TTL', 6 * 60 * 60))
+# Once the results page of an upload was served, its files are only kept for this long (30 minutes) so the browser can still load them
+RESULTS_SERVED_TTL = int(os.getenv('RESULTS_SERVED_TTL', 30 * 60))
+# How often the garbage collector looks for expired files, in seconds
+GC_INTERVAL = int(os.getenv('GC_INTERVAL', 60))
+
+# What is produced for uploaded videos
+#   "video": an annotated .webm video (.mp4 for H.264, see below)
+#   "annotations": only a JSON lines timeline of the faces and emotions, the results page draws them over the original video
+VIDEO_OUTPUT_MODE = os.getenv('VIDEO_OUTPUT_MODE', 'video')
+TIMELINE_SUFFIX = '.timeline.jsonl'
+# Container of the annotated videos, which follows the codec of video_encoding.py (read from the same environment variables,
+# video_encoding isn't imported here since it needs OpenCV): H.264 from the ffmpeg encoder goes into MP4, everything else into WebM
+if os.getenv('VIDEO_ENCODER', 'opencv') == 'ffmpeg' and os.getenv('FFMPEG_CODEC', 'vp8') == 'h264':
+    VIDEO_OUTPUT_EXTENSION, VIDEO_OUTPUT_MIMETYPE = '.mp4', 'video/mp4'
+else:
+    VIDEO_OUTPUT_EXTENSION, VIDEO_OUTPUT_MIMETYPE = '.webm', 'video/webm'
+
+MANIFEST_KEY = 'uploads:%s:%s'
+# Hash of the durations (in seconds) of the user's uploaded videos, read once at upload so that starting jobs never waits on ffprobe
+DURATIONS_KEY = 'uploads:%s:durations'
+EXPIRY_KEY = 'uploads:expiry'
+# Maximum number of expired files deleted per Redis round trip
+GC_BATCH_SIZE = 100
+
+IMAGES = 'images'
+VIDEOS = 'videos'
+
+
+def input_path(kind, filename):
+    return '%s/input_%s/%s' % (kind, kind, filename)
+
+
+def output_video_filename(filename, output_mode=None):
+    '''
+        Filename of the output of an input video, a video (VIDEO_OUTPUT_EXTENSION) or a timeline depending on output_mode
+        (VIDEO_OUTPUT_MODE by default)
+        The whole input filename, extension included, is kept so that inputs that only differ in their extension (a.mp4, a.avi)
+        or after a dot (clip.v1.mp4, clip.v2.mp4) never share an output
+    '''
+    if (output_mode or VIDEO_OUTPUT_MODE) == 'annotations':
+        return filename + TIMELINE_SUFFIX
+    return filename + VIDEO_OUTPUT_EXTENSION
+
+
+def output_path(kind, filename):
+    if kind == VIDEOS:
+        filename = output_video_filename(filename)
+    return '%s/output_%s/%s' % (kind, kind, filename)
+
+
+def upload_paths(image_filenames, video_filenames):
+    '''
+        Relative paths of all input and output files of an upload
+    '''
+    paths = []
+    for kind, filenames in ((IMAGES, image_filenames), (VIDEOS, video_filenames)):
+        for filename in filenames:
+            paths.append(input_path(kind, filename))
+            paths.append(output_path(kind, filename))
+    return paths
+
+
+def record_upload(connection, user_uuid, kind, filename, duration=None):
+    '''
+        Adds an uploaded file to the manifest of its user and schedules its input and output files for deletion after UPLOAD_TTL
+
+        Parameters:
+            connection: Redis connection
+            user_uuid: UUID of the user that uploaded the file
+            kind: IMAGES or VIDEOS
+            filename: Unique filename the file was saved as
+            duration: Duration of a video in seconds, None if it isn't known
+    '''
+    manifest_key = MANIFEST_KEY % (user_uuid, kind)
+    expiry = time.time() + UPLOAD_TTL
+
+    pipeline = connection.pipeline()
+    pipeline.rpush(manifest_key, filename)
+    pipeline.expire(manifest_key, UPLOAD_TTL)
+    if duration is not None:
+        pipeline.hset(DURATIONS_KEY % user_uuid, filename, duration)
+        pipeline.expire(DURATIONS_KEY % user_uuid, UPLOAD_TTL)
+    pipeline.zadd(EXPIRY_KEY, {input_path(kind, filename): expiry, output_path(kind, filename): expiry})
+    pipeline.execute()
+
+
+def get_uploads(connection, user_uuid):
+    '''
+        Returns the (image_filenames, video_filenames) uploaded by the user, in upload order
+    '''
+    pipeline = connection.pipeline()
+    pipeline.lrange(MANIFEST_KEY % (user_uuid, IMAGES), 0, -1)
+    pipeline.lrange(MANIFEST_KEY % (user_uuid, VIDEOS), 0, -1)
+    image_filenames, video_filenames = pipeline.execute()
+
+    return [filename.decode() for filename in image_filenames], [filename.decode() for filename in video_filenames]
+
+
+def get_video_durations(connection, user_uuid):
+    '''
+        Returns {video_filename: duration in seconds} of the user's uploaded videos whose duration is known
+    '''
+    return {filename.decode(): float(duration) for filename, duration in connection.hgetall(DURATIONS_KEY % user_uuid).items()}
+
+
+def results_served(connection, user_uuid, image_filenames, video_filenames):
+    '''
+        Called once the results page of an upload was rendered. Clears the manifest of the user
+        and brings the deletion of all files of the upload forward to RESULTS_SERVED_TTL from now
+    '''
+    expiry = time.time() + RESULTS_SERVED_TTL
+
+    pipeline = connection.pipeline()
+    pipeline.delete(MANIFEST_KEY % (user_uuid, IMAGES), MANIFEST_KEY % (user_uuid, VIDEOS), DURATIONS_KEY % user_uuid)
+
+    paths = upload_paths(image_filenames, video_filenames)
+    if paths:
+        pipeline.zadd(EXPIRY_KEY, {path: expiry for path in paths})
+
+    pipeline.execute()
+
+
+def collect_garbage(connection, upload_folder=UPLOAD_FOLDER):
+    '''
+        Deletes every file whose expiry time has passed and returns how many were deleted
+        Safe to run from several workers at once, a file is only deleted by the worker that removed it from the sorted set
+    '''
+    deleted = 0
+
+    while True:
+        paths = connection.zrangebyscore(EXPIRY_KEY, '-inf', time.time(), start=0, num=GC_BATCH_SIZE)
+
+        if not paths:
+            return deleted
+
+        for path in paths:
+            if not connection.zrem(EXPIRY_KEY, path):
+                continue
+
+            try:
+                os.remove(os.path.join(upload_folder, path.decode()))
+                deleted += 1
+            # Output files don't exist for failed jobs
+            except FileNotFoundError:
+                pass
+
+
+def run_garbage_collector(connection, upload_folder=UPLOAD_FOLDER, interval=GC_INTERVAL):
+    '''
+        Runs collect_garbage() every interval seconds forever, meant to be the target of a daemon thread
+    '''
+    while True:
+        try:
+            deleted = collect_garbage(connection, upload_folder)
+            if deleted:
+                print("Garbage collector deleted", deleted, "expired upload files")
+        except Exception as e:
+            print("Garbage collector failed:", e)
+
+        time.sleep(interval)
@@ -0,0 +1,158 @@
+# Output encoding backends of the annotated videos.
+# face_detection writes every annotated frame through a writer created by create_video_writer(), selected with VIDEO_ENCODER:
+#   "opencv": cv2.VideoWriter with the VP80 fourcc, single threaded but needs nothing besides OpenCV
+#   "ffmpeg": raw BGR frames are piped to a local ffmpeg subprocess, which encodes them with multiple threads
+#             using the codec, speed preset and quality (CRF) or bitrate configured below
+# Both writers have the write(frame) / release() interface of cv2.VideoWriter.
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+import cv2
+
+VIDEO_ENCODER = os.getenv('VIDEO_ENCODER', 'opencv')
+
+# Settings of the ffmpeg encoder
+# Codec, "vp8", "vp9" or "h264". H.264 is written into an MP4 container, so its outputs are named .mp4 (see upload_manifest.py)
+FFMPEG_CODEC = os.getenv('FFMPEG_CODEC', 'vp8')
+# Speed preset, "ultrafast" ... "veryslow" (for VP8/VP9 it is mapped onto their -deadline and -cpu-used options)
+FFMPEG_PRESET = os.getenv('FFMPEG_PRESET', 'veryfast')
+# Constant quality, lower is better and larger. Ignored if a bitrate is given
+FFMPEG_CRF = int(os.getenv('FFMPEG_CRF', 32))
+# Target bitrate, e.g., "1M", empty for constant quality
+FFMPEG_BITRATE = os.getenv('FFMPEG_BITRATE', '')
+# Encoder threads, 0 lets ffmpeg decide
+FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS', 0))
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+
+# ffmpeg encoder and container of every codec
+FFMPEG_CODECS = {
+    'vp8': ('libvpx', 'webm'),
+    'vp9': ('libvpx-vp9', 'webm'),
+    'h264': ('libx264', 'mp4')
+}
+# libvpx has no presets, the x264 presets are mapped onto its -deadline and -cpu-used speed options instead
+VPX_PRESETS = {
+    'ultrafast': ('realtime', 8),
+    'superfast': ('realtime', 6),
+    'veryfast': ('realtime', 5),
+    'faster': ('good', 5),
+    'fast': ('good', 4),
+    'medium': ('good', 2),
+    'slow': ('good', 1),
+    'slower': ('good', 0),
+    'veryslow': ('best', 0)
+}
+
+
+class OpenCVVideoWriter:
+    '''
+        Encodes frames into VP8 .webm with cv2.VideoWriter
+    '''
+
+    def __init__(self, output_file, fps, size):
+        # Note that size format is (width, height) and not (height, width)
+        self.writer = cv2.VideoWriter(output_file, cv2.VideoWriter_fourcc(*'VP80'), fps, size)
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+
+class FFmpegVideoWriter:
+    '''
+        Pipes raw BGR frames into a local ffmpeg subprocess that encodes them
+        release() waits for ffmpeg to finish and raises a RuntimeError if it failed
+
+        Parameters:
+            output_file: Path of the output video
+            fps: Frame rate of the output video
+            size: (width, height) of the frames
+            codec, preset, crf, bitrate, threads: Encoding settings, see the FFMPEG_* globals
+    '''
+
+    def __init__(self, output_file, fps, size, codec=None, preset=None, crf=None, bitrate=None, threads=None):
+        self.size = size
+        # stderr goes to a temporary file rather than a pipe, a pipe that is only read at release() could fill up
+        # and block ffmpeg, which would then block write()
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            ffmpeg_command(output_file, fps, size, codec or FFMPEG_CODEC, preset or FFMPEG_PRESET,
+                           FFMPEG_CRF if crf is None else crf, FFMPEG_BITRATE if bitrate is None else bitrate,
+                           FFMPEG_THREADS if threads is None else threads),
+            stdin=subprocess.PIPE, stderr=self.log)
+
+    def write(self, frame):
+        # Frames of another size would shift every following frame, cv2.VideoWriter silently drops them too
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            return
+        self.process.stdin.write(frame.tobytes())
+
+    def release(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+        with self.log:
+            if self.process.returncode != 0:
+                self.log.seek(0)
+                raise RuntimeError('ffmpeg failed: ' + self.log.read().decode(errors='replace').strip())
+
+
+def ffmpeg_command(output_file, fps, size, codec, preset, crf, bitrate, threads):
+    '''
+        Command line of an ffmpeg process that reads raw BGR frames of the given size from stdin and encodes them into output_file
+    '''
+    encoder, container = FFMPEG_CODECS[codec]
+
+    command = [FFMPEG_BINARY, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d' % size, '-r', str(fps), '-i', '-',
+               '-an', '-c:v', encoder, '-pix_fmt', 'yuv420p', '-threads', str(threads)]
+
+    if codec == 'h264':
+        command += ['-preset', preset]
+        command += ['-b:v', bitrate] if bitrate else ['-crf', str(crf)]
+        # Moves the index to the start of the file so browsers can start playing before the whole file is loaded
+        command += ['-movflags', '+faststart']
+    else:
+        deadline, cpu_used = VPX_PRESETS[preset]
+        command += ['-deadline', deadline, '-cpu-used', str(cpu_used)]
+        # Row based multithreading is an option of libvpx-vp9 only, libvpx (VP8) doesn't know it
+        if codec == 'vp9':
+            command += ['-row-mt', '1']
+        # Without a bitrate libvpx runs in constant quality mode, which needs -b:v 0
+        command += ['-b:v', bitrate] if bitrate else ['-crf', str(crf), '-b:v', '0']
+
+    return command + ['-f', container, output_file]
+
+
+def ffmpeg_available():
+    return shutil.which(FFMPEG_BINARY) is not None
+
+
+VIDEO_ENCODERS = {
+    'opencv': OpenCVVideoWriter,
+    'ffmpeg': FFmpegVideoWriter
+}
+
+
+def create_video_writer(output_file, fps, size, encoder=None, **settings):
+    '''
+        Creates the writer the annotated frames of a video are encoded with
+
+        Parameters:
+            output_file: Path of the output video
+            fps: Frame rate of the output video
+            size: (width, height) of the frames
+            encoder: Key of VIDEO_ENCODERS, VIDEO_ENCODER by default
+            settings: Encoding settings passed on to FFmpegVideoWriter
+    '''
+    encoder = encoder or VIDEO_ENCODER
+
+    if encoder not in VIDEO_ENCODERS:
+        raise ValueError("Unknown VIDEO_ENCODER '%s', expected one of %s" % (encoder, ', '.join(VIDEO_ENCODERS)))
+
+    return VIDEO_ENCODERS[encoder](output_file, fps, size, **settings)
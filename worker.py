@@ -1,16 +1,41 @@
 import os
+import threading
 
 import redis
-from rq import Worker, Queue, Connection
+from rq import SimpleWorker, Queue, Connection
 
-listen = ['default']
+# Queue classes with the time (in seconds) RQ holds on to the result of their jobs and how long a job may run
+# Image jobs are short, so they get their own queue and never wait behind a long video on the bulk queue
+FAST_QUEUE = 'images-fast'
+BULK_QUEUE = 'video-bulk'
+QUEUES = {
+	FAST_QUEUE: {'result_ttl': 5000, 'job_timeout': 300},
+	BULK_QUEUE: {'result_ttl': 5000, 'job_timeout': 3600},
+}
+
+# Queues this worker drains, in priority order: a job is only taken from a queue once all the queues before it are empty
+# e.g. WORKER_QUEUES=images-fast for a worker dedicated to images
+# "default" is still drained for jobs enqueued before the queue classes existed
+listen = os.getenv('WORKER_QUEUES', ','.join([FAST_QUEUE, BULK_QUEUE, 'default'])).split(',')
 
 redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
 
 conn = redis.from_url(redis_url)
 
 if __name__ == '__main__':
+	# Build the model and run a dummy forward pass once at boot, the jobs enqueued by app.jobs reuse it
+	# through face_detection.get_model() for the life of this process
+	# Imported here so that app.py, which imports conn from this module, doesn't pay for it
+	from face_detection import warm_model
+	warm_model()
+
+	# Delete expired uploads and outputs in the background, see upload_manifest.py
+	import upload_manifest
+	threading.Thread(target=upload_manifest.run_garbage_collector, args=(conn,), daemon=True).start()
+
 	with Connection(conn):
-		worker = Worker(list(map(Queue, listen)))
+		# SimpleWorker runs jobs in this process instead of a forked work horse,
+		# which is what lets the warm model survive from one job to the next
+		worker = SimpleWorker(list(map(Queue, listen)))
 		worker.work()
 